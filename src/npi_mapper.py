@@ -58,50 +58,827 @@
 #        - removed all name defaulting on locations, turns ou its not reliable at all
 #
 # ----------------------------------------------------------------------------------------------------
+import array
+import bisect
 import csv
 import json
 import argparse
+import base64
+import collections
+import concurrent.futures
+import cProfile
+import glob
+import hashlib
+import heapq
+import http.server
+import io
+import math
+import mmap
+import multiprocessing
 import datetime
+import difflib
+import fnmatch
 import time
 import os
+import pstats
 import sys
+import tempfile
+import threading
+import urllib.parse
+import warnings
 import pandas
 import sqlite3
 import signal
 import random
+import resource
+import zlib
+
+# --bump whenever the layout of the reference DB tables changes so existing DB files are reloaded
+referenceDbVersion = 4
+
+# --lookup tables built when a reference table is loaded, clustered by NPI so the rows of an NPI are
+#   read in one range scan.  Only the columns the lookups read are kept, under short names, with
+#   the other columns as part of the key so duplicate rows are dropped as they are inserted.
+#   Key columns cannot be null so nulls are stored as ''.  SEQ keeps the file order of the rows.
+#   An affiliation's SEQ is its place among all the NPI's distinct endpoint rows, its own endpoints included,
+#   which numbers its RECORD_ID as it always has
+referenceTableSql = {}
+referenceTableSql["PL"] = [
+    """create table PL_LOCATION (NPI text, A1 text, A2 text, CI text, ST text, PC text,
+                                 CO text, PH text, FX text, SEQ integer,
+                                 primary key (NPI, A1, A2, CI, ST, PC, CO, PH, FX)) without rowid""",
+    """insert or ignore into PL_LOCATION
+       select NPI,
+              coalesce("Provider Secondary Practice Location Address- Address Line 1", ''),
+              coalesce("Provider Secondary Practice Location Address-  Address Line 2", ''),
+              coalesce("Provider Secondary Practice Location Address - City Name", ''),
+              coalesce("Provider Secondary Practice Location Address - State Name", ''),
+              coalesce("Provider Secondary Practice Location Address - Postal Code", ''),
+              coalesce("Provider Secondary Practice Location Address - Country Code (If outside U.S.)", ''),
+              coalesce("Provider Secondary Practice Location Address - Telephone Number", ''),
+              coalesce("Provider Practice Location Address - Fax Number", ''),
+              rowid
+         from PL
+        order by rowid""",
+]
+referenceTableSql["ENDPOINT"] = [
+    """create table ENDPOINT_AFFILIATION (NPI text, EP text, NM text, A1 text, A2 text, CI text,
+                                          ST text, CO text, PC text, SEQ integer,
+                                          primary key (NPI, EP, NM, A1, A2, CI, ST, CO, PC)) without rowid""",
+    """insert or ignore into ENDPOINT_AFFILIATION
+       select NPI, EP, NM, A1, A2, CI, ST, CO, PC, SEQ
+         from (select NPI, IS_AFFILIATE, EP, NM, A1, A2, CI, ST, CO, PC,
+                      row_number() over (partition by NPI order by FIRST_ROW) as SEQ
+                 from (select NPI,
+                              "Affiliation" as IS_AFFILIATE,
+                              coalesce("Endpoint", '') as EP,
+                              coalesce("Affiliation Legal Business Name", '') as NM,
+                              coalesce("Affiliation Address Line One", '') as A1,
+                              coalesce("Affiliation Address Line Two", '') as A2,
+                              coalesce("Affiliation Address City", '') as CI,
+                              coalesce("Affiliation Address State", '') as ST,
+                              coalesce("Affiliation Address Country", '') as CO,
+                              coalesce("Affiliation Address Postal Code", '') as PC,
+                              min(rowid) as FIRST_ROW
+                         from ENDPOINT
+                        group by NPI, "Affiliation", "Endpoint", "Affiliation Legal Business Name",
+                                 "Affiliation Address Line One", "Affiliation Address Line Two",
+                                 "Affiliation Address City", "Affiliation Address State",
+                                 "Affiliation Address Country", "Affiliation Address Postal Code"))
+        where IS_AFFILIATE = 'Y'
+        order by NPI, SEQ""",
+]
+
+# --data sources that need each reference table, a table is not loaded when they are all skipped.
+#   The lookup tables are only built for their data source and the fragments for NPI-PROVIDERS
+referenceTableDataSources = {
+    "OTHERNAME": ("NPI-PROVIDERS",),
+    "PL": ("NPI-LOCATIONS",),
+    "ENDPOINT": ("NPI-PROVIDERS", "NPI-AFFILIATIONS"),
+}
+referenceTableSource = {"PL": "NPI-LOCATIONS", "ENDPOINT": "NPI-AFFILIATIONS"}
+# --what each reference file is called in the messages
+referenceFileNames = {
+    "OTHERNAME": "Other Name",
+    "PL": "Practice Location",
+    "ENDPOINT": "Endpoint",
+}
+
+# --per NPI fragments built when a reference table is loaded, the other names and the NPI's own
+#   endpoints are classified and de-duplicated in bulk so the main loop only has to splice them in
+referenceFragmentSql = {}
+referenceFragmentSql["OTHERNAME"] = [
+    "create table OTHERNAME_FRAG (NPI text primary key, OTHER_NAMES text) without rowid",
+    """insert into OTHERNAME_FRAG
+       select NPI,
+              json_group_array(json_object(
+                  case TYPE_CODE when '3' then 'DBA_NAME_ORG'
+                                 when '4' then 'FORMER_NAME_ORG'
+                                 else 'OTHER_NAME_ORG' end,
+                  NAME))
+         from (select NPI,
+                      "Provider Other Organization Name" as NAME,
+                      "Provider Other Organization Name Type Code" as TYPE_CODE
+                 from OTHERNAME
+                where rowid in (select min(rowid) from OTHERNAME
+                                 where "Provider Other Organization Name" <> 'NONE'
+                                 group by NPI, "Provider Other Organization Name")
+                order by NPI, rowid)
+        where TYPE_CODE in ('3', '4', '5')
+        group by NPI""",
+]
+referenceFragmentSql["ENDPOINT"] = [
+    "create table ENDPOINT_FRAG (NPI text primary key, ENDPOINT_LIST text) without rowid",
+    """insert into ENDPOINT_FRAG
+       select NPI,
+              json_group_array(json_object(
+                  case when instr(ENDPOINT, '@') > 1 then 'EMAIL_ADDRESS'
+                       else 'WEBSITE_ADDRESS' end,
+                  ENDPOINT))
+         from (select NPI, "Endpoint" as ENDPOINT, min(rowid) as FIRST_ROW
+                 from ENDPOINT
+                where coalesce("Affiliation", '') <> 'Y' and "Endpoint" <> ''
+                group by NPI, "Endpoint"
+                order by NPI, FIRST_ROW)
+        group by NPI""",
+]
+
+# --columns the mapping reads from each input file, the headers are checked for them before anything is loaded
+requiredColumns = {}
+requiredColumns["NPIDATA"] = [
+    "NPI",
+    "Entity Type Code",
+    "Replacement NPI",
+    "Provider Organization Name (Legal Business Name)",
+    "Provider Last Name (Legal Name)",
+    "Provider First Name",
+    "Provider Middle Name",
+    "Provider Name Prefix Text",
+    "Provider Name Suffix Text",
+    "Provider Other Organization Name",
+    "Provider Other Organization Name Type Code",
+    "Provider Other Last Name",
+    "Provider Other First Name",
+    "Provider Other Middle Name",
+    "Provider Other Name Prefix Text",
+    "Provider Other Name Suffix Text",
+    "Provider Other Last Name Type Code",
+    "Provider Business Mailing Address Telephone Number",
+    "Provider Business Mailing Address Fax Number",
+    "Provider Business Practice Location Address Telephone Number",
+    "Provider Business Practice Location Address Fax Number",
+    "Provider Enumeration Date",
+    "Last Update Date",
+    "NPI Deactivation Reason Code",
+    "NPI Deactivation Date",
+    "NPI Reactivation Date",
+    "Provider Gender Code",
+    "Authorized Official Last Name",
+    "Authorized Official First Name",
+    "Authorized Official Middle Name",
+    "Authorized Official Title or Position",
+    "Authorized Official Telephone Number",
+    "Authorized Official Name Prefix Text",
+    "Authorized Official Name Suffix Text",
+    "Parent Organization LBN",
+]
+requiredColumns["NPIDATA"] += [
+    x % y
+    for y in ("Business Mailing", "Business Practice Location")
+    for x in (
+        "Provider First Line %s Address",
+        "Provider Second Line %s Address",
+        "Provider %s Address City Name",
+        "Provider %s Address State Name",
+        "Provider %s Address Postal Code",
+        "Provider %s Address Country Code (If outside U.S.)",
+    )
+]
+requiredColumns["NPIDATA"] += [
+    x + str(y)
+    for x in (
+        "Healthcare Provider Taxonomy Code_",
+        "Provider License Number_",
+        "Provider License Number State Code_",
+        "Healthcare Provider Primary Taxonomy Switch_",
+        "Healthcare Provider Taxonomy Group_",
+    )
+    for y in range(1, 16)
+]
+requiredColumns["NPIDATA"] += [
+    x + str(y)
+    for x in (
+        "Other Provider Identifier_",
+        "Other Provider Identifier Type Code_",
+        "Other Provider Identifier State_",
+        "Other Provider Identifier Issuer_",
+    )
+    for y in range(1, 51)
+]
+requiredColumns["OTHERNAME"] = [
+    "NPI",
+    "Provider Other Organization Name",
+    "Provider Other Organization Name Type Code",
+]
+requiredColumns["PL"] = [
+    "NPI",
+    "Provider Secondary Practice Location Address- Address Line 1",
+    "Provider Secondary Practice Location Address-  Address Line 2",
+    "Provider Secondary Practice Location Address - City Name",
+    "Provider Secondary Practice Location Address - State Name",
+    "Provider Secondary Practice Location Address - Postal Code",
+    "Provider Secondary Practice Location Address - Country Code (If outside U.S.)",
+    "Provider Secondary Practice Location Address - Telephone Number",
+    "Provider Practice Location Address - Fax Number",
+]
+requiredColumns["ENDPOINT"] = [
+    "NPI",
+    "Endpoint",
+    "Affiliation",
+    "Affiliation Legal Business Name",
+    "Affiliation Address Line One",
+    "Affiliation Address Line Two",
+    "Affiliation Address City",
+    "Affiliation Address State",
+    "Affiliation Address Country",
+    "Affiliation Address Postal Code",
+]
+
+# --lookup tables with a sorted array of the NPIs they have rows for, so most NPIs are never looked up
+presenceTables = (
+    "OTHERNAME_FRAG",
+    "ENDPOINT_FRAG",
+    "PL_LOCATION",
+    "ENDPOINT_AFFILIATION",
+)
+
+# --stat categories for the other name types in the OTHERNAME fragments
+otherNameStats = {
+    "DBA_NAME_ORG": "NAME-DBA",
+    "FORMER_NAME_ORG": "NAME-FORMER",
+    "OTHER_NAME_ORG": "NAME-OTHER",
+}
+
+
+# --payload attributes are not used for resolution, they are left out of the records of data sources
+#   with the resolution output profile.  Names ending in _ are the prefix of numbered attributes
+payloadAttributes = {
+    "NPI-PROVIDERS": (
+        "Taxonomy Code_",
+        "Taxonomy Group_",
+        "Provider Enumeration Date",
+        "Last Update Date",
+        "NPI Deactivation Reason Code",
+        "NPI Deactivation Date",
+        "NPI Reactivation Date",
+        "Parent Organization LBN",
+    ),
+    "NPI-OFFICIALS": ("Title or Position", "Provider Name"),
+}
+outputProfileNames = ("full", "resolution")
+dataSourceNames = (
+    "NPI-PROVIDERS",
+    "NPI-OFFICIALS",
+    "NPI-LOCATIONS",
+    "NPI-AFFILIATIONS",
+)
+
+# --records that share a spread key are kept at least this many records apart when --spread-window allows
+spreadDistance = 32
+
+# --every stat category with examples also keeps a fixed size sketch of its values, the most frequent values
+#   and a hyperloglog of the distinct count, so shared values can be found without a second pass
+sketchTopValues = 10  # Most frequent values written to the stats
+sketchCapacity = 1000  # Values counted at once, counts are short by 1/1000 of the rest
+sketchPrecision = 12  # Hyperloglog registers are 2**precision bytes, about 1.6% error
+
+# --what the time of the mapping is attributed to in the --profile summary
+profileFunctions = {
+    "map_npi": "map_npi",
+    "map_auth": "map_auth",
+    "map_locations": "map_locations",
+    "map_endpoints": "map_endpoints",
+    "map_othernames": "map_othernames",
+    "map_npi_endpoints": "map_npi_endpoints",
+    "updateStat": "updateStat",
+    "next_npi_row": "csv parsing",
+    "encode_record": "json encoding",
+    "export_record": "export",
+}
+profileSampleSeconds = 0.005  # Stack sampling interval for --profile-mode sample
+
+# --rows of an --export-db table inserted at a time
+exportBatchSize = 10000
+
+# --records are written without the spaces json.dumps puts after separators
+jsonEncoder = json.JSONEncoder(separators=(",", ":"))
+
+# --guards the count of requests using each --serve store, a replaced store is closed when its last one is done
+serveStoreLock = threading.Lock()
+serveStore = None
+serveLoading = False
+
+# --the records and stats of the NPI being mapped, held in these lists until it maps cleanly
+heldRecords = None
+heldStats = None
+
+# --a --serve request maps into the same module globals as a mapping run, so only one request maps at a time
+#   even if the server is ever made threaded
+serveMapLock = threading.Lock()
+
+# --the run settings, set from the command line by init_run_settings
+shutDown = False
+sampleThreshold = None
+memoryBudget = None
+sortMemory = None
+npiFilter = None
+npiFilterActive = False
+idValuesToIgnore = {}
+partitionIndex = None
+partitionCount = None
+partitionSuffix = ""
+outputProfiles = {}
+activeDataSources = dataSourceNames
+spreadWindow = 0
+spreadBuffers = None
+anchorFirst = False
+stableIds = None
+
+# --the --export-db connection and the tables created in it
+exportConn = None
+exportTables = {}
+
+# --the state of the file period being mapped, reset by process_period
+currentPeriod = None
+statPack = {}
+statSketches = {}
+conn = None
+npiPresence = {}
+Providers_outFile = None
+Officials_outFile = None
+Affiliations_outFile = None
+Locations_outFile = None
+NPIinput_row_count = 0
+NPIfiltered_row_count = 0
+NPIpartition_row_count = 0
+NPIProvider_row_count = 0
+NPIOfficials_row_count = 0
+NPILocations_row_count = 0
+NPIAffiliations_row_count = 0
+JSON_row_count = 0
+metricsFileSpec = None
+refBytesRead = 0
+npiBytesRead = 0
+referenceLookupSeconds = 0.0
+periodStartTime = None
+mappingStartTime = None
+metricsWriteTime = 0
+npiErrFile = None
+npiErrFileSpec = None
+npiQuarantineCount = 0
+npiQuarantinedLines = set()
+npiLinesRead = 0
+npiRowStart = (0, 0)
+npiRowLines = []
+
+
+# -------------------------------------------------------------
+#  Leave out the payload attributes of a mapped record if its output profile is resolution
+# -------------------------------------------------------------
+def apply_output_profile(recordData):
+
+    if outputProfiles[recordData["DATA_SOURCE"]] == "resolution":
+        payloadNames = payloadAttributes.get(recordData["DATA_SOURCE"])
+        if payloadNames:
+            recordData = {
+                x: y for x, y in recordData.items() if not x.startswith(payloadNames)
+            }
+    return recordData
+
+
+# -------------------------------------------------------------
+#  Encode a mapped record as json with its output profile
+# -------------------------------------------------------------
+def encode_record(recordData):
+
+    return jsonEncoder.encode(apply_output_profile(recordData))
+
+
+# -------------------------------------------------------------
+#  Export a mapped record to the --export-db tables of its data source
+#     lists such as PROVIDER_LICENSE_NUMS are flattened into child tables keyed by RECORD_ID and SEQ
+# -------------------------------------------------------------
+def export_record(recordData):
+
+    recordData = apply_output_profile(recordData)
+    tableName = recordData["DATA_SOURCE"].replace("-", "_")
+    parentRow = {}
+    for attrName, attrValue in recordData.items():
+        if isinstance(attrValue, list):
+            for itemSeq, itemValue in enumerate(attrValue, 1):
+                childRow = {"RECORD_ID": recordData["RECORD_ID"], "SEQ": itemSeq}
+                if isinstance(itemValue, dict):
+                    childRow.update(itemValue)
+                else:
+                    childRow["VALUE"] = itemValue
+                add_export_row(tableName + "_" + attrName, childRow)
+        else:
+            parentRow[attrName] = attrValue
+    add_export_row(tableName, parentRow)
+
+
+def add_export_row(tableName, exportRow):
+
+    if tableName not in exportTables:
+        exportTables[tableName] = {"columns": [], "rows": []}
+    exportTables[tableName]["rows"].append(exportRow)
+    if len(exportTables[tableName]["rows"]) >= exportBatchSize:
+        flush_export_table(tableName)
+
+
+# -------------------------------------------------------------
+#  Insert the batched rows of an export table, adding any columns it does not have yet
+# -------------------------------------------------------------
+def flush_export_table(tableName):
+
+    exportTable = exportTables[tableName]
+    if not exportTable["rows"]:
+        return
+    newColumns = []
+    for exportRow in exportTable["rows"]:
+        for columnName in exportRow:
+            if (
+                columnName not in exportTable["columns"]
+                and columnName not in newColumns
+            ):
+                newColumns.append(columnName)
+    if not exportTable["columns"]:
+        exportConn.execute(
+            "create table %s (%s)"
+            % (
+                quote_name(tableName),
+                ", ".join(
+                    quote_name(x) + (" integer" if x == "SEQ" else " text")
+                    for x in newColumns
+                ),
+            )
+        )
+    else:
+        for columnName in newColumns:
+            exportConn.execute(
+                "alter table %s add column %s text"
+                % (quote_name(tableName), quote_name(columnName))
+            )
+    exportTable["columns"].extend(newColumns)
+    exportConn.executemany(
+        "insert into %s (%s) values (%s)"
+        % (
+            quote_name(tableName),
+            ", ".join(quote_name(x) for x in exportTable["columns"]),
+            ", ".join("?" * len(exportTable["columns"])),
+        ),
+        [tuple(x.get(y) for y in exportTable["columns"]) for x in exportTable["rows"]],
+    )
+    exportTable["rows"] = []
+
+
+def quote_name(inName):
+
+    return '"' + inName.replace('"', '""') + '"'
+
+
+# -------------------------------------------------------------
+#  Open the --export-db of a file period, it is rebuilt on every run
+# -------------------------------------------------------------
+def open_export_db(exportDbFileSpec):
+
+    global exportConn
+    global exportTables
+
+    if os.path.exists(exportDbFileSpec):
+        os.remove(exportDbFileSpec)
+    exportConn = sqlite3.connect(exportDbFileSpec)
+    exportConn.execute("pragma journal_mode = off")
+    exportConn.execute("pragma synchronous = off")
+    exportTables = {}
+
+
+# -------------------------------------------------------------
+#  Insert the last batches of the --export-db, index the tables by RECORD_ID and close it
+# -------------------------------------------------------------
+def close_export_db():
+
+    global exportConn
+
+    for tableName in exportTables:
+        flush_export_table(tableName)
+        exportConn.execute(
+            "create index %s on %s (RECORD_ID)"
+            % (quote_name(tableName + "_RECORD_ID"), quote_name(tableName))
+        )
+    exportConn.commit()
+    exportConn.close()
+    exportConn = None
+
+
+# -------------------------------------------------------------
+#  The key records are spread apart by with --spread-window: the affiliate name of an affiliation,
+#  otherwise the normalized address or phone, so records that share one are not loaded at the same time
+# -------------------------------------------------------------
+def get_spread_key(recordData):
+
+    if recordData.get("DATA_SOURCE") == "NPI-AFFILIATIONS" and recordData.get(
+        "PRIMARY_NAME_ORG"
+    ):
+        return "NAME " + " ".join(recordData["PRIMARY_NAME_ORG"].upper().split())
+    for addrLabel in ("BUSINESS", "PRIMARY", "MAILING"):
+        if recordData.get(addrLabel + "_ADDR_LINE1"):
+            return normalize_address(
+                recordData[addrLabel + "_ADDR_LINE1"],
+                recordData.get(addrLabel + "_ADDR_LINE2"),
+                recordData.get(addrLabel + "_ADDR_CITY"),
+                recordData.get(addrLabel + "_ADDR_STATE"),
+                recordData.get(addrLabel + "_ADDR_POSTAL_CODE"),
+            )
+    if recordData.get("PHONE_NUMBER"):
+        return "PHONE " + str(normalize_phone(recordData["PHONE_NUMBER"]))
+    return recordData["RECORD_ID"]
+
+
+# -------------------------------------------------------------
+#  Write a mapped record to its output file
+#     with --spread-window the last records of each file are held back so the ones that share a spread key
+#     can be written apart.  With --anchor-first a record is never written before the NPI record it points to
+#     while heldRecords is a list the records of the NPI being mapped are kept in it until it maps cleanly
+# -------------------------------------------------------------
+def write_record(outFile, recordData):
+
+    if heldRecords is not None:
+        heldRecords.append((outFile, recordData))
+        return
+    if exportConn:
+        export_record(recordData)
+
+    if not spreadWindow:
+        outFile.write(encode_record(recordData) + "\n")
+        return
+
+    if outFile not in spreadBuffers:
+        spreadBuffers[outFile] = {
+            "queues": {},
+            "keyHeap": [],
+            "recordCount": 0,
+            "recordSeq": 0,
+            "pendingAnchors": set(),
+            "writeSeq": 0,
+            "recentKeys": collections.deque(),
+            "lastWritten": {},
+        }
+    spreadBuffer = spreadBuffers[outFile]
+    spreadKey = get_spread_key(recordData)
+    anchorKey = recordData.get("REL_ANCHOR_KEY") if anchorFirst else None
+    if anchorKey:
+        spreadBuffer["pendingAnchors"].add(anchorKey)
+    spreadBuffer["recordSeq"] += 1
+    if spreadKey not in spreadBuffer["queues"]:
+        spreadBuffer["queues"][spreadKey] = collections.deque()
+        heapq.heappush(spreadBuffer["keyHeap"], (spreadBuffer["recordSeq"], spreadKey))
+    spreadBuffer["queues"][spreadKey].append(
+        (
+            spreadBuffer["recordSeq"],
+            encode_record(recordData),
+            recordData.get("REL_POINTER_KEY"),
+            anchorKey,
+        )
+    )
+    spreadBuffer["recordCount"] += 1
+    if spreadBuffer["recordCount"] > spreadWindow:
+        write_spread_record(outFile, spreadBuffer)
+
+
+# -------------------------------------------------------------
+#  Write the oldest record held back for --spread-window whose spread key is not too recently written
+#  and that is not waiting on its anchor, or the oldest record if there is none.
+#     a key should be written no closer than spreadDistance records apart, or closer when it holds
+#     so much of the window that it could not be written out otherwise
+#     the oldest record is never waiting on its anchor as anchors are written before their records
+# -------------------------------------------------------------
+def write_spread_record(outFile, spreadBuffer):
+
+    keyHeap = spreadBuffer["keyHeap"]
+    lastWritten = spreadBuffer["lastWritten"]
+    passedKeys = []
+    nextKey = None
+    while keyHeap and len(passedKeys) <= spreadDistance:
+        headSeq, spreadKey = heapq.heappop(keyHeap)
+        keyQueue = spreadBuffer["queues"][spreadKey]
+        keyDistance = min(spreadDistance, spreadBuffer["recordCount"] // len(keyQueue))
+        if (
+            spreadBuffer["writeSeq"] - lastWritten.get(spreadKey, -spreadDistance)
+            >= keyDistance
+            and keyQueue[0][2] not in spreadBuffer["pendingAnchors"]
+        ):
+            nextKey = spreadKey
+            break
+        passedKeys.append((headSeq, spreadKey))
+    if nextKey is None:
+        nextKey = passedKeys.pop(0)[1]
+    for passedKey in passedKeys:
+        heapq.heappush(keyHeap, passedKey)
+
+    keyQueue = spreadBuffer["queues"][nextKey]
+    recordText, anchorKey = keyQueue.popleft()[1::2]
+    if keyQueue:
+        heapq.heappush(keyHeap, (keyQueue[0][0], nextKey))
+    else:
+        del spreadBuffer["queues"][nextKey]
+    if anchorKey:
+        spreadBuffer["pendingAnchors"].discard(anchorKey)
+    spreadBuffer["recordCount"] -= 1
+    outFile.write(recordText + "\n")
+
+    # --only the keys written in the last spreadDistance records are remembered
+    spreadBuffer["writeSeq"] += 1
+    lastWritten[nextKey] = spreadBuffer["writeSeq"]
+    spreadBuffer["recentKeys"].append((nextKey, spreadBuffer["writeSeq"]))
+    if len(spreadBuffer["recentKeys"]) > spreadDistance:
+        oldKey, oldSeq = spreadBuffer["recentKeys"].popleft()
+        if lastWritten[oldKey] == oldSeq:
+            del lastWritten[oldKey]
+
+
+# -------------------------------------------------------------
+#  Write the records and add the stats held for an NPI that mapped cleanly
+# -------------------------------------------------------------
+def release_held_records():
+
+    global heldRecords
+    global heldStats
+
+    npiRecords = heldRecords
+    heldRecords = None
+    npiStats = heldStats
+    heldStats = None
+    for statArgs in npiStats:
+        updateStat(*statArgs)
+    for outFile, recordData in npiRecords:
+        write_record(outFile, recordData)
+
+
+# -------------------------------------------------------------
+#  Write all the records held back for --spread-window, before an output file is closed or read
+# -------------------------------------------------------------
+def flush_records(outFile):
+
+    spreadBuffer = spreadBuffers.pop(outFile, None)
+    while spreadBuffer and spreadBuffer["recordCount"]:
+        write_spread_record(outFile, spreadBuffer)
+
+
+# -------------------------------------------------------------
+#  RECORD_ID from a hash of a location or affiliation's values for --stable-ids, so it keeps its RECORD_ID
+#  when the NPI's other rows change.  The values are compared upper case with their spaces collapsed
+#     usedIds - the RECORD_IDs already given to the NPI's rows, a collision gets the next free -2, -3 suffix
+# -------------------------------------------------------------
+def get_stable_id(dataSource, inNPI, rowValues, usedIds):
+
+    contentText = "|".join(" ".join(str(x or "").upper().split()) for x in rowValues)
+    recordId = (
+        str(inNPI) + "-" + hashlib.sha1(contentText.encode("utf-8")).hexdigest()[:12]
+    )
+    stableId = recordId
+    idSuffix = 1
+    while stableId in usedIds:
+        idSuffix += 1
+        stableId = recordId + "-" + str(idSuffix)
+    if idSuffix > 1:
+        updateStat(dataSource, "STABLE-ID-COLLISION", stableId)
+    usedIds.add(stableId)
+    return stableId
+
+
+# -------------------------------------------------------------
+#  Sorted arrays of the NPIs each lookup table has rows for, built once the reference data is loaded
+#     NPIs that are not all digits are left out, they are always looked up
+# -------------------------------------------------------------
+def build_npi_presence(dbConn):
+
+    tableNPIs = {}
+    for tableName in presenceTables:
+        try:
+            npiCursor = dbConn.execute("select distinct NPI from %s" % tableName)
+        except sqlite3.OperationalError:  # --not loaded for the active data sources
+            continue
+        tableNPIs[tableName] = array.array(
+            "Q", sorted(int(x[0]) for x in npiCursor if x[0] and x[0].isdigit())
+        )
+    return tableNPIs
+
+
+# -------------------------------------------------------------
+#  Check whether a lookup table can have rows for an NPI, true when there is no array for the table
+# -------------------------------------------------------------
+def npi_in_table(tableName, inNPI):
+
+    tableNPIs = npiPresence.get(tableName)
+    if tableNPIs is None or not inNPI.isdigit():
+        return True
+    npiNumber = int(inNPI)
+    npiIndex = bisect.bisect_left(tableNPIs, npiNumber)
+    return npiIndex < len(tableNPIs) and tableNPIs[npiIndex] == npiNumber
+
+
+# -------------------------------------------------------------
+#  Normalize an address for comparison, upper case words of letters and digits with a 5 digit postal code
+# -------------------------------------------------------------
+def normalize_address(addr1, addr2, city, state, postalCode):
+
+    if not addr1:
+        return None
+    addrParts = [addr1, addr2 if addr2 != "NONE" else "", city, state]
+    addrParts = [x or "" for x in addrParts]
+    addrWords = "".join(x if x.isalnum() else " " for x in " ".join(addrParts).upper())
+    return " ".join(addrWords.split()) + " " + (postalCode or "")[:5]
+
+
+# -------------------------------------------------------------
+#  Normalize a phone number for comparison, its last 10 digits
+# -------------------------------------------------------------
+def normalize_phone(phoneNumber):
+
+    phoneDigits = "".join(x for x in (phoneNumber or "") if x.isdigit())
+    return phoneDigits[-10:] if phoneDigits else None
 
 
 # -------------------------------------------------------------
 #  Map Provider Locations Reference file for this NPI
+#     knownAddresses and knownPhones are the normalized addresses and phones the NPI already has,
+#     a location with no address or phone that is not already known is not written
 # -------------------------------------------------------------
-def map_locations(inNPI, inName, inType):
+def map_locations(inNPI, inName, inType, knownAddresses, knownPhones):
     global NPILocations_row_count
     global JSON_row_count
 
     cntr = 0
+    usedIds = set()
+    if not npi_in_table("PL_LOCATION", inNPI):
+        return
 
-    sql = "select distinct "
-    sql += ' "Provider Secondary Practice Location Address- Address Line 1"                  as ADDR1,'
-    sql += ' "Provider Secondary Practice Location Address-  Address Line 2"                 as ADDR2,'
-    sql += ' "Provider Secondary Practice Location Address - City Name"                      as CITY,'
-    sql += ' "Provider Secondary Practice Location Address - State Name"                     as STATE,'
-    sql += ' "Provider Secondary Practice Location Address - Postal Code"                    as POSTAL_CODE,'
-    sql += ' "Provider Secondary Practice Location Address - Country Code (If outside U.S.)" as COUNTRY,'
-    sql += ' "Provider Secondary Practice Location Address - Telephone Number"               as PH1,'
-    sql += ' "Provider Practice Location Address - Fax Number"                               as PH2'
-    sql += " from PL where pl.NPI = '" + str(inNPI) + "'"
+    # --the distinct locations were stored clustered by NPI in PL_LOCATION when the table was loaded
+    sql = "select "
+    sql += " nullif(A1, '') as ADDR1,"
+    sql += " nullif(A2, '') as ADDR2,"
+    sql += " nullif(CI, '') as CITY,"
+    sql += " nullif(ST, '') as STATE,"
+    sql += " nullif(PC, '') as POSTAL_CODE,"
+    sql += " nullif(CO, '') as COUNTRY,"
+    sql += " nullif(PH, '') as PH1,"
+    sql += " nullif(FX, '') as PH2"
+    sql += " from PL_LOCATION where NPI = ? order by SEQ"
 
     plObj = conn.cursor()
-    cursor1 = plObj.execute(sql)
+    cursor1 = plObj.execute(sql, (str(inNPI),))
     hdr1 = [col[0] for col in plObj.description]
     resultRow = cursor1.fetchone()
     while resultRow:
-        cntr += 1
         rsltRecord = dict(zip(hdr1, resultRow))
 
+        locAddress = normalize_address(
+            rsltRecord["ADDR1"],
+            rsltRecord["ADDR2"],
+            rsltRecord["CITY"],
+            rsltRecord["STATE"],
+            rsltRecord["POSTAL_CODE"],
+        )
+        locPhones = {
+            normalize_phone(rsltRecord["PH1"]),
+            normalize_phone(rsltRecord["PH2"]),
+        }
+        locPhones.discard(None)
+
+        # --a suppressed location keeps its number so the RECORD_IDs of the later ones do not change
+        cntr += 1
+        if not locAddress and not locPhones:
+            updateStat("NPI-LOCATIONS", "SUPPRESSED-EMPTY", inNPI)
+            resultRow = cursor1.fetchone()
+            continue
+        if (
+            not locAddress or locAddress in knownAddresses
+        ) and locPhones <= knownPhones:
+            updateStat("NPI-LOCATIONS", "SUPPRESSED-DUPLICATE", inNPI)
+            resultRow = cursor1.fetchone()
+            continue
+        if locAddress:
+            knownAddresses.add(locAddress)
+        knownPhones.update(locPhones)
+
         loc_data = {}
         loc_data["DATA_SOURCE"] = "NPI-LOCATIONS"
         loc_data["RECORD_ID"] = str(inNPI) + "-" + str(cntr)
+        if stableIds:
+            loc_data["RECORD_ID"] = get_stable_id(
+                loc_data["DATA_SOURCE"], inNPI, resultRow, usedIds
+            )
         loc_data["RECORD_TYPE"] = "ORGANIZATION"
         updateStat("DATA_SOURCES", loc_data["DATA_SOURCE"])
         updateStat(loc_data["DATA_SOURCE"], loc_data["RECORD_TYPE"])
@@ -139,7 +916,7 @@ def map_locations(inNPI, inName, inType):
         loc_data["REL_POINTER_KEY"] = inNPI
         loc_data["REL_POINTER_ROLE"] = "Secondary Location"
 
-        Locations_outFile.write(json.dumps(loc_data) + "\n")
+        write_record(Locations_outFile, loc_data)
         JSON_row_count += 1
         NPILocations_row_count += 1
 
@@ -154,138 +931,129 @@ def map_endpoints(inNPI):
     global NPIAffiliations_row_count
     global JSON_row_count
 
-    endpointList = (
-        []
-    )  # --jb: for emails and websites that belong to the NPI, not affiliates
-
-    cntr = 0
+    usedIds = set()
+    if not npi_in_table("ENDPOINT_AFFILIATION", inNPI):
+        return
 
-    sql = "select distinct "
-    sql += ' "Affiliation"                      as IS_AFFILIATE,'  # --jb: added
-    sql += ' "Endpoint"                         as ENDPOINT,'
-    sql += ' "Affiliation Legal Business Name"  as NAME_ORG,'  # --jb: added
-    sql += ' "Affiliation Address Line One"     as ADDR1,'
-    sql += ' "Affiliation Address Line Two"     as ADDR2,'
-    sql += ' "Affiliation Address City"         as CITY,'
-    sql += ' "Affiliation Address State"        as STATE,'
-    sql += ' "Affiliation Address Country"      as COUNTRY,'
-    sql += ' "Affiliation Address Postal Code"  as POSTAL_CODE'
-    sql += " From ENDPOINT where NPI = '" + str(inNPI) + "'"
+    # --jb: emails and websites that belong to the NPI, not affiliates, are mapped by map_npi_endpoints
+    #   the distinct affiliations were stored clustered by NPI in ENDPOINT_AFFILIATION when the table was loaded
+    sql = "select "
+    sql += " SEQ,"
+    sql += " nullif(EP, '') as ENDPOINT,"
+    sql += " nullif(NM, '') as NAME_ORG,"  # --jb: added
+    sql += " nullif(A1, '') as ADDR1,"
+    sql += " nullif(A2, '') as ADDR2,"
+    sql += " nullif(CI, '') as CITY,"
+    sql += " nullif(ST, '') as STATE,"
+    sql += " nullif(CO, '') as COUNTRY,"
+    sql += " nullif(PC, '') as POSTAL_CODE"
+    sql += " from ENDPOINT_AFFILIATION where NPI = ? order by SEQ"
 
     epObj = conn.cursor()
-    cursor1 = epObj.execute(sql)
+    cursor1 = epObj.execute(sql, (str(inNPI),))
     hdr1 = [col[0] for col in epObj.description]
     resultRow = cursor1.fetchone()
     while resultRow:
         rsltRecord = dict(zip(hdr1, resultRow))
-        cntr += 1
         ep_data = {}
 
-        if rsltRecord["IS_AFFILIATE"] == "Y":
-            ep_data["DATA_SOURCE"] = "NPI-AFFILIATIONS"
-            ep_data["RECORD_ID"] = str(inNPI) + "-" + str(cntr)
-            ep_data["RECORD_TYPE"] = "ORGANIZATION"
-            updateStat("DATA_SOURCES", ep_data["DATA_SOURCE"])
-            updateStat(ep_data["DATA_SOURCE"], ep_data["RECORD_TYPE"])
-
-            # --jb: added name org
-            if rsltRecord["NAME_ORG"]:
-                updateStat(ep_data["DATA_SOURCE"], "NAME", rsltRecord["NAME_ORG"])
-                ep_data["PRIMARY_NAME_ORG"] = rsltRecord["NAME_ORG"]
-            else:
-                updateStat(ep_data["DATA_SOURCE"], "MISSING_NAME", ep_data["RECORD_ID"])
+        ep_data["DATA_SOURCE"] = "NPI-AFFILIATIONS"
+        ep_data["RECORD_ID"] = str(inNPI) + "-" + str(rsltRecord["SEQ"])
+        if stableIds:
+            ep_data["RECORD_ID"] = get_stable_id(
+                ep_data["DATA_SOURCE"], inNPI, resultRow[1:], usedIds
+            )
+        ep_data["RECORD_TYPE"] = "ORGANIZATION"
+        updateStat("DATA_SOURCES", ep_data["DATA_SOURCE"])
+        updateStat(ep_data["DATA_SOURCE"], ep_data["RECORD_TYPE"])
 
-            if rsltRecord["ADDR1"]:
-                updateStat(ep_data["DATA_SOURCE"], "ADDR_LINE1", rsltRecord["ADDR1"])
-                ep_data["BUSINESS_ADDR_LINE1"] = rsltRecord["ADDR1"]
-                if rsltRecord["ADDR2"] and rsltRecord["ADDR2"] != "NONE":
-                    updateStat(
-                        ep_data["DATA_SOURCE"], "ADDR_LINE2", rsltRecord["ADDR2"]
-                    )
-                    ep_data["BUSINESS_ADDR_LINE2"] = rsltRecord["ADDR2"]
-                ep_data["BUSINESS_ADDR_CITY"] = rsltRecord["CITY"]
-                ep_data["BUSINESS_ADDR_STATE"] = rsltRecord["STATE"]
-                ep_data["BUSINESS_ADDR_POSTAL_CODE"] = rsltRecord["POSTAL_CODE"]
-                ep_data["BUSINESS_ADDR_COUNTRY"] = rsltRecord["COUNTRY"]
-
-            # Disclose rel to NPI
-            ep_data["REL_POINTER_DOMAIN"] = "NPI"
-            ep_data["REL_POINTER_KEY"] = inNPI
-            ep_data["REL_POINTER_ROLE"] = "Affiliate"
-
-        # --jb: these could be for the affiliate or for the NPI
-        if rsltRecord["ENDPOINT"]:
-            if rsltRecord["IS_AFFILIATE"] == "Y":
-                logDataSource = ep_data["DATA_SOURCE"]
-            else:
-                logDataSource = "NPI-PROVIDERS"
+        # --jb: added name org
+        if rsltRecord["NAME_ORG"]:
+            updateStat(ep_data["DATA_SOURCE"], "NAME", rsltRecord["NAME_ORG"])
+            ep_data["PRIMARY_NAME_ORG"] = rsltRecord["NAME_ORG"]
+        else:
+            updateStat(ep_data["DATA_SOURCE"], "MISSING_NAME", ep_data["RECORD_ID"])
+
+        if rsltRecord["ADDR1"]:
+            updateStat(ep_data["DATA_SOURCE"], "ADDR_LINE1", rsltRecord["ADDR1"])
+            ep_data["BUSINESS_ADDR_LINE1"] = rsltRecord["ADDR1"]
+            if rsltRecord["ADDR2"] and rsltRecord["ADDR2"] != "NONE":
+                updateStat(ep_data["DATA_SOURCE"], "ADDR_LINE2", rsltRecord["ADDR2"])
+                ep_data["BUSINESS_ADDR_LINE2"] = rsltRecord["ADDR2"]
+            ep_data["BUSINESS_ADDR_CITY"] = rsltRecord["CITY"]
+            ep_data["BUSINESS_ADDR_STATE"] = rsltRecord["STATE"]
+            ep_data["BUSINESS_ADDR_POSTAL_CODE"] = rsltRecord["POSTAL_CODE"]
+            ep_data["BUSINESS_ADDR_COUNTRY"] = rsltRecord["COUNTRY"]
+
+        # Disclose rel to NPI
+        ep_data["REL_POINTER_DOMAIN"] = "NPI"
+        ep_data["REL_POINTER_KEY"] = inNPI
+        ep_data["REL_POINTER_ROLE"] = "Affiliate"
 
+        if rsltRecord["ENDPOINT"]:
             if rsltRecord["ENDPOINT"].find("@") > 0:
-                if rsltRecord["IS_AFFILIATE"] == "Y":
-                    ep_data["EMAIL_ADDRESS"] = rsltRecord["ENDPOINT"]
-                else:
-                    endpointList.append({"EMAIL_ADDRESS": rsltRecord["ENDPOINT"]})
-                updateStat(logDataSource, "EMAIL_ADDRESS", rsltRecord["ENDPOINT"])
+                ep_data["EMAIL_ADDRESS"] = rsltRecord["ENDPOINT"]
+                updateStat(
+                    ep_data["DATA_SOURCE"], "EMAIL_ADDRESS", rsltRecord["ENDPOINT"]
+                )
 
             # --jb: if not email its a website or other url
             else:
-                updateStat(logDataSource, "WEBSITE_ADDRESS", rsltRecord["ENDPOINT"])
-                if rsltRecord["IS_AFFILIATE"] == "Y":
-                    ep_data["WEBSITE_ADDRESS"] = rsltRecord["ENDPOINT"]
-                else:
-                    endpointList.append({"WEBSITE_ADDRESS": rsltRecord["ENDPOINT"]})
+                updateStat(
+                    ep_data["DATA_SOURCE"], "WEBSITE_ADDRESS", rsltRecord["ENDPOINT"]
+                )
+                ep_data["WEBSITE_ADDRESS"] = rsltRecord["ENDPOINT"]
 
         # --jb: write it out to affiliate file
-        if rsltRecord["IS_AFFILIATE"] == "Y":
-            Affiliations_outFile.write(json.dumps(ep_data) + "\n")
-            JSON_row_count += 1
-            NPIAffiliations_row_count += 1
+        write_record(Affiliations_outFile, ep_data)
+        JSON_row_count += 1
+        NPIAffiliations_row_count += 1
 
         resultRow = cursor1.fetchone()
 
-    return endpointList
-
 
 #
 # -------------------------------------------------------------
 #  Map Othernames for this specific NPI #
 # -------------------------------------------------------------
 def map_othernames(inNPI):
-    oNames_Mapped = {}
     oNames = []
+    if not npi_in_table("OTHERNAME_FRAG", inNPI):
+        return oNames
 
-    sql = "select distinct "
-    sql += ' "Provider Other Organization Name"            as name1,'
-    sql += ' "Provider Other Organization Name Type Code"  as typCd'
-    sql += (
-        " from OTHERNAME where NPI = '"
-        + str(inNPI)
-        + "' and \"Provider Other Organization Name\" <> 'NONE'"
-    )
-
-    onObj = conn.cursor()
-    onCur = onObj.execute(sql)
-    hdr1 = [col[0] for col in onObj.description]
-    resultRow = onCur.fetchone()
-    while resultRow:
-        rsltRecord = dict(zip(hdr1, resultRow))
-        if rsltRecord["name1"] and rsltRecord["name1"] not in oNames_Mapped:
-            oNames_Mapped[rsltRecord["name1"]] = True
-            if rsltRecord["typCd"] == "3":  # DBA
-                updateStat("NPI-PROVIDER", "NAME-DBA", rsltRecord["name1"])
-                oNames.append({"DBA_NAME_ORG": rsltRecord["name1"]})
-            elif rsltRecord["typCd"] == "4":  # Former Bus name
-                updateStat("NPI-PROVIDER", "NAME-FORMER", rsltRecord["name1"])
-                oNames.append({"FORMER_NAME_ORG": rsltRecord["name1"]})
-            elif rsltRecord["typCd"] == "5":  # Other
-                updateStat("NPI-PROVIDER", "NAME-OTHER", rsltRecord["name1"])
-                oNames.append({"OTHER_NAME_ORG": rsltRecord["name1"]})
-
-        resultRow = onCur.fetchone()
+    # --the names were classified and de-duplicated into OTHER_NAMES fragments when the table was loaded
+    sql = "select OTHER_NAMES from OTHERNAME_FRAG where NPI = ?"
+    resultRow = conn.execute(sql, (str(inNPI),)).fetchone()
+    if resultRow:
+        oNames = json.loads(resultRow[0])
+        for oName in oNames:
+            for nameType, nameValue in oName.items():
+                updateStat("NPI-PROVIDER", otherNameStats[nameType], nameValue)
 
     return oNames
 
 
+#
+# -------------------------------------------------------------
+#  Map the Endpoint emails and websites that belong to this NPI, not its affiliates
+# -------------------------------------------------------------
+def map_npi_endpoints(inNPI):
+    endpointList = []
+    if not npi_in_table("ENDPOINT_FRAG", inNPI):
+        return endpointList
+
+    # --the endpoints were classified and de-duplicated into ENDPOINT_LIST fragments when the table was loaded
+    sql = "select ENDPOINT_LIST from ENDPOINT_FRAG where NPI = ?"
+    resultRow = conn.execute(sql, (str(inNPI),)).fetchone()
+    if resultRow:
+        endpointList = json.loads(resultRow[0])
+        for endpoint in endpointList:
+            for endpointType, endpointValue in endpoint.items():
+                updateStat("NPI-PROVIDERS", endpointType, endpointValue)
+
+    return endpointList
+
+
 #
 # -------------------------------------------------------------
 #  Map Authorized Official
@@ -349,21 +1117,40 @@ def map_auth(input_row, npi_name):
     auth_data["REL_POINTER_DOMAIN"] = "NPI"
     auth_data["REL_POINTER_ROLE"] = "Authorized Official"
 
-    return json.dumps(auth_data)
+    return auth_data
 
 
 #
 # -------------------------------------------------------------
-#  Maps the root after starting a new JSON row
+#  Builds the name the NPI's officials and locations refer back to it by
 # -------------------------------------------------------------
-def map_npi(input_row):
+def get_npi_name(input_row):
 
-    global JSON_row_count
-    global NPIOfficials_row_count
+    if input_row["Entity Type Code"] != "1":
+        return input_row["Provider Organization Name (Legal Business Name)"]
 
-    json_data = {}
+    npi_name = (
+        input_row["Provider Last Name (Legal Name)"]
+        + ", "
+        + input_row["Provider First Name"]
+    )
+    if (
+        input_row["Provider Middle Name"]
+        and input_row["Provider Middle Name"] != "NONE"
+    ):
+        npi_name = npi_name + " " + input_row["Provider Middle Name"]
+    return npi_name
 
-    currNPI = input_row["NPI"]
+
+#
+# -------------------------------------------------------------
+#  Maps the NPI-PROVIDERS record for an NPI
+# -------------------------------------------------------------
+def map_provider(input_row, npi_name):
+
+    global referenceLookupSeconds
+
+    json_data = {}
 
     # --required attributes
     json_data["DATA_SOURCE"] = "NPI-PROVIDERS"
@@ -389,16 +1176,19 @@ def map_npi(input_row):
     # Names
     if input_row["Entity Type Code"] == "1":
         json_data["PRIMARY_NAME_LAST"] = input_row["Provider Last Name (Legal Name)"]
-        npi_name = input_row["Provider Last Name (Legal Name)"]
         json_data["PRIMARY_NAME_FIRST"] = input_row["Provider First Name"]
-        npi_name = npi_name + ", " + input_row["Provider First Name"]
-        updateStat(json_data["DATA_SOURCE"], "NAME_LAST/FIRST-PRIMARY", npi_name)
+        updateStat(
+            json_data["DATA_SOURCE"],
+            "NAME_LAST/FIRST-PRIMARY",
+            input_row["Provider Last Name (Legal Name)"]
+            + ", "
+            + input_row["Provider First Name"],
+        )
         if (
             input_row["Provider Middle Name"]
             and input_row["Provider Middle Name"] != "NONE"
         ):
             json_data["PRIMARY_NAME_MIDDLE"] = input_row["Provider Middle Name"]
-            npi_name = npi_name + " " + input_row["Provider Middle Name"]
         if input_row["Provider Name Prefix Text"]:
             json_data["PRIMARY_NAME_PREFIX"] = input_row["Provider Name Prefix Text"]
         if input_row["Provider Name Suffix Text"]:
@@ -407,7 +1197,6 @@ def map_npi(input_row):
         json_data["PRIMARY_NAME_ORG"] = input_row[
             "Provider Organization Name (Legal Business Name)"
         ]
-        npi_name = input_row["Provider Organization Name (Legal Business Name)"]
         updateStat(json_data["DATA_SOURCE"], "NAME_ORG-PRIMARY", npi_name)
 
     if (
@@ -901,42 +1690,259 @@ def map_npi(input_row):
         json_data["Parent Organization LBN"] = input_row["Parent Organization LBN"]
 
     #   Map the Othername reference data if there is any for this NPI
+    #   and the Endpoint emails and websites that belong to the NPI
+    lookupStartTime = time.perf_counter()
     onNames = map_othernames(input_row["NPI"])
+    # --jb: some endpoints like email and website belong to the npi, others are affiliates
+    endpointList = map_npi_endpoints(input_row["NPI"])
+    referenceLookupSeconds += time.perf_counter() - lookupStartTime
     if onNames:
         json_data["OTHER_NAMES"] = onNames
+    if endpointList:
+        json_data["ENDPOINT_LIST"] = endpointList
+
+    return json_data
+
+
+#
+# -------------------------------------------------------------
+#  Maps the root after starting a new JSON row
+#     the NPI-PROVIDERS record is written after the records that point to it, or before them with --anchor-first
+#     and is only built when NPI-PROVIDERS is being mapped
+# -------------------------------------------------------------
+def map_npi(input_row):
+
+    global JSON_row_count
+    global NPIProvider_row_count
+    global NPIOfficials_row_count
+    global referenceLookupSeconds
+
+    currNPI = input_row["NPI"]
+
+    npi_name = get_npi_name(input_row)
+
+    if "NPI-PROVIDERS" in activeDataSources:
+        json_data = map_provider(input_row, npi_name)
+        if anchorFirst:
+            write_record(Providers_outFile, json_data)
+            JSON_row_count += 1
+            NPIProvider_row_count += 1
 
     #  Map the authorized official if there is one
-    if input_row["Authorized Official Last Name"]:
-        Officials_outFile.write(map_auth(input_row, npi_name) + "\n")
+    if (
+        input_row["Authorized Official Last Name"]
+        and "NPI-OFFICIALS" in activeDataSources
+    ):
+        write_record(Officials_outFile, map_auth(input_row, npi_name))
         JSON_row_count += 1
         NPIOfficials_row_count += 1
 
     #   Map the Provider Locations reference data if there are any for this NPI
-    map_locations(input_row["NPI"], npi_name, input_row["Entity Type Code"])
+    #   leaving out locations with only the addresses and phones the NPI already has
+    #   which are only normalized for the NPIs that have locations
+    if "NPI-LOCATIONS" in activeDataSources and npi_in_table(
+        "PL_LOCATION", input_row["NPI"]
+    ):
+        knownAddresses = set()
+        for addrPrefix in ("Business Mailing", "Business Practice Location"):
+            knownAddresses.add(
+                normalize_address(
+                    input_row["Provider First Line %s Address" % addrPrefix],
+                    input_row["Provider Second Line %s Address" % addrPrefix],
+                    input_row["Provider %s Address City Name" % addrPrefix],
+                    input_row["Provider %s Address State Name" % addrPrefix],
+                    input_row["Provider %s Address Postal Code" % addrPrefix],
+                )
+            )
+        knownPhones = {
+            normalize_phone(
+                input_row["Provider Business Mailing Address Telephone Number"]
+            ),
+            normalize_phone(input_row["Provider Business Mailing Address Fax Number"]),
+            normalize_phone(
+                input_row[
+                    "Provider Business Practice Location Address Telephone Number"
+                ]
+            ),
+            normalize_phone(
+                input_row["Provider Business Practice Location Address Fax Number"]
+            ),
+        }
+        knownAddresses.discard(None)
+        knownPhones.discard(None)
+        lookupStartTime = time.perf_counter()
+        map_locations(
+            input_row["NPI"],
+            npi_name,
+            input_row["Entity Type Code"],
+            knownAddresses,
+            knownPhones,
+        )
+        referenceLookupSeconds += time.perf_counter() - lookupStartTime
 
-    #   Map the Endpoint reference data if there are any for this NPI
-    endpointList = map_endpoints(input_row["NPI"])
-    # --jb: some endpoints like email and website belong to the npi, others are affiliates
-    if endpointList:
-        json_data["ENDPOINT_LIST"] = endpointList
+    #   Map the Endpoint affiliates if there are any for this NPI
+    if "NPI-AFFILIATIONS" in activeDataSources:
+        lookupStartTime = time.perf_counter()
+        map_endpoints(input_row["NPI"])
+        referenceLookupSeconds += time.perf_counter() - lookupStartTime
 
-    return json.dumps(json_data)
+    if "NPI-PROVIDERS" in activeDataSources and not anchorFirst:
+        write_record(Providers_outFile, json_data)
+        JSON_row_count += 1
+        NPIProvider_row_count += 1
 
 
 # -------------------------------------------------------------
 #  Load Reference data into DB
+#     keepNPIs        - optional set of NPIs, rows for any other NPI are not loaded
+#     sampleThreshold - only rows for NPIs whose hash falls under this (out of 1,000,000) are loaded
+#     loadChunkSize   - csv rows read at a time
+#     partition       - optional (partition number, partition count), only rows for NPIs in that partition are loaded
+#     dataSources     - optional data sources to build the lookups for, all of them if not given
 # -------------------------------------------------------------
-def loadDB(inFileSpec, inTabName):
+def loadDB(
+    inFileSpec,
+    inTabName,
+    dbConn,
+    keepNPIs,
+    sampleThreshold,
+    loadChunkSize,
+    partition=None,
+    dataSources=dataSourceNames,
+    errFileSpec=None,
+):
 
     msgOut(
         0, "  Populating " + inTabName + " DB Table from reference file ", "I", "", 0, 0
     )
-    df = pandas.read_csv(
-        inFileSpec, low_memory=False, encoding="latin-1", quotechar='"'
-    )
-    df.to_sql(inTabName, conn, if_exists="replace")
-    msgOut(0, "        Building " + inTabName + ".NPI Index", "I", "", 0, 0)
-    conn.cursor().execute("create index ix_%s on %s (NPI)" % (inTabName, inTabName))
+    dbConn.cursor().execute("drop table if exists %s" % inTabName)
+    rowsLoaded = 0
+    # --rows with too many fields are skipped by pandas with a warning, they are quarantined after the load
+    with warnings.catch_warnings(record=True) as loadWarnings:
+        warnings.simplefilter("always", pandas.errors.ParserWarning)
+        for df in pandas.read_csv(
+            inFileSpec,
+            dtype=str,
+            encoding="latin-1",
+            quotechar='"',
+            chunksize=loadChunkSize,
+            on_bad_lines="warn",
+        ):
+            if keepNPIs is not None:
+                df = df[df["NPI"].isin(keepNPIs)]
+            else:
+                if sampleThreshold < 1000000:
+                    df = df[
+                        df["NPI"].map(lambda x: npi_hash(x) % 1000000 < sampleThreshold)
+                    ]
+                if partition:
+                    df = df[
+                        df["NPI"].map(
+                            lambda x: npi_partition(x, partition[1]) == partition[0]
+                        )
+                    ]
+            # --only the provider's own endpoints are needed without NPI-AFFILIATIONS
+            if inTabName == "ENDPOINT" and "NPI-AFFILIATIONS" not in dataSources:
+                df = df[df["Affiliation"] != "Y"]
+            df.to_sql(inTabName, dbConn, if_exists="append", index=False)
+            rowsLoaded += len(df)
+    if errFileSpec:
+        badLines = {}
+        for loadWarning in loadWarnings:
+            for warningLine in str(loadWarning.message).splitlines():
+                if warningLine.startswith("Skipping line "):
+                    lineNumber, errorText = warningLine[14:].split(": ", 1)
+                    badLines[int(lineNumber)] = errorText
+        quarantine_lines(inFileSpec, inTabName, errFileSpec, badLines)
+    msgOut(0, "        %s rows loaded into %s" % (rowsLoaded, inTabName), "I", "", 0, 0)
+    if (
+        inTabName in referenceTableSql
+        and referenceTableSource[inTabName] in dataSources
+    ):
+        msgOut(
+            0,
+            "        Building " + inTabName + " lookup table clustered by NPI",
+            "I",
+            "",
+            0,
+            0,
+        )
+        for sql in referenceTableSql[inTabName]:
+            dbConn.cursor().execute(sql)
+    if inTabName in referenceFragmentSql and "NPI-PROVIDERS" in dataSources:
+        msgOut(
+            0,
+            "        Building " + inTabName + "_FRAG per NPI fragments",
+            "I",
+            "",
+            0,
+            0,
+        )
+        for sql in referenceFragmentSql[inTabName]:
+            dbConn.cursor().execute(sql)
+    # --the lookups only read the clustered tables and fragments
+    dbConn.cursor().execute("drop table %s" % inTabName)
+    dbConn.commit()
+    dbConn.execute("vacuum")
+    return rowsLoaded
+
+
+# -------------------------------------------------------------
+#  Load Reference data into its own DB file, run in a separate process for each reference file
+#     the DB file is reused as is if it was loaded from the same file with the same settings
+# -------------------------------------------------------------
+def loadDBFile(
+    inFileSpec,
+    inTabName,
+    dbFileSpec,
+    keepNPIs,
+    sampleThreshold,
+    loadChunkSize,
+    loadFingerprint,
+    partition=None,
+    dataSources=dataSourceNames,
+    errFileSpec=None,
+):
+
+    if os.path.exists(dbFileSpec):
+        dbConn = sqlite3.connect(dbFileSpec)
+        try:
+            loadInfo = dbConn.execute(
+                "select FINGERPRINT, ROWS_LOADED from LOAD_INFO"
+            ).fetchone()
+        except sqlite3.DatabaseError:
+            loadInfo = None
+        dbConn.close()
+        if loadInfo and loadInfo[0] == loadFingerprint:
+            msgOut(
+                0,
+                "  Reusing %s DB Table, reference file is unchanged" % inTabName,
+                "I",
+                "",
+                0,
+                0,
+            )
+            return loadInfo[1]
+        os.remove(dbFileSpec)  # --purge and reload
+
+    dbConn = sqlite3.connect(dbFileSpec)
+    rowsLoaded = loadDB(
+        inFileSpec,
+        inTabName,
+        dbConn,
+        keepNPIs,
+        sampleThreshold,
+        loadChunkSize,
+        partition,
+        dataSources,
+        errFileSpec,
+    )
+    # --written last so a partially loaded DB is never reused
+    dbConn.execute("create table LOAD_INFO (FINGERPRINT text, ROWS_LOADED integer)")
+    dbConn.execute("insert into LOAD_INFO values (?, ?)", (loadFingerprint, rowsLoaded))
+    dbConn.commit()
+    dbConn.close()
+    return rowsLoaded
 
 
 # -------------------------------------------------------------
@@ -954,6 +1960,420 @@ def check_id_value(inList):
     return retValue
 
 
+# -------------------------------------------------------------
+#  Parse a NPPES date (MM/DD/YYYY) or a filter date (YYYY-MM-DD)
+# -------------------------------------------------------------
+def parse_date(inValue):
+
+    for dateFormat in ("%m/%d/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(inValue, dateFormat).date()
+        except ValueError:
+            pass
+    return None
+
+
+# -------------------------------------------------------------
+#  Check a main NPI row against the subset filters given on the command line
+# -------------------------------------------------------------
+def check_npi_filter(input_row):
+
+    retValue = True
+
+    if npiFilter["states"] and (
+        input_row["Provider Business Practice Location Address State Name"]
+        not in npiFilter["states"]
+    ):
+        retValue = False
+
+    elif (
+        npiFilter["entityType"]
+        and input_row["Entity Type Code"] != npiFilter["entityType"]
+    ):
+        retValue = False
+
+    elif npiFilter["taxonomies"]:
+        retValue = False
+        for looper in range(1, 16):
+            taxonomyCode = input_row["Healthcare Provider Taxonomy Code_" + str(looper)]
+            # --groups are code plus description, ie: "193200000X SINGLE SPECIALTY GROUP"
+            taxonomyGroup = input_row[
+                "Healthcare Provider Taxonomy Group_" + str(looper)
+            ].split(" ")[0]
+            if (
+                taxonomyCode in npiFilter["taxonomies"]
+                or taxonomyGroup in npiFilter["taxonomies"]
+            ):
+                retValue = True
+                break
+
+    if retValue and npiFilter["status"]:
+        isActive = not input_row["NPI Deactivation Date"] or bool(
+            input_row["NPI Reactivation Date"]
+        )
+        retValue = isActive == (npiFilter["status"] == "active")
+
+    if retValue and (npiFilter["enumeratedFrom"] or npiFilter["enumeratedTo"]):
+        enumerationDate = parse_date(input_row["Provider Enumeration Date"])
+        if not enumerationDate:
+            retValue = False
+        elif (
+            npiFilter["enumeratedFrom"]
+            and enumerationDate < npiFilter["enumeratedFrom"]
+        ):
+            retValue = False
+        elif npiFilter["enumeratedTo"] and enumerationDate > npiFilter["enumeratedTo"]:
+            retValue = False
+
+    return retValue
+
+
+# -------------------------------------------------------------
+#  Stable hash of an NPI, the same NPI always hashes the same across files, runs and hosts
+# -------------------------------------------------------------
+def npi_hash(inNPI):
+
+    return zlib.crc32(str(inNPI).encode("utf-8"))
+
+
+# -------------------------------------------------------------
+#  Check if an NPI is part of the --sample-rate sample
+# -------------------------------------------------------------
+def check_npi_sample(inNPI):
+
+    return npi_hash(inNPI) % 1000000 < sampleThreshold
+
+
+# -------------------------------------------------------------
+#  Partition number (1 to inPartitionCount) of an NPI for --partition
+#     taken from the high digits of the hash so partitions are independent of the --sample-rate sample
+# -------------------------------------------------------------
+def npi_partition(inNPI, inPartitionCount):
+
+    return npi_hash(inNPI) // 1000000 % inPartitionCount + 1
+
+
+# -------------------------------------------------------------
+#  Split a comma separated parameter into a set of upper case values
+# -------------------------------------------------------------
+def parse_list_parm(inValue):
+
+    return {x.strip().upper() for x in inValue.split(",") if x.strip()}
+
+
+# -------------------------------------------------------------
+#  Scan the main NPI file for the NPIs that pass the subset filters
+# -------------------------------------------------------------
+def get_filtered_npis(inFileSpec):
+
+    msgOut(0, "  Scanning main NPI file for NPIs that pass the filters", "I", "", 0, 0)
+    global npiBytesRead
+    global npiLinesRead
+
+    keepNPIs = set()
+    rowsScanned = 0
+    with open(inFileSpec, "rb") as inFile:
+        for input_row in read_npi_rows(inFile):
+            rowsScanned += 1
+            if shutDown:
+                break
+            if input_row is None:
+                continue
+            if sampleThreshold < 1000000 and not check_npi_sample(input_row["NPI"]):
+                continue
+            if (
+                partitionCount > 1
+                and npi_partition(input_row["NPI"], partitionCount) != partitionIndex
+            ):
+                continue
+            if check_npi_filter(input_row):
+                keepNPIs.add(input_row["NPI"])
+    # --the main loop reads the file again from the start, the rows quarantined here are not quarantined twice
+    npiBytesRead = 0
+    npiLinesRead = 0
+    msgOut(0, "        %s NPIs pass the filters" % len(keepNPIs), "I", "", 0, 0)
+    return keepNPIs, rowsScanned
+
+
+# -------------------------------------------------------------
+#  Parse a memory size such as 512M or 8G into bytes
+# -------------------------------------------------------------
+def parse_memory_size(inValue):
+
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    sizeValue = inValue.strip().upper().rstrip("B")
+    multiplier = 1
+    if sizeValue[-1:] in multipliers:
+        multiplier = multipliers[sizeValue[-1:]]
+        sizeValue = sizeValue[:-1]
+    try:
+        return int(float(sizeValue) * multiplier)
+    except ValueError:
+        return None
+
+
+# -------------------------------------------------------------
+#  Format a number of bytes for display
+# -------------------------------------------------------------
+def format_bytes(inBytes):
+
+    for unitName in ("bytes", "KB", "MB", "GB"):
+        if inBytes < 1024 or unitName == "GB":
+            break
+        inBytes = inBytes / 1024
+    return "%.1f %s" % (inBytes, unitName)
+
+
+# -------------------------------------------------------------
+#  Peak resident memory of this process, or of its largest child process, in bytes
+# -------------------------------------------------------------
+def get_peak_rss():
+
+    # --the reference loader processes count too, they run before the main mapping
+    peakRss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # --linux reports kilobytes, macos reports bytes
+    return peakRss if sys.platform == "darwin" else peakRss * 1024
+
+
+# -------------------------------------------------------------
+#  Average bytes per row of a csv file from a sample of its first lines
+# -------------------------------------------------------------
+def get_avg_row_bytes(inFileSpec, sampleLines=1000):
+
+    lineCount = 0
+    byteCount = 0
+    with open(inFileSpec, "rb") as inFile:
+        inFile.readline()  # --skip the header
+        for line in inFile:
+            lineCount += 1
+            byteCount += len(line)
+            if lineCount >= sampleLines:
+                break
+    return byteCount / lineCount if lineCount else 1
+
+
+# -------------------------------------------------------------
+#  Choose where the reference data lives and how it is loaded to fit a memory budget
+#     returns the backend, the csv rows to read per chunk and the sqlite page cache in KiB
+#        memory - sqlite database held entirely in memory
+#        sqlite - sqlite database file with a large page cache
+#        disk   - sqlite database file with a small page cache, relying on the on disk NPI index
+# -------------------------------------------------------------
+def choose_reference_backend(budgetBytes, refFileSpecs, refFraction):
+
+    refFileBytes = sum(os.path.getsize(x) for x in refFileSpecs) * refFraction
+    # --to_sql's index column and the NPI index make the db larger than the csv
+    estimatedDbBytes = int(refFileBytes * 1.5)
+
+    # --a chunk of rows in a pandas dataframe takes roughly 10x its csv size, and
+    #   the reference files are loaded at the same time so each gets a share of the budget
+    avgRowBytes = max(get_avg_row_bytes(x) for x in refFileSpecs)
+    loadChunkSize = int(budgetBytes * 0.1 / len(refFileSpecs) / (avgRowBytes * 10))
+    loadChunkSize = max(1000, min(1000000, loadChunkSize))
+    chunkBytes = int(loadChunkSize * avgRowBytes * 10 * len(refFileSpecs))
+
+    if estimatedDbBytes + chunkBytes < budgetBytes * 0.5:
+        backend = "memory"
+        cacheKiB = 0
+    elif estimatedDbBytes < budgetBytes * 0.5:
+        backend = "sqlite"
+        cacheKiB = int(estimatedDbBytes / 1024)
+    else:
+        backend = "disk"
+        cacheKiB = int(budgetBytes * 0.1 / 1024)
+
+    msgOut(
+        0,
+        "  Memory budget %s, estimated reference data %s, using %s backend with %s row chunks"
+        % (
+            format_bytes(budgetBytes),
+            format_bytes(estimatedDbBytes),
+            backend,
+            loadChunkSize,
+        ),
+        "I",
+        "",
+        0,
+        0,
+    )
+    return backend, loadChunkSize, cacheKiB
+
+
+# -------------------------------------------------------------
+#  Check that a NPPES csv file is in NPI order without sorting it
+#     returns the number of rows and the number of rows with a lower NPI than the row before
+# -------------------------------------------------------------
+def check_npi_order(inFileSpec, stopAtFirst=False):
+
+    rowCount = 0
+    unorderedCount = 0
+    # --latin-1 decodes any byte so the check never fails on encoding
+    with open(inFileSpec, "r", encoding="latin-1", newline="") as inFile:
+        csvReader = csv.reader(inFile)
+        next(csvReader, None)
+        prevNPI = ""
+        for input_row in csvReader:
+            rowCount += 1
+            if input_row[0] < prevNPI:
+                unorderedCount += 1
+                if stopAtFirst:
+                    break
+            prevNPI = input_row[0]
+    return rowCount, unorderedCount
+
+
+# -------------------------------------------------------------
+#  Check the header of each input file of a file period has the columns the mapping reads
+#     only the header lines are read, every missing column is reported with the closest unused columns
+#     returns the number of missing columns
+# -------------------------------------------------------------
+def check_period_columns(sourceDir, filePeriod):
+
+    missingCount = 0
+    for fileType, tabName in (
+        ("npidata", "NPIDATA"),
+        ("othername", "OTHERNAME"),
+        ("pl", "PL"),
+        ("endpoint", "ENDPOINT"),
+    ):
+        if tabName != "NPIDATA" and not activeDataSources.intersection(
+            referenceTableDataSources[tabName]
+        ):
+            continue
+        fileSpec = os.path.abspath(
+            sourceDir + fileType + "_pfile_" + filePeriod + ".csv"
+        )
+        if not os.path.isfile(fileSpec):
+            continue
+        with open(fileSpec, "r", encoding="latin-1", newline="") as inFile:
+            headerRow = next(csv.reader(inFile), [])
+        unusedColumns = [x for x in headerRow if x not in requiredColumns[tabName]]
+        for columnName in requiredColumns[tabName]:
+            if columnName in headerRow:
+                continue
+            missingCount += 1
+            closeMatches = difflib.get_close_matches(columnName, unusedColumns, 3, 0.8)
+            msgOut(
+                0,
+                ' %s is missing column "%s"%s'
+                % (
+                    fileSpec,
+                    columnName,
+                    (
+                        ", did it become "
+                        + " or ".join('"%s"' % x for x in closeMatches)
+                        + "?"
+                        if closeMatches
+                        else ""
+                    ),
+                ),
+                "E",
+                "",
+                0,
+                0,
+            )
+    return missingCount
+
+
+# -------------------------------------------------------------
+#  Sort a NPPES csv file by NPI within a memory limit
+#     sorted runs are written to temp files then k-way merged, rows with the same NPI keep their order
+# -------------------------------------------------------------
+def sort_npi_file(inFileSpec, outFileSpec, sortMemory):
+
+    maxOpenRuns = 256  # Runs merged at a time, more than this are merged in passes
+    runDir = tempfile.mkdtemp(dir=os.path.dirname(outFileSpec))
+    runFileSpecs = []
+
+    def write_run(runRows):
+        runRows.sort(key=lambda x: x[0])
+        runFileSpec = os.path.join(runDir, "run%06d.csv" % len(runFileSpecs))
+        with open(runFileSpec, "w", encoding="latin-1", newline="") as runFile:
+            csv.writer(runFile, quoting=csv.QUOTE_ALL).writerows(runRows)
+        runFileSpecs.append(runFileSpec)
+
+    def merge_runs(mergeFileSpecs, mergeFileSpec, headerRow):
+        mergeFiles = [
+            open(x, "r", encoding="latin-1", newline="") for x in mergeFileSpecs
+        ]
+        with open(mergeFileSpec, "w", encoding="latin-1", newline="") as mergeFile:
+            csvWriter = csv.writer(mergeFile, quoting=csv.QUOTE_ALL)
+            if headerRow:
+                csvWriter.writerow(headerRow)
+            csvWriter.writerows(
+                heapq.merge(*[csv.reader(x) for x in mergeFiles], key=lambda x: x[0])
+            )
+        for mergeFile in mergeFiles:
+            mergeFile.close()
+        for runFileSpec in mergeFileSpecs:
+            os.remove(runFileSpec)
+
+    msgOut(0, "  Sorting " + inFileSpec + " by NPI", "I", "", 0, 0)
+    with open(inFileSpec, "r", encoding="latin-1", newline="") as inFile:
+        csvReader = csv.reader(inFile)
+        headerRow = next(csvReader)
+        runRows = []
+        runBytes = 0
+        for input_row in csvReader:
+            runRows.append(input_row)
+            # --python strings and lists take about 60 bytes each on top of the text
+            runBytes += sum(len(x) for x in input_row) + 60 * len(input_row) + 60
+            if runBytes >= sortMemory:
+                write_run(runRows)
+                runRows = []
+                runBytes = 0
+        if runRows or not runFileSpecs:
+            write_run(runRows)
+
+    msgOut(0, "        Merging %s sorted runs" % len(runFileSpecs), "I", "", 0, 0)
+    # --a merged run takes the place of the runs it holds, ahead of the later ones, so same NPI rows keep their order
+    while len(runFileSpecs) > maxOpenRuns:
+        mergeFileSpecs = runFileSpecs[:maxOpenRuns]
+        runFileSpecs = [mergeFileSpecs[-1] + ".merged"] + runFileSpecs[maxOpenRuns:]
+        merge_runs(mergeFileSpecs, runFileSpecs[0], None)
+    merge_runs(runFileSpecs, outFileSpec, headerRow)
+    os.rmdir(runDir)
+
+
+# -------------------------------------------------------------
+#  Return the input file as is if it is in NPI order, otherwise a sorted copy of it
+#     the sorted copy is named with a hash of the input file's full path, size and modified time,
+#     so an existing copy is only reused for the same unchanged input file
+# -------------------------------------------------------------
+def get_sorted_file(inFileSpec, sortDir, sortMemory):
+
+    fileStat = os.stat(inFileSpec)
+    inputDigest = hashlib.sha1(
+        "|".join(
+            (
+                os.path.abspath(inFileSpec),
+                str(fileStat.st_size),
+                str(fileStat.st_mtime_ns),
+            )
+        ).encode("utf-8")
+    ).hexdigest()[:12]
+    fileRoot, fileExt = os.path.splitext(os.path.basename(inFileSpec))
+    sortedFileSpec = os.path.join(sortDir, fileRoot + "_" + inputDigest + fileExt)
+    if os.path.isfile(sortedFileSpec):
+        msgOut(0, "  Using sorted copy " + sortedFileSpec, "I", "", 0, 0)
+        return sortedFileSpec
+
+    rowCount, unorderedCount = check_npi_order(inFileSpec, stopAtFirst=True)
+    if not unorderedCount:
+        return inFileSpec
+
+    os.makedirs(sortDir, exist_ok=True)
+    # --partitions on other nodes may be sorting the same file into a shared directory
+    sortTempFileSpec = sortedFileSpec + partitionSuffix + ".tmp"
+    sort_npi_file(inFileSpec, sortTempFileSpec, sortMemory)
+    os.replace(sortTempFileSpec, sortedFileSpec)
+    msgOut(0, "        Sorted copy written to " + sortedFileSpec, "I", "", 0, 0)
+    return sortedFileSpec
+
+
 # ---------------------------------------------------------------------
 #   msgout - Used to standardize output messages displayed to std out
 #      eDie    - Value of 1 will abort the processing
@@ -984,7 +2404,6 @@ def msgOut(eDie, eMsg, eType, eRow, eCode, eRowNum):
                 "{:%H:%M:%S}".format(datetime.datetime.now())
                 + "  ... Warning ->"
                 + eMsg
-                + msg2
             )
         else:
             print("{:%H:%M:%S} ".format(datetime.datetime.now()) + eMsg)
@@ -996,6 +2415,11 @@ def msgOut(eDie, eMsg, eType, eRow, eCode, eRowNum):
 def updateStat(cat1, cat2, example=None):
     global statPack
 
+    # --the stats of the NPI being mapped are held with its records until it maps cleanly
+    if heldStats is not None:
+        heldStats.append((cat1, cat2, example))
+        return
+
     if cat1 not in statPack:
         statPack[cat1] = {}
     if cat2 not in statPack[cat1]:
@@ -1004,6 +2428,7 @@ def updateStat(cat1, cat2, example=None):
 
     statPack[cat1][cat2]["count"] += 1
     if example:
+        update_stat_sketch(cat1, cat2, str(example))
         if "examples" not in statPack[cat1][cat2]:
             statPack[cat1][cat2]["examples"] = []
         if example not in statPack[cat1][cat2]["examples"]:
@@ -1016,300 +2441,1327 @@ def updateStat(cat1, cat2, example=None):
 
 
 # ----------------------------------------
-#    interrupt handler
+#    sketch of the values of a stat category
+#       top - misra-gries counters, when more than twice the capacity are kept the (capacity+1)th count
+#             is subtracted from all of them and added to error, the most any count can be short
+#       hll - hyperloglog registers, the highest rank of the hashes that fall in each
 # ----------------------------------------
-def signal_handler(signal, frame):
-    print("USER INTERRUPT! Shutting down ... (please wait)")
-    global shutDown
-    shutDown = True
-    return
+def new_stat_sketch():
 
+    return {"top": {}, "error": 0, "hll": bytearray(2**sketchPrecision)}
 
-# ---------------------------------------------------------------------
-#   M A I N     P R O G R A M
-# ---------------------------------------------------------------------
-if __name__ == "__main__":
 
-    global shutDown
-    shutDown = False
-    signal.signal(signal.SIGINT, signal_handler)
+def reduce_stat_sketch(statSketch):
 
-    global statPack
-    statPack = {}
+    topCounts = statSketch["top"]
+    if len(topCounts) <= sketchCapacity:
+        return
+    reduceBy = sorted(topCounts.values(), reverse=True)[sketchCapacity]
+    statSketch["top"] = {x: y - reduceBy for x, y in topCounts.items() if y > reduceBy}
+    statSketch["error"] += reduceBy
 
-    procStartTime = time.time()
-    abortRun = 0
 
-    msgOut(0, "  - Starting processing", "I", "", 0, 0)
-    # --   Checking Arguments passed in
-    msgOut(0, "      - Checking parameters passed in", "I", "", 0, 0)
+def update_stat_sketch(cat1, cat2, value):
 
-    argParser = argparse.ArgumentParser()
-    argParser.add_argument(
-        "-i",
-        "--sourceDir",
-        dest="sourceDir",
-        default="",
-        help="directory in which the source files are located",
-        required=True,
-    )
-    argParser.add_argument(
-        "-f",
-        "--filePeriod",
-        dest="filePeriod",
-        default="",
-        help='the period portion of the NPPES file naming convention such as "20050523-20201108"',
-        required=True,
-    )
-    argParser.add_argument(
-        "-o",
-        "--outFileDir",
-        dest="outputFilePath",
-        default="",
-        help="the file or directory to write the JSON files to",
-        required=True,
+    if (cat1, cat2) not in statSketches:
+        statSketches[(cat1, cat2)] = new_stat_sketch()
+    statSketch = statSketches[(cat1, cat2)]
+
+    # --a value still counted was already added to the registers
+    topCounts = statSketch["top"]
+    if value in topCounts:
+        topCounts[value] += 1
+        return
+    topCounts[value] = 1
+    if len(topCounts) > 2 * sketchCapacity:
+        reduce_stat_sketch(statSketch)
+
+    valueHash = int.from_bytes(
+        hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little"
     )
-    argParser.add_argument(
-        "-l",
-        "--logFileName",
-        dest="logFileName",
-        default="",
-        help="optional statistics output file name",
+    register = valueHash & (2**sketchPrecision - 1)
+    valueRank = 65 - sketchPrecision - (valueHash >> sketchPrecision).bit_length()
+    if valueRank > statSketch["hll"][register]:
+        statSketch["hll"][register] = valueRank
+
+
+# ----------------------------------------
+#    estimate the distinct count from the hyperloglog registers, with linear counting for small counts
+# ----------------------------------------
+def estimate_distinct(hllRegisters):
+
+    registerCount = len(hllRegisters)
+    rawEstimate = (
+        0.7213
+        / (1 + 1.079 / registerCount)
+        * registerCount**2
+        / sum(2.0**-x for x in hllRegisters)
     )
-    parms = argParser.parse_args()
+    zeroRegisters = hllRegisters.count(0)
+    if rawEstimate <= 2.5 * registerCount and zeroRegisters:
+        return round(registerCount * math.log(registerCount / zeroRegisters))
+    return round(rawEstimate)
 
-    if (parms.filePeriod and len(parms.filePeriod) > 0) and (
-        parms.sourceDir and len(parms.sourceDir) > 0
-    ):
-        #    Define all the file names
-        parms.sourceDir = parms.sourceDir + (
-            os.path.sep if parms.sourceDir[-1:] != os.path.sep else ""
+
+# ----------------------------------------
+#    add the distinct count and most frequent values of each sketch to its stat category
+#       the counts of the top values are at least their true count less top_values_error
+# ----------------------------------------
+def add_sketch_stats(inStatPack, inStatSketches):
+
+    for (cat1, cat2), statSketch in inStatSketches.items():
+        if cat1 not in inStatPack or cat2 not in inStatPack[cat1]:
+            continue
+        reduce_stat_sketch(statSketch)
+        inStatPack[cat1][cat2]["distinct"] = estimate_distinct(statSketch["hll"])
+        topValues = sorted(statSketch["top"].items(), key=lambda x: (-x[1], x[0]))
+        inStatPack[cat1][cat2]["top_values"] = [
+            [x, y] for x, y in topValues[:sketchTopValues] if y > 1
+        ]
+        if statSketch["error"]:
+            inStatPack[cat1][cat2]["top_values_error"] = statSketch["error"]
+
+
+# ----------------------------------------
+#    sketches as json for a partition stats file, and merged back for --merge-stats
+#       counters are added and reduced, registers take the highest rank
+# ----------------------------------------
+def dump_stat_sketches(inStatSketches):
+
+    sketchList = []
+    for (cat1, cat2), statSketch in inStatSketches.items():
+        reduce_stat_sketch(statSketch)
+        sketchList.append(
+            {
+                "cat1": cat1,
+                "cat2": cat2,
+                "top": statSketch["top"],
+                "error": statSketch["error"],
+                "hll": base64.b64encode(zlib.compress(statSketch["hll"])).decode(),
+            }
         )
-        npiDataFileSpec = parms.sourceDir + "npidata_pfile_" + parms.filePeriod + ".csv"
-        onDataFileSpec = (
-            parms.sourceDir + "othername_pfile_" + parms.filePeriod + ".csv"
+    return sketchList
+
+
+def merge_stat_sketches(intoStatSketches, sketchList):
+
+    for sketchData in sketchList:
+        sketchKey = (sketchData["cat1"], sketchData["cat2"])
+        if sketchKey not in intoStatSketches:
+            intoStatSketches[sketchKey] = new_stat_sketch()
+        statSketch = intoStatSketches[sketchKey]
+        for value, valueCount in sketchData["top"].items():
+            statSketch["top"][value] = statSketch["top"].get(value, 0) + valueCount
+        statSketch["error"] += sketchData["error"]
+        reduce_stat_sketch(statSketch)
+        hllRegisters = zlib.decompress(base64.b64decode(sketchData["hll"]))
+        statSketch["hll"] = bytearray(map(max, statSketch["hll"], hllRegisters))
+
+
+# -------------------------------------------------------------
+#  Output file that keeps the sha256, bytes and records of what is written to it for the run manifest
+#     so the output does not have to be read again to check it
+# -------------------------------------------------------------
+class ChecksumFile:
+    """json lines output file that checksums and counts as it writes"""
+
+    def __init__(self, fileSpec):
+        self.fileSpec = fileSpec
+        self.outFile = open(fileSpec, "wb")
+        self.sha256 = hashlib.sha256()
+        self.byteCount = 0
+        self.recordCount = 0
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.sha256.update(data)
+        self.byteCount += len(data)
+        self.recordCount += data.count(b"\n")
+        self.outFile.write(data)
+
+    def close(self):
+        self.outFile.close()
+
+    def manifest_entry(self):
+        return {
+            "path": self.fileSpec,
+            "bytes": self.byteCount,
+            "records": self.recordCount,
+            "sha256": self.sha256.hexdigest(),
+        }
+
+
+# -------------------------------------------------------------
+#  Fingerprint of an input file for the run manifest
+# -------------------------------------------------------------
+def get_file_fingerprint(inFileSpec):
+
+    fileStat = os.stat(inFileSpec)
+    return {
+        "path": os.path.abspath(inFileSpec),
+        "bytes": fileStat.st_size,
+        "modified": datetime.datetime.fromtimestamp(fileStat.st_mtime).isoformat(),
+    }
+
+
+# -------------------------------------------------------------
+#  Quarantine a bad input row to the .err file of its input file as a json line
+#     with the line number and byte offset the row starts at, what was wrong with it and the row itself
+# -------------------------------------------------------------
+def quarantine_row(
+    errFile, inTabName, errorKind, lineNumber, byteOffset, errorText, rowText
+):
+
+    errFile.write(
+        json.dumps(
+            {
+                "FILE": inTabName,
+                "KIND": errorKind,
+                "LINE": lineNumber,
+                "OFFSET": byteOffset,
+                "ERROR": errorText,
+                "ROW": rowText,
+            }
         )
-        plDataFileSpec = parms.sourceDir + "pl_pfile_" + parms.filePeriod + ".csv"
-        epDataFileSpec = parms.sourceDir + "endpoint_pfile_" + parms.filePeriod + ".csv"
+        + "\n"
+    )
 
-        npiDataFileSpec = os.path.abspath(npiDataFileSpec)
-        onDataFileSpec = os.path.abspath(onDataFileSpec)
-        plDataFileSpec = os.path.abspath(plDataFileSpec)
-        epDataFileSpec = os.path.abspath(epDataFileSpec)
 
-        if os.path.isfile(npiDataFileSpec):
-            msgOut(
-                0,
-                "        NPI Main data Input File Name : " + npiDataFileSpec,
-                "I",
-                "",
-                0,
-                0,
-            )
-            npiDataErrFileSpec = npiDataFileSpec + ".err"
-        else:
-            abortRun = 1
-            msgOut(
-                0,
-                " NPI Main data Input File Name  : "
-                + npiDataFileSpec
-                + "   <-  is not a file or does not exist",
-                "E",
-                "",
-                2,
-                0,
+# -------------------------------------------------------------
+#  Quarantine the lines of a reference file pandas skipped, found by line number in one pass over the file
+#     any .err file left from an earlier load is replaced
+# -------------------------------------------------------------
+def quarantine_lines(inFileSpec, inTabName, errFileSpec, badLines):
+
+    if os.path.exists(errFileSpec):
+        os.remove(errFileSpec)
+    if not badLines:
+        return
+    with open(inFileSpec, "rb") as inFile, open(errFileSpec, "w") as errFile:
+        byteOffset = 0
+        for lineNumber, line in enumerate(inFile, 1):
+            if lineNumber in badLines:
+                quarantine_row(
+                    errFile,
+                    inTabName,
+                    "FIELD-COUNT",
+                    lineNumber,
+                    byteOffset,
+                    badLines[lineNumber],
+                    line.decode("latin-1"),
+                )
+            byteOffset += len(line)
+    msgOut(
+        0,
+        "        %s bad rows of %s quarantined to %s"
+        % (len(badLines), inTabName, errFileSpec),
+        "W",
+        "",
+        0,
+        0,
+    )
+
+
+# -------------------------------------------------------------
+#  Add the rows quarantined from the reference files to the stats
+# -------------------------------------------------------------
+def count_reference_quarantine(refTables):
+
+    for refFileSpec, refTabName in refTables:
+        errFileSpec = refFileSpec + partitionSuffix + ".err"
+        if refTabName not in refRowsLoaded or not os.path.exists(errFileSpec):
+            continue
+        with open(errFileSpec, "r") as errFile:
+            for errLine in errFile:
+                errRow = json.loads(errLine)
+                updateStat(
+                    "QUARANTINED",
+                    refTabName + " " + errRow["KIND"],
+                    "line %s" % errRow["LINE"],
+                )
+
+
+# -------------------------------------------------------------
+#  Quarantine a bad row of the main NPI file, the run is aborted once more than --max-error-rate
+#  of the rows read have been quarantined
+# -------------------------------------------------------------
+def quarantine_npi_row(errorKind, lineNumber, byteOffset, errorText, rowText):
+
+    global npiErrFile
+    global npiQuarantineCount
+    global shutDown
+
+    if lineNumber in npiQuarantinedLines:
+        return
+    npiQuarantinedLines.add(lineNumber)
+    if not npiErrFile:
+        npiErrFile = open(npiErrFileSpec, "w")
+    quarantine_row(
+        npiErrFile, "NPIDATA", errorKind, lineNumber, byteOffset, errorText, rowText
+    )
+    npiQuarantineCount += 1
+    updateStat("QUARANTINED", "NPIDATA " + errorKind, "line %s" % lineNumber)
+    if npiQuarantineCount > max(10, parms.maxErrorRate * npiLinesRead):
+        msgOut(
+            0,
+            " %s rows of %s quarantined, more than --max-error-rate allows"
+            % (npiQuarantineCount, npiErrFileSpec[:-4]),
+            "E",
+            "",
+            0,
+            0,
+        )
+        shutDown = True
+
+
+# -------------------------------------------------------------
+#  Read the next row of the main NPI file, its own function so csv parsing shows up when profiled
+# -------------------------------------------------------------
+def next_npi_row(npiReader):
+
+    return next(npiReader)
+
+
+# -------------------------------------------------------------
+#  Read the rows of the main NPI file as dicts, quarantining the rows that cannot be read
+#     a row with the wrong number of fields is quarantined and yielded as None so it is still counted
+# -------------------------------------------------------------
+def read_npi_rows(npiInputFile):
+
+    npiReader = csv.reader(read_lines(npiInputFile))
+    npiFieldNames = next(npiReader, [])
+    while True:
+        npiRowLines.clear()
+        try:
+            npiRowValues = next_npi_row(npiReader)
+        except StopIteration:
+            return
+        except csv.Error as err:
+            quarantine_npi_row("CSV", *npiRowStart, str(err), "".join(npiRowLines))
+            continue
+        if not npiRowValues:
+            continue
+        if len(npiRowValues) != len(npiFieldNames):
+            quarantine_npi_row(
+                "FIELD-COUNT",
+                *npiRowStart,
+                "expected %s fields, saw %s" % (len(npiFieldNames), len(npiRowValues)),
+                "".join(npiRowLines),
             )
-        if os.path.isfile(onDataFileSpec):
-            msgOut(
-                0,
-                "        Other Name reference data Input File Name : " + onDataFileSpec,
-                "I",
-                "",
-                0,
-                0,
+            yield None
+            continue
+        yield dict(zip(npiFieldNames, npiRowValues))
+
+
+# -------------------------------------------------------------
+#  Start profiling the mapping for --profile
+#     trace  - cProfile of every call, written as pstats
+#     sample - the main thread's stack every profileSampleSeconds, written as collapsed stacks for flamegraph tools
+# -------------------------------------------------------------
+def start_profile():
+
+    profileState = {"mode": parms.profileMode, "startTime": time.time()}
+    if parms.profileMode == "trace":
+        profileState["profiler"] = cProfile.Profile()
+        profileState["profiler"].enable()
+    else:
+        profileState["stackCounts"] = collections.Counter()
+        profileState["stopEvent"] = threading.Event()
+        profileState["sampler"] = threading.Thread(
+            target=sample_stacks,
+            args=(
+                threading.get_ident(),
+                profileState["stackCounts"],
+                profileState["stopEvent"],
+            ),
+            daemon=True,
+        )
+        profileState["sampler"].start()
+    return profileState
+
+
+def sample_stacks(threadIdent, stackCounts, stopEvent):
+
+    while not stopEvent.wait(profileSampleSeconds):
+        stackFrame = sys._current_frames().get(  # pylint: disable=protected-access
+            threadIdent
+        )
+        frameNames = []
+        while stackFrame:
+            frameNames.append(
+                "%s (%s:%s)"
+                % (
+                    stackFrame.f_code.co_name,
+                    os.path.basename(stackFrame.f_code.co_filename),
+                    stackFrame.f_code.co_firstlineno,
+                )
             )
-            onDataErrFileSpec = onDataFileSpec + ".err"
-        else:
+            stackFrame = stackFrame.f_back
+        if frameNames:
+            stackCounts[";".join(reversed(frameNames))] += 1
+
+
+# -------------------------------------------------------------
+#  Stop profiling, write the profile and a summary of where the time went
+#     the summary has the time in each of the profileFunctions, including what they call, and the top
+#     functions by their own time
+# -------------------------------------------------------------
+def stop_profile(profileState, profileFileSpec, rowsProfiled):
+
+    profileSeconds = time.time() - profileState["startTime"]
+    functionTimes = {}
+    ownTimes = {}
+    if profileState["mode"] == "trace":
+        profileState["profiler"].disable()
+        profileState["profiler"].dump_stats(profileFileSpec)
+        profileStats = pstats.Stats(profileState["profiler"])
+        timeUnit = "secs"
+        for (
+            fileName,
+            lineNumber,
+            functionName,
+        ), functionStats in profileStats.stats.items():  # pylint: disable=no-member
+            if functionName in profileFunctions:
+                functionTimes[profileFunctions[functionName]] = (
+                    functionTimes.get(profileFunctions[functionName], 0)
+                    + functionStats[3]
+                )
+            ownTimes[
+                "%s (%s:%s)" % (functionName, os.path.basename(fileName), lineNumber)
+            ] = functionStats[2]
+        profileTotal = profileStats.total_tt  # pylint: disable=no-member
+    else:
+        profileState["stopEvent"].set()
+        profileState["sampler"].join()
+        stackCounts = profileState["stackCounts"]
+        with open(profileFileSpec, "w") as profileFile:
+            for stackText, sampleCount in sorted(stackCounts.items()):
+                profileFile.write("%s %s\n" % (stackText, sampleCount))
+        timeUnit = "samples"
+        for stackText, sampleCount in stackCounts.items():
+            frameNames = stackText.split(";")
+            for summaryName in {
+                profileFunctions[x.split(" ", 1)[0]]
+                for x in frameNames
+                if x.split(" ", 1)[0] in profileFunctions
+            }:
+                functionTimes[summaryName] = (
+                    functionTimes.get(summaryName, 0) + sampleCount
+                )
+            ownTimes[frameNames[-1]] = ownTimes.get(frameNames[-1], 0) + sampleCount
+        profileTotal = sum(stackCounts.values())
+
+    summaryLines = [
+        "Profile of %s main NPI rows over %s seconds written to %s"
+        % (rowsProfiled, round(profileSeconds, 1), profileFileSpec),
+        "  Time in, including what it calls:",
+    ]
+    for summaryName in sorted(functionTimes, key=lambda x: -functionTimes[x]):
+        summaryLines.append(
+            "    %-20s %10s %s %5.1f%%"
+            % (
+                summaryName,
+                round(functionTimes[summaryName], 2),
+                timeUnit,
+                100 * functionTimes[summaryName] / (profileTotal or 1),
+            )
+        )
+    summaryLines.append("  Top functions by own time:")
+    for functionName in sorted(ownTimes, key=lambda x: -ownTimes[x])[:15]:
+        summaryLines.append(
+            "    %10s %s %5.1f%%  %s"
+            % (
+                round(ownTimes[functionName], 2),
+                timeUnit,
+                100 * ownTimes[functionName] / (profileTotal or 1),
+                functionName,
+            )
+        )
+    summaryFileSpec = os.path.splitext(profileFileSpec)[0] + "_summary.txt"
+    with open(summaryFileSpec, "w") as summaryFile:
+        summaryFile.write("\n".join(summaryLines) + "\n")
+    for summaryLine in summaryLines:
+        msgOut(0, "     " + summaryLine, "I", "", 0, 0)
+
+
+# -------------------------------------------------------------
+#  Read lines from a file opened in binary mode, keeping count of the bytes and lines read
+#     and the line and offset of the start of the current row.  Lines that are not utf-8 are quarantined
+# -------------------------------------------------------------
+def read_lines(inFile):
+
+    global npiBytesRead
+    global npiLinesRead
+    global npiRowStart
+
+    for line in inFile:
+        lineOffset = npiBytesRead
+        npiBytesRead += len(line)
+        npiLinesRead += 1
+        try:
+            lineText = line.decode("utf-8")
+        except UnicodeDecodeError as err:
+            quarantine_npi_row(
+                "ENCODING", npiLinesRead, lineOffset, str(err), line.decode("latin-1")
+            )
+            continue
+        if not npiRowLines:
+            npiRowStart = (npiLinesRead, lineOffset)
+        npiRowLines.append(lineText)
+        yield lineText
+
+
+# ----------------------------------------
+#    write the live metrics file, rewritten in place so readers never see a partial file
+#       .prom files are written in prometheus textfile collector format, anything else as json
+# ----------------------------------------
+def write_metrics(stage):
+
+    global metricsWriteTime
+
+    metricsWriteTime = time.time()
+    if not metricsFileSpec:
+        return
+
+    mappingSeconds = metricsWriteTime - mappingStartTime if mappingStartTime else 0
+    metrics = {}
+    metrics["file_period"] = currentPeriod
+    metrics["stage"] = stage
+    metrics["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+    metrics["elapsed_seconds"] = round(metricsWriteTime - periodStartTime, 1)
+    metrics["rows_processed"] = {"npidata": NPIinput_row_count}
+    metrics["rows_processed"].update(refRowsLoaded)
+    metrics["rows_skipped"] = NPIfiltered_row_count
+    metrics["records_emitted"] = {
+        "NPI-PROVIDERS": NPIProvider_row_count,
+        "NPI-OFFICIALS": NPIOfficials_row_count,
+        "NPI-LOCATIONS": NPILocations_row_count,
+        "NPI-AFFILIATIONS": NPIAffiliations_row_count,
+    }
+    metrics["rows_per_second"] = (
+        round(NPIinput_row_count / mappingSeconds, 1) if mappingSeconds else 0
+    )
+    metrics["bytes_read"] = {"npidata": npiBytesRead}
+    metrics["bytes_read"].update(refBytesRead)
+    metrics["peak_rss_bytes"] = get_peak_rss()
+    metrics["reference_lookup_seconds"] = round(referenceLookupSeconds, 3)
+
+    if metricsFileSpec.endswith(".prom"):
+        metricLines = []
+
+        def add_metric(metricName, metricType, helpText, metricValues):
+            metricLines.append("# HELP npi_mapper_%s %s" % (metricName, helpText))
+            metricLines.append("# TYPE npi_mapper_%s %s" % (metricName, metricType))
+            for metricLabels, metricValue in metricValues:
+                metricLines.append(
+                    "npi_mapper_%s{%s} %s" % (metricName, metricLabels, metricValue)
+                )
+
+        periodLabel = 'period="%s"' % currentPeriod
+        add_metric(
+            "stage_info",
+            "gauge",
+            "Current stage of the run",
+            [('%s,stage="%s"' % (periodLabel, stage), 1)],
+        )
+        add_metric(
+            "last_update_timestamp_seconds",
+            "gauge",
+            "Time these metrics were written",
+            [(periodLabel, round(metricsWriteTime, 3))],
+        )
+        add_metric(
+            "rows_processed_total",
+            "counter",
+            "Input rows processed per source file",
+            [
+                ('%s,source="%s"' % (periodLabel, x), y)
+                for x, y in metrics["rows_processed"].items()
+            ],
+        )
+        add_metric(
+            "records_emitted_total",
+            "counter",
+            "JSON records written per data source",
+            [
+                ('%s,data_source="%s"' % (periodLabel, x), y)
+                for x, y in metrics["records_emitted"].items()
+            ],
+        )
+        add_metric(
+            "rows_per_second",
+            "gauge",
+            "Main NPI rows mapped per second",
+            [(periodLabel, metrics["rows_per_second"])],
+        )
+        add_metric(
+            "bytes_read_total",
+            "counter",
+            "Input bytes read per source file",
+            [
+                ('%s,source="%s"' % (periodLabel, x), y)
+                for x, y in metrics["bytes_read"].items()
+            ],
+        )
+        add_metric(
+            "peak_rss_bytes",
+            "gauge",
+            "Peak resident memory",
+            [(periodLabel, metrics["peak_rss_bytes"])],
+        )
+        add_metric(
+            "reference_lookup_seconds_total",
+            "counter",
+            "Time spent in reference data lookups",
+            [(periodLabel, metrics["reference_lookup_seconds"])],
+        )
+        metricsText = "\n".join(metricLines) + "\n"
+    else:
+        metricsText = json.dumps(metrics, indent=4)
+
+    with open(metricsFileSpec + ".tmp", "w") as metricsFile:
+        metricsFile.write(metricsText)
+    os.replace(metricsFileSpec + ".tmp", metricsFileSpec)
+
+
+# ----------------------------------------
+#    interrupt handler
+# ----------------------------------------
+def signal_handler(signal, frame):
+    print("USER INTERRUPT! Shutting down ... (please wait)")
+    global shutDown
+    shutDown = True
+    return
+
+
+# ---------------------------------------------------------------------
+#   Set the run wide settings from the command line parameters
+#      also used to initialize the worker processes when file periods are mapped in parallel,
+#      each of the inPeriodWorkers gets its share of the memory budget
+# ---------------------------------------------------------------------
+def init_run_settings(inParms, inMultiPeriod, inPeriodWorkers=1):
+
+    global parms
+    global multiPeriod
+    global shutDown
+    global sampleThreshold
+    global memoryBudget
+    global sortMemory
+    global npiFilter
+    global npiFilterActive
+    global idValuesToIgnore
+    global partitionIndex
+    global partitionCount
+    global partitionSuffix
+    global outputProfiles
+    global activeDataSources
+    global spreadWindow
+    global spreadBuffers
+    global anchorFirst
+    global heldRecords
+    global heldStats
+    global exportConn
+    global stableIds
+
+    parms = inParms
+    multiPeriod = inMultiPeriod
+    shutDown = False
+    heldRecords = None
+    heldStats = None
+    exportConn = None
+    stableIds = inParms.stableIds
+    signal.signal(signal.SIGINT, signal_handler)
+
+    abortRun = 0
+
+    # --sampled NPIs are those whose hash falls under this threshold out of 1,000,000
+    if inParms.sampleRate <= 0 or inParms.sampleRate > 1:
+        abortRun = 1
+        msgOut(
+            0,
+            " Invalid sample rate : "
+            + str(inParms.sampleRate)
+            + "   <-  must be greater than 0 and no more than 1",
+            "E",
+            "",
+            2,
+            0,
+        )
+    sampleThreshold = int(round(inParms.sampleRate * 1000000))
+    if inParms.maxErrorRate < 0 or inParms.maxErrorRate > 1:
+        abortRun = 1
+        msgOut(
+            0,
+            " Invalid max error rate : "
+            + str(inParms.maxErrorRate)
+            + "   <-  must be from 0 to 1",
+            "E",
+            "",
+            2,
+            0,
+        )
+
+    memoryBudget = None
+    if inParms.memoryBudget:
+        memoryBudget = parse_memory_size(inParms.memoryBudget)
+        if not memoryBudget:
             abortRun = 1
             msgOut(
                 0,
-                " Other Name reference data Input File Name  : "
-                + onDataFileSpec
-                + "   <-  is not a file or does not exist",
+                " Invalid memory budget : "
+                + inParms.memoryBudget
+                + "   <-  must be a size such as 512M or 8G",
                 "E",
                 "",
                 2,
                 0,
             )
-        if os.path.isfile(plDataFileSpec):
+        elif inPeriodWorkers > 1:
+            # --each parallel period gets its share of the memory budget
+            memoryBudget = int(memoryBudget / inPeriodWorkers)
+
+    # --output profiles are given as profile or data source=profile, such as "resolution,NPI-OFFICIALS=full"
+    outputProfiles = {x: "full" for x in dataSourceNames}
+    for outputProfile in [x.strip() for x in inParms.outputProfile.split(",") if x]:
+        profileSources = dataSourceNames
+        if "=" in outputProfile:
+            profileSource, outputProfile = [
+                x.strip() for x in outputProfile.split("=", 1)
+            ]
+            profileSources = [profileSource.upper()]
+        outputProfile = outputProfile.lower()
+        if (
+            outputProfile not in outputProfileNames
+            or profileSources[0] not in dataSourceNames
+        ):
+            abortRun = 1
             msgOut(
                 0,
-                "        Practice Location reference data Input File Name : "
-                + plDataFileSpec,
-                "I",
+                " Invalid output profile : "
+                + inParms.outputProfile
+                + "   <-  must be %s, optionally as data source=profile"
+                % " or ".join(outputProfileNames),
+                "E",
                 "",
-                0,
+                2,
                 0,
             )
-            plDataErrFileSpec = plDataFileSpec + ".err"
-        else:
+            continue
+        for profileSource in profileSources:
+            outputProfiles[profileSource] = outputProfile
+
+    # --only or skip some of the data sources, the NPI- prefix is optional
+    activeDataSources = set(dataSourceNames)
+    for dataSourceParm, keepListed in (
+        (inParms.onlySources, True),
+        (inParms.skipSources, False),
+    ):
+        if not dataSourceParm:
+            continue
+        listedSources = {
+            x if x.startswith("NPI-") else "NPI-" + x
+            for x in parse_list_parm(dataSourceParm)
+        }
+        if not listedSources <= set(dataSourceNames):
             abortRun = 1
             msgOut(
                 0,
-                " Practice Location reference data Input File Name  : "
-                + plDataFileSpec
-                + "   <-  is not a file or does not exist",
+                " Invalid data sources : "
+                + dataSourceParm
+                + "   <-  must be from "
+                + ",".join(dataSourceNames),
                 "E",
                 "",
                 2,
                 0,
             )
-        if os.path.isfile(epDataFileSpec):
+        if keepListed:
+            activeDataSources &= listedSources
+        else:
+            activeDataSources -= listedSources
+    if not activeDataSources:
+        abortRun = 1
+        msgOut(0, " --only and --skip leave no data sources to map", "E", "", 2, 0)
+
+    # --records held back to spread the ones that share an address, phone or affiliate through the output
+    spreadWindow = inParms.spreadWindow
+    spreadBuffers = {}
+    anchorFirst = inParms.anchorFirst
+    if spreadWindow < 0:
+        abortRun = 1
+        msgOut(0, " Spread window must be 0 or more", "E", "", 2, 0)
+
+    # --partition K/N maps only the NPIs that hash to partition K of N
+    partitionIndex = 1
+    partitionCount = 1
+    partitionSuffix = ""
+    if inParms.partition:
+        try:
+            partitionIndex, partitionCount = [
+                int(x) for x in inParms.partition.split("/")
+            ]
+        except ValueError:
+            partitionIndex, partitionCount = 0, 0
+        if not 1 <= partitionIndex <= partitionCount <= 100:
+            abortRun = 1
             msgOut(
                 0,
-                "        Endpoint reference data Input File Name : " + epDataFileSpec,
-                "I",
+                " Invalid partition : "
+                + inParms.partition
+                + "   <-  must be K/N such as 2/8, with N no more than 100",
+                "E",
                 "",
+                2,
                 0,
-                0,
-            )
-
-        outputFilePath = os.path.abspath(parms.outputFilePath)
-        if os.path.isdir(outputFilePath):
-            outputOneFile = False
-            msgOut(
-                0, "        Output File Directory : " + outputFilePath, "I", "", 0, 0
-            )
-        else:
-            outputOneFile = True
-            msgOut(0, "        Output File Name : " + outputFilePath, "I", "", 0, 0)
-
-        if abortRun == 1:
-            msgOut(1, " Aborting Run after Command Line Validation", "E", "", 42, 0)
-
-        #    Creating Output File names
-        if not outputOneFile:
-            outputFilePath = outputFilePath + (
-                os.path.sep if outputFilePath[-1:] != os.path.sep else ""
-            )
-            Providers_outputFileSpec = (
-                outputFilePath + "NPI_PROVIDERS_" + parms.filePeriod + ".json"
-            )
-            Officials_outputFileSpec = (
-                outputFilePath + "NPI_OFFICIALS_" + parms.filePeriod + ".json"
-            )
-            Affiliations_outputFileSpec = (
-                outputFilePath + "NPI_AFFILIATIONS_" + parms.filePeriod + ".json"
             )
-            Locations_outputFileSpec = (
-                outputFilePath + "NPI_LOCATIONS_" + parms.filePeriod + ".json"
-            )
-
-            #    Checking for existence of output files.  Delete if they exist.
-
-            if not os.path.isfile(Providers_outputFileSpec):
-                msgOut(
-                    0,
-                    "        NPI-PROVIDERS will be written to  : "
-                    + Providers_outputFileSpec,
-                    "I",
-                    "",
-                    0,
-                    0,
-                )
-            else:
+        elif partitionCount > 1:
+            partitionSuffix = "_p%sof%s" % (partitionIndex, partitionCount)
+            if not inParms.logFileName:
+                abortRun = 1
                 msgOut(
                     0,
-                    "        NPI-PROVIDERS output file exists and will be replaced  : "
-                    + Providers_outputFileSpec,
-                    "I",
+                    " A statistics file (-l) is required with --partition to merge the partition stats",
+                    "E",
                     "",
-                    0,
+                    2,
                     0,
                 )
-                os.remove(Providers_outputFileSpec)
 
-            if not os.path.isfile(Officials_outputFileSpec):
-                msgOut(
-                    0,
-                    "        NPI-OFFICIALS will be written to  : "
-                    + Officials_outputFileSpec,
-                    "I",
-                    "",
-                    0,
-                    0,
-                )
-            else:
-                msgOut(
-                    0,
-                    "        NPI-OFFICIALS output file exists and will be replaced  : "
-                    + Officials_outputFileSpec,
-                    "I",
-                    "",
-                    0,
-                    0,
-                )
-                os.remove(Officials_outputFileSpec)
+    sortMemory = parse_memory_size(inParms.sortMemory)
+    if not sortMemory:
+        abortRun = 1
+        msgOut(
+            0,
+            " Invalid sort memory : "
+            + inParms.sortMemory
+            + "   <-  must be a size such as 512M or 2G",
+            "E",
+            "",
+            2,
+            0,
+        )
 
-            if not os.path.isfile(Affiliations_outputFileSpec):
+    # --subset filters are applied as each main NPI row is parsed, before any mapping or reference lookups
+    npiFilter = {}
+    npiFilter["states"] = parse_list_parm(inParms.stateFilter)
+    npiFilter["entityType"] = inParms.entityTypeFilter
+    npiFilter["taxonomies"] = parse_list_parm(inParms.taxonomyFilter)
+    npiFilter["status"] = inParms.statusFilter
+    npiFilter["enumeratedFrom"] = None
+    npiFilter["enumeratedTo"] = None
+    for filterName in ("enumeratedFrom", "enumeratedTo"):
+        if getattr(parms, filterName):
+            npiFilter[filterName] = parse_date(getattr(parms, filterName))
+            if not npiFilter[filterName]:
+                abortRun = 1
                 msgOut(
                     0,
-                    "        NPI-AFFILIATIONS will be written to  : "
-                    + Affiliations_outputFileSpec,
-                    "I",
+                    " Invalid enumeration date filter : "
+                    + getattr(parms, filterName)
+                    + "   <-  must be YYYY-MM-DD",
+                    "E",
                     "",
-                    0,
+                    2,
                     0,
                 )
+    npiFilterActive = any(npiFilter.values())
+
+    # Set up list of ID values to ignore.  To check, split value by space and check first word to cover 'NONE ISSUED', 'NONE REQUIRED'....:
+    idValuesToIgnore = {}
+    idValuesToIgnore["========="] = True
+    idValuesToIgnore["PENDING"] = True
+    idValuesToIgnore["NA"] = True
+    idValuesToIgnore["ENROLLED"] = True
+    idValuesToIgnore["NONE"] = True
+
+    return abortRun
+
+
+# ---------------------------------------------------------------------
+#   Add the file period to an output file name when more than one period is mapped
+#      and the partition when only one partition is mapped
+# ---------------------------------------------------------------------
+def period_file_name(inFileName, filePeriod):
+
+    if not multiPeriod and not partitionSuffix:
+        return inFileName
+    fileRoot, fileExt = os.path.splitext(inFileName)
+    if multiPeriod:
+        fileRoot = fileRoot + "_" + filePeriod
+    return fileRoot + partitionSuffix + fileExt
+
+
+# ---------------------------------------------------------------------
+#   Expand the -i and -f parameters into the list of (source directory, file period) to map
+#      both can be comma separated lists and file periods can be wildcards such as "*-2020*"
+# ---------------------------------------------------------------------
+def get_period_list(inSourceDirs, inFilePeriods):
+
+    periodList = []
+    for sourceDir in [x.strip() for x in inSourceDirs.split(",") if x.strip()]:
+        sourceDir = sourceDir + (os.path.sep if sourceDir[-1:] != os.path.sep else "")
+        for filePeriod in [x.strip() for x in inFilePeriods.split(",") if x.strip()]:
+            if glob.has_magic(filePeriod):
+                filePrefix = sourceDir + "npidata_pfile_"
+                for npiFileSpec in sorted(glob.glob(filePrefix + filePeriod + ".csv")):
+                    periodName = npiFileSpec[len(filePrefix) : -4]
+                    if not periodName.endswith("_fileheader"):
+                        periodList.append((sourceDir, periodName))
             else:
-                msgOut(
-                    0,
-                    "        NPI-AFFILIATIONS output file exists and will be replaced  : "
-                    + Affiliations_outputFileSpec,
-                    "I",
-                    "",
-                    0,
-                    0,
-                )
-                os.remove(Affiliations_outputFileSpec)
+                periodList.append((sourceDir, filePeriod))
+    return periodList
 
-            if not os.path.isfile(Locations_outputFileSpec):
-                msgOut(
+
+# ---------------------------------------------------------------------
+#   Fingerprint of a reference file and how it is loaded, a reference DB is reused if its fingerprint is unchanged
+# ---------------------------------------------------------------------
+def get_load_fingerprint(inFileSpec, inTabName, keepNPIsDigest):
+
+    fileStat = os.stat(inFileSpec)
+    tableDataSources = [
+        x for x in referenceTableDataSources[inTabName] if x in activeDataSources
+    ]
+    return "|".join(
+        [
+            "v%s" % referenceDbVersion,
+            inFileSpec,
+            str(fileStat.st_size),
+            str(fileStat.st_mtime_ns),
+            str(sampleThreshold),
+            partitionSuffix,
+            ",".join(tableDataSources),
+            keepNPIsDigest,
+        ]
+    )
+
+
+# ---------------------------------------------------------------------
+#   Load the reference files of a file period and open the connection the lookups use
+#      refTables - list of (reference file, table name)
+#      keepNPIs  - optional set of NPIs, rows for any other NPI are not loaded
+#   the connection can be used from another thread for --serve, which loads a new file period in the background
+# ---------------------------------------------------------------------
+def open_reference_data(sourceDir, filePeriod, refTables, keepNPIs, refFraction):
+
+    refTables = [
+        x
+        for x in refTables
+        if activeDataSources.intersection(referenceTableDataSources[x[1]])
+    ]
+
+    # --fit the reference data to the memory budget if there is one
+    referenceBackend = "sqlite"
+    loadChunkSize = 250000  # Reference rows read from the csv at a time
+    cacheKiB = 0
+    if memoryBudget and refTables:
+        referenceBackend, loadChunkSize, cacheKiB = choose_reference_backend(
+            memoryBudget, [x[0] for x in refTables], refFraction
+        )
+
+    keepNPIsDigest = ""
+    if keepNPIs is not None:
+        keepNPIsDigest = hashlib.sha1(
+            "|".join(sorted(keepNPIs)).encode("utf-8")
+        ).hexdigest()
+    if referenceBackend == "memory":
+        msgOut(0, "  Initializing in memory DB for reference data", "I", "", 0, 0)
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        for refFileSpec, refTabName in refTables:
+            refRowsLoaded[refTabName] = loadDB(
+                refFileSpec,
+                refTabName,
+                conn,
+                keepNPIs,
+                sampleThreshold,
+                loadChunkSize,
+                (partitionIndex, partitionCount) if partitionCount > 1 else None,
+                tuple(activeDataSources),
+                refFileSpec + partitionSuffix + ".err",
+            )
+        conn.execute("pragma query_only = 1")
+    else:
+        # --each reference file is loaded and indexed at the same time in its own process and DB file
+        #   which are then attached to a single connection for the lookups
+        msgOut(
+            0,
+            "  Initializing temp DBs for reference data in :" + sourceDir,
+            "I",
+            "",
+            0,
+            0,
+        )
+        loadArgs = []
+        for refFileSpec, refTabName in refTables:
+            refDbFileSpec = (
+                sourceDir
+                + "NPPES_"
+                + filePeriod
+                + partitionSuffix
+                + "_"
+                + refTabName
+                + ".db"
+            )
+            loadArgs.append(
+                (
+                    refFileSpec,
+                    refTabName,
+                    refDbFileSpec,
+                    keepNPIs,
+                    sampleThreshold,
+                    loadChunkSize,
+                    get_load_fingerprint(refFileSpec, refTabName, keepNPIsDigest),
+                    (partitionIndex, partitionCount) if partitionCount > 1 else None,
+                    tuple(activeDataSources),
+                    refFileSpec + partitionSuffix + ".err",
+                )
+            )
+        if loadArgs:
+            with multiprocessing.Pool(len(loadArgs)) as loadPool:
+                for loadArg, rowsLoaded in zip(
+                    loadArgs, loadPool.starmap(loadDBFile, loadArgs)
+                ):
+                    refRowsLoaded[loadArg[1]] = rowsLoaded
+
+        # --the DB files are attached read only, memory mapped unless the memory budget is too small to hold them
+        conn = sqlite3.connect("file::memory:", uri=True, check_same_thread=False)
+        for loadArg in loadArgs:
+            refSchema = "ref_" + loadArg[1].lower()
+            conn.execute(
+                "attach database ? as %s" % refSchema,
+                ("file:" + urllib.parse.quote(loadArg[2]) + "?mode=ro",),
+            )
+            if cacheKiB:
+                conn.execute(
+                    "pragma %s.cache_size = -%s"
+                    % (refSchema, int(cacheKiB / len(loadArgs)))
+                )
+            if referenceBackend != "disk":
+                conn.execute(
+                    "pragma %s.mmap_size = %s"
+                    % (refSchema, os.path.getsize(loadArg[2]))
+                )
+        conn.execute("pragma query_only = 1")
+    return conn
+
+
+# ---------------------------------------------------------------------
+#   Map one file period from one source directory
+# ---------------------------------------------------------------------
+def process_period(sourceDir, filePeriod):
+
+    global statPack
+    global statSketches
+    global conn
+    global npiPresence
+    global Providers_outFile
+    global Officials_outFile
+    global Affiliations_outFile
+    global Locations_outFile
+    global NPIinput_row_count
+    global NPIfiltered_row_count
+    global NPIpartition_row_count
+    global NPIProvider_row_count
+    global NPIOfficials_row_count
+    global NPILocations_row_count
+    global NPIAffiliations_row_count
+    global JSON_row_count
+    global metricsFileSpec
+    global refRowsLoaded
+    global refBytesRead
+    global npiBytesRead
+    global referenceLookupSeconds
+    global periodStartTime
+    global mappingStartTime
+    global metricsWriteTime
+    global currentPeriod
+    global npiErrFile
+    global npiErrFileSpec
+    global npiQuarantineCount
+    global npiQuarantinedLines
+    global npiLinesRead
+    global npiRowStart
+    global npiRowLines
+    global heldRecords
+    global heldStats
+
+    currentPeriod = filePeriod
+    periodStartTime = time.time()
+    statPack = {}
+    statSketches = {}
+    abortRun = 0
+
+    msgOut(0, "  - Processing file period " + filePeriod, "I", "", 0, 0)
+    if (filePeriod and len(filePeriod) > 0) and (sourceDir and len(sourceDir) > 0):
+        #    Define all the file names
+        sourceDir = sourceDir + (os.path.sep if sourceDir[-1:] != os.path.sep else "")
+        npiDataFileSpec = sourceDir + "npidata_pfile_" + filePeriod + ".csv"
+        onDataFileSpec = sourceDir + "othername_pfile_" + filePeriod + ".csv"
+        plDataFileSpec = sourceDir + "pl_pfile_" + filePeriod + ".csv"
+        epDataFileSpec = sourceDir + "endpoint_pfile_" + filePeriod + ".csv"
+
+        npiDataFileSpec = os.path.abspath(npiDataFileSpec)
+        onDataFileSpec = os.path.abspath(onDataFileSpec)
+        plDataFileSpec = os.path.abspath(plDataFileSpec)
+        epDataFileSpec = os.path.abspath(epDataFileSpec)
+
+        if os.path.isfile(npiDataFileSpec):
+            msgOut(
+                0,
+                "        NPI Main data Input File Name : " + npiDataFileSpec,
+                "I",
+                "",
+                0,
+                0,
+            )
+        else:
+            abortRun = 1
+            msgOut(
+                0,
+                " NPI Main data Input File Name  : "
+                + npiDataFileSpec
+                + "   <-  is not a file or does not exist",
+                "E",
+                "",
+                2,
+                0,
+            )
+        # --only the reference files of the data sources being mapped are read
+        refTables = [
+            x
+            for x in (
+                (onDataFileSpec, "OTHERNAME"),
+                (plDataFileSpec, "PL"),
+                (epDataFileSpec, "ENDPOINT"),
+            )
+            if activeDataSources.intersection(referenceTableDataSources[x[1]])
+        ]
+        for refFileSpec, refTabName in refTables:
+            if os.path.isfile(refFileSpec):
+                msgOut(
                     0,
-                    "        NPI-LOCATIONS will be written to  : "
-                    + Locations_outputFileSpec,
+                    "        %s reference data Input File Name : %s"
+                    % (referenceFileNames[refTabName], refFileSpec),
                     "I",
                     "",
                     0,
                     0,
                 )
             else:
+                abortRun = 1
                 msgOut(
                     0,
-                    "        NPI-LOCATIONS output file exists and will be replaced  : "
-                    + Locations_outputFileSpec,
-                    "I",
+                    " %s reference data Input File Name  : %s   <-  is not a file or does not exist"
+                    % (referenceFileNames[refTabName], refFileSpec),
+                    "E",
                     "",
-                    0,
+                    2,
                     0,
                 )
-                os.remove(Locations_outputFileSpec)
 
-    npiInputFile = open(npiDataFileSpec, "r", encoding="utf-8")
+        outputFilePath = os.path.abspath(parms.outputFilePath)
+        if os.path.isdir(outputFilePath):
+            outputOneFile = False
+            msgOut(
+                0, "        Output File Directory : " + outputFilePath, "I", "", 0, 0
+            )
+        else:
+            outputOneFile = True
+            outputFilePath = period_file_name(outputFilePath, filePeriod)
+            msgOut(0, "        Output File Name : " + outputFilePath, "I", "", 0, 0)
+
+        if abortRun == 1:
+            msgOut(1, " Aborting Run after Command Line Validation", "E", "", 42, 0)
+
+        # --replace any input file that is not in NPI order with a sorted copy
+        if parms.sortInputs:
+            sortDir = parms.sortDir or os.path.join(
+                os.path.dirname(outputFilePath) if outputOneFile else outputFilePath,
+                "sorted",
+            )
+            npiDataFileSpec = get_sorted_file(npiDataFileSpec, sortDir, sortMemory)
+            refTables = [
+                (get_sorted_file(x, sortDir, sortMemory), y) for x, y in refTables
+            ]
+
+        #    Creating Output File names
+        if not outputOneFile:
+            outputFilePath = outputFilePath + (
+                os.path.sep if outputFilePath[-1:] != os.path.sep else ""
+            )
+            Providers_outputFileSpec = (
+                outputFilePath
+                + "NPI_PROVIDERS_"
+                + filePeriod
+                + partitionSuffix
+                + ".json"
+            )
+            Officials_outputFileSpec = (
+                outputFilePath
+                + "NPI_OFFICIALS_"
+                + filePeriod
+                + partitionSuffix
+                + ".json"
+            )
+            Affiliations_outputFileSpec = (
+                outputFilePath
+                + "NPI_AFFILIATIONS_"
+                + filePeriod
+                + partitionSuffix
+                + ".json"
+            )
+            Locations_outputFileSpec = (
+                outputFilePath
+                + "NPI_LOCATIONS_"
+                + filePeriod
+                + partitionSuffix
+                + ".json"
+            )
+
+            #    Checking for existence of output files.  Delete if they exist.
+
+            if "NPI-PROVIDERS" in activeDataSources:
+                if not os.path.isfile(Providers_outputFileSpec):
+                    msgOut(
+                        0,
+                        "        NPI-PROVIDERS will be written to  : "
+                        + Providers_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                else:
+                    msgOut(
+                        0,
+                        "        NPI-PROVIDERS output file exists and will be replaced  : "
+                        + Providers_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                    os.remove(Providers_outputFileSpec)
+
+            if "NPI-OFFICIALS" in activeDataSources:
+                if not os.path.isfile(Officials_outputFileSpec):
+                    msgOut(
+                        0,
+                        "        NPI-OFFICIALS will be written to  : "
+                        + Officials_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                else:
+                    msgOut(
+                        0,
+                        "        NPI-OFFICIALS output file exists and will be replaced  : "
+                        + Officials_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                    os.remove(Officials_outputFileSpec)
+
+            if "NPI-AFFILIATIONS" in activeDataSources:
+                if not os.path.isfile(Affiliations_outputFileSpec):
+                    msgOut(
+                        0,
+                        "        NPI-AFFILIATIONS will be written to  : "
+                        + Affiliations_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                else:
+                    msgOut(
+                        0,
+                        "        NPI-AFFILIATIONS output file exists and will be replaced  : "
+                        + Affiliations_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                    os.remove(Affiliations_outputFileSpec)
+
+            if "NPI-LOCATIONS" in activeDataSources:
+                if not os.path.isfile(Locations_outputFileSpec):
+                    msgOut(
+                        0,
+                        "        NPI-LOCATIONS will be written to  : "
+                        + Locations_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                else:
+                    msgOut(
+                        0,
+                        "        NPI-LOCATIONS output file exists and will be replaced  : "
+                        + Locations_outputFileSpec,
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+                    os.remove(Locations_outputFileSpec)
+
+    npiInputFile = open(npiDataFileSpec, "rb")
+
+    # --the same records are also exported to sqlite tables for analytics
+    exportDbFileSpec = ""
+    if parms.exportDbFileName:
+        exportDbFileSpec = period_file_name(parms.exportDbFileName, filePeriod)
+        open_export_db(exportDbFileSpec)
+        msgOut(
+            0,
+            "        Records will be exported to : " + exportDbFileSpec,
+            "I",
+            "",
+            0,
+            0,
+        )
+
+    # --bad rows are quarantined to the .err file of the file read, the line numbers are those of any sorted copy
+    npiErrFileSpec = npiDataFileSpec + partitionSuffix + ".err"
+    if os.path.exists(npiErrFileSpec):
+        os.remove(npiErrFileSpec)
+    npiErrFile = None
+    npiQuarantineCount = 0
+    npiQuarantinedLines = set()
+    npiLinesRead = 0
+    npiRowStart = (0, 0)
+    npiRowLines = []
 
     if outputOneFile:
-        one_outFile = open(outputFilePath, "w", encoding="utf-8")
+        one_outFile = ChecksumFile(outputFilePath)
         Providers_outFile = one_outFile
         Officials_outFile = one_outFile
         Affiliations_outFile = one_outFile
         Locations_outFile = one_outFile
     else:
-        Providers_outFile = open(Providers_outputFileSpec, "w", encoding="utf-8")
-        Officials_outFile = open(Officials_outputFileSpec, "w", encoding="utf-8")
-        Affiliations_outFile = open(Affiliations_outputFileSpec, "w", encoding="utf-8")
-        Locations_outFile = open(Locations_outputFileSpec, "w", encoding="utf-8")
+        # --no output file is written for a skipped data source
+        Providers_outFile = None
+        Officials_outFile = None
+        Affiliations_outFile = None
+        Locations_outFile = None
+        if "NPI-PROVIDERS" in activeDataSources:
+            Providers_outFile = ChecksumFile(Providers_outputFileSpec)
+        if "NPI-OFFICIALS" in activeDataSources:
+            Officials_outFile = ChecksumFile(Officials_outputFileSpec)
+        if "NPI-AFFILIATIONS" in activeDataSources:
+            Affiliations_outFile = ChecksumFile(Affiliations_outputFileSpec)
+        if "NPI-LOCATIONS" in activeDataSources:
+            Locations_outFile = ChecksumFile(Locations_outputFileSpec)
 
     NPIinput_row_count = 0
+    NPIfiltered_row_count = 0
+    NPIpartition_row_count = 0
     NPIProvider_row_count = 0
     NPIOfficials_row_count = 0
     NPILocations_row_count = 0
@@ -1317,31 +3769,46 @@ if __name__ == "__main__":
     JSON_row_count = 1
     progressInterval = 10000  # Report every 'this-many' records processed.
 
-    # Set up list of ID values to ignore.  To check, split value by space and check first word to cover 'NONE ISSUED', 'NONE REQUIRED'....:
-    idValuesToIgnore = {}
-    idValuesToIgnore["========="] = True
-    idValuesToIgnore["PENDING"] = True
-    idValuesToIgnore["NA"] = True
-    idValuesToIgnore["ENROLLED"] = True
-    idValuesToIgnore["NONE"] = True
+    # --live metrics
+    metricsFileSpec = (
+        period_file_name(parms.metricsFileName, filePeriod)
+        if parms.metricsFileName
+        else ""
+    )
+    refRowsLoaded = {}
+    refBytesRead = {}
+    npiBytesRead = 0
+    referenceLookupSeconds = 0.0
+    mappingStartTime = None
+    metricsWriteTime = 0
+    write_metrics("starting")
 
-    # --   open database connection and load from csv
-    dbname = parms.sourceDir + "/NPPES.db"
-    dbExists = os.path.exists(dbname)
-    if dbExists:  # --purge and reload
-        msgOut(
-            0, "  Purging existing temp DB for reference data :" + dbname, "I", "", 0, 0
-        )
-        os.remove(dbname)
-    else:
-        msgOut(0, "  Initializing temp DB for reference data:" + dbname, "I", "", 0, 0)
-    conn = sqlite3.connect(dbname)
+    # --only load reference rows for the NPIs that will actually be mapped
+    keepNPIs = None
+    refFraction = parms.sampleRate
+    if npiFilterActive:
+        write_metrics("filtering")
+        keepNPIs, rowsScanned = get_filtered_npis(npiDataFileSpec)
+        refFraction = len(keepNPIs) / rowsScanned if rowsScanned else 1
 
-    # Load up the reference files into the DB and index on NPI
+    # --   open database connection and load from csv
+    loadStartTime = time.time()
+    write_metrics("loading reference data")
+    conn = open_reference_data(sourceDir, filePeriod, refTables, keepNPIs, refFraction)
+    npiPresence = build_npi_presence(conn)
+    count_reference_quarantine(refTables)
+    for refFileSpec, refTabName in refTables:
+        if refTabName in refRowsLoaded:
+            refBytesRead[refTabName] = os.path.getsize(refFileSpec)
+    msgOut(
+        0,
+        "  Reference data loaded in %s seconds" % round(time.time() - loadStartTime, 1),
+        "I",
+        "",
+        0,
+        0,
+    )
 
-    loadDB(onDataFileSpec, "OTHERNAME")
-    loadDB(plDataFileSpec, "PL")
-    loadDB(epDataFileSpec, "ENDPOINT")
     msgOut(
         0,
         "  Beginning Main NPI file processing nesting OtherNames & Locations ",
@@ -1352,12 +3819,58 @@ if __name__ == "__main__":
     )
 
     #  Process main NPI file
-    for NPIinput_row in csv.DictReader(npiInputFile):
+    mappingStartTime = time.time()
+    write_metrics("mapping")
+    profileState = None
+    profileFileSpec = ""
+    if parms.profileFileName:
+        profileFileSpec = period_file_name(parms.profileFileName, filePeriod)
+        profileState = start_profile()
+    for NPIinput_row in read_npi_rows(npiInputFile):
         NPIinput_row_count += 1
+        if NPIinput_row is None:
+            continue
 
-        Providers_outFile.write(map_npi(NPIinput_row) + "\n")
-        JSON_row_count += 1
-        NPIProvider_row_count += 1
+        if (
+            partitionCount > 1
+            and npi_partition(NPIinput_row["NPI"], partitionCount) != partitionIndex
+        ):
+            NPIpartition_row_count += 1
+        elif (keepNPIs is not None and NPIinput_row["NPI"] not in keepNPIs) or (
+            sampleThreshold < 1000000 and not check_npi_sample(NPIinput_row["NPI"])
+        ):
+            NPIfiltered_row_count += 1
+        else:
+            # --the records and stats of an NPI are only kept once all of it maps
+            heldRecords = []
+            heldStats = []
+            rowCounters = (
+                JSON_row_count,
+                NPIProvider_row_count,
+                NPIOfficials_row_count,
+                NPILocations_row_count,
+                NPIAffiliations_row_count,
+            )
+            try:
+                map_npi(NPIinput_row)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                heldRecords = None
+                heldStats = None
+                (
+                    JSON_row_count,
+                    NPIProvider_row_count,
+                    NPIOfficials_row_count,
+                    NPILocations_row_count,
+                    NPIAffiliations_row_count,
+                ) = rowCounters
+                quarantine_npi_row(
+                    "MAPPING-" + type(err).__name__,
+                    *npiRowStart,
+                    "%s: %s" % (type(err).__name__, err),
+                    "".join(npiRowLines),
+                )
+            else:
+                release_held_records()
 
         #  Messages at intervals, or stop processing because of test mode
         if NPIinput_row_count % progressInterval == 0:
@@ -1369,33 +3882,251 @@ if __name__ == "__main__":
                 0,
                 0,
             )
+        if (
+            NPIinput_row_count % 1000 == 0
+            and time.time() - metricsWriteTime >= parms.metricsInterval
+        ):
+            write_metrics("mapping")
+        if profileState and NPIinput_row_count == parms.profileRows:
+            stop_profile(profileState, profileFileSpec, NPIinput_row_count)
+            profileState = None
 
         if shutDown:  # --user abort
             break
+    if profileState:
+        stop_profile(profileState, profileFileSpec, NPIinput_row_count)
+
+    if partitionCount > 1:
+        msgOut(
+            0,
+            "     Main NPI rows in other partitions     : "
+            + str(NPIpartition_row_count),
+            "I",
+            "",
+            0,
+            0,
+        )
+
+    # --------------------------------------------------------------------------------------------
+    # Wrap-up
+    npiInputFile.close()
+    if npiErrFile:
+        npiErrFile.close()
+        msgOut(
+            0,
+            "     %s bad rows quarantined to %s" % (npiQuarantineCount, npiErrFileSpec),
+            "W",
+            "",
+            0,
+            0,
+        )
+    for outFile in (
+        Providers_outFile,
+        Affiliations_outFile,
+        Locations_outFile,
+        Officials_outFile,
+    ):
+        if outFile:
+            flush_records(outFile)
+    if outputOneFile:
+        one_outFile.close()
+    else:
+        for outFile in (
+            Providers_outFile,
+            Affiliations_outFile,
+            Locations_outFile,
+            Officials_outFile,
+        ):
+            if outFile:
+                outFile.close()
+    if exportDbFileSpec:
+        close_export_db()
+        msgOut(0, "     Records exported to " + exportDbFileSpec, "I", "", 0, 0)
+
+    periodCounters = {}
+    periodCounters["NPI_ROWS"] = NPIinput_row_count - NPIpartition_row_count
+    periodCounters["FILTERED_ROWS"] = NPIfiltered_row_count
+    periodCounters["QUARANTINED_ROWS"] = npiQuarantineCount
+    periodCounters["JSON_ROWS"] = JSON_row_count
+    periodCounters["NPI-PROVIDERS"] = NPIProvider_row_count
+    periodCounters["NPI-OFFICIALS"] = NPIOfficials_row_count
+    periodCounters["NPI-LOCATIONS"] = NPILocations_row_count
+    periodCounters["NPI-AFFILIATIONS"] = NPIAffiliations_row_count
+    print_period_totals(periodCounters)
 
+    peakRss = get_peak_rss()
     msgOut(
         0,
-        "     Total Main NPI rows processed         : " + str(NPIinput_row_count),
+        "     Peak memory (RSS)                     : " + format_bytes(peakRss),
         "I",
         "",
         0,
         0,
     )
+    if memoryBudget and peakRss > memoryBudget:
+        msgOut(
+            0,
+            " Peak memory exceeded the memory budget of " + format_bytes(memoryBudget),
+            "W",
+            "",
+            0,
+            0,
+        )
 
-    # --------------------------------------------------------------------------------------------
-    # Wrap-up
-    npiInputFile.close()
+    elapsedMins = round((time.time() - periodStartTime) / 60, 1)
+
+    # --write statistics file, a partition writes its stats and counters for --merge-stats
+    if parms.logFileName:
+        logFileSpec = period_file_name(parms.logFileName, filePeriod)
+        with open(logFileSpec, "w") as outfile:
+            if partitionCount > 1:
+                partitionStats = {}
+                partitionStats["PARTITION"] = partitionIndex
+                partitionStats["PARTITION_COUNT"] = partitionCount
+                partitionStats["FILE_PERIOD"] = filePeriod
+                partitionStats["ELAPSED_MINS"] = elapsedMins
+                partitionStats["ABORTED"] = shutDown
+                partitionStats["COUNTERS"] = periodCounters
+                partitionStats["STATS"] = statPack
+                partitionStats["SKETCHES"] = dump_stat_sketches(statSketches)
+                json.dump(partitionStats, outfile, indent=4, sort_keys=True)
+            else:
+                add_sketch_stats(statPack, statSketches)
+                json.dump(statPack, outfile, indent=4, sort_keys=True)
+        msgOut(0, f"Mapping stats written to {logFileSpec}", "I", "", 0, 0)
+
+    # --write the run manifest, what was read and written with the checksums of the output
+    manifestFileSpec = (
+        os.path.splitext(outputFilePath)[0] + "_manifest.json"
+        if outputOneFile
+        else outputFilePath + "NPI_MANIFEST_" + filePeriod + partitionSuffix + ".json"
+    )
+    runManifest = {}
+    runManifest["FILE_PERIOD"] = filePeriod
+    runManifest["SOURCE_DIR"] = os.path.abspath(sourceDir)
+    if partitionCount > 1:
+        runManifest["PARTITION"] = "%s/%s" % (partitionIndex, partitionCount)
+    runManifest["STARTED"] = datetime.datetime.fromtimestamp(
+        periodStartTime
+    ).isoformat()
+    runManifest["COMPLETED"] = datetime.datetime.now().isoformat()
+    runManifest["ABORTED"] = shutDown
+    runManifest["SETTINGS"] = vars(parms)
+    runManifest["INPUT_FILES"] = {"NPIDATA": get_file_fingerprint(npiDataFileSpec)}
+    for refFileSpec, refTabName in refTables:
+        runManifest["INPUT_FILES"][refTabName] = get_file_fingerprint(refFileSpec)
+    runManifest["OUTPUT_FILES"] = []
+    for dataSource, outFile in (
+        ("NPI-PROVIDERS", Providers_outFile),
+        ("NPI-OFFICIALS", Officials_outFile),
+        ("NPI-LOCATIONS", Locations_outFile),
+        ("NPI-AFFILIATIONS", Affiliations_outFile),
+    ):
+        if outFile and not outputOneFile:
+            runManifest["OUTPUT_FILES"].append(
+                {"data_source": dataSource, **outFile.manifest_entry()}
+            )
     if outputOneFile:
-        one_outFile.close()
+        runManifest["OUTPUT_FILES"].append(one_outFile.manifest_entry())
+    if exportDbFileSpec:
+        runManifest["EXPORT_DB"] = get_file_fingerprint(exportDbFileSpec)
+    runManifest["COUNTERS"] = periodCounters
+    with open(manifestFileSpec, "w") as outfile:
+        json.dump(runManifest, outfile, indent=4)
+    msgOut(0, f"Run manifest written to {manifestFileSpec}", "I", "", 0, 0)
+
+    write_metrics("aborted" if shutDown else "complete")
+
+    if shutDown:
+        msgOut(
+            0,
+            " File period "
+            + filePeriod
+            + " aborted after "
+            + str(elapsedMins)
+            + " minutes!",
+            "I",
+            "",
+            0,
+            0,
+        )
     else:
-        Providers_outFile.close()
-        Affiliations_outFile.close()
-        Locations_outFile.close()
-        Officials_outFile.close()
+        msgOut(
+            0,
+            " File period "
+            + filePeriod
+            + " completed in "
+            + str(elapsedMins)
+            + " minutes!",
+            "I",
+            "",
+            0,
+            0,
+        )
 
+    periodResult = {}
+    periodResult["sourceDir"] = sourceDir
+    periodResult["filePeriod"] = filePeriod
+    periodResult["npiRows"] = periodCounters["NPI_ROWS"]
+    periodResult["jsonRows"] = JSON_row_count
+    periodResult["elapsedMins"] = elapsedMins
+    periodResult["aborted"] = shutDown
+    periodResult["dataSources"] = sorted(activeDataSources)
+    periodResult["outputFiles"] = [
+        x.fileSpec
+        for x in (
+            [one_outFile]
+            if outputOneFile
+            else [
+                Providers_outFile,
+                Officials_outFile,
+                Locations_outFile,
+                Affiliations_outFile,
+            ]
+        )
+        if x
+    ]
+    return periodResult
+
+
+# ---------------------------------------------------------------------
+#   Display the row totals of a file period, or of its merged partitions
+# ---------------------------------------------------------------------
+def print_period_totals(periodCounters):
+
+    msgOut(
+        0,
+        "     Total Main NPI rows processed         : "
+        + str(periodCounters["NPI_ROWS"]),
+        "I",
+        "",
+        0,
+        0,
+    )
+    if periodCounters["FILTERED_ROWS"]:
+        msgOut(
+            0,
+            "     Main NPI rows skipped by filter/sample: "
+            + str(periodCounters["FILTERED_ROWS"]),
+            "I",
+            "",
+            0,
+            0,
+        )
+    if periodCounters.get("QUARANTINED_ROWS"):
+        msgOut(
+            0,
+            "     Main NPI rows quarantined             : "
+            + str(periodCounters["QUARANTINED_ROWS"]),
+            "I",
+            "",
+            0,
+            0,
+        )
     msgOut(
         0,
-        "     Total JSON rows produced              : " + str(JSON_row_count),
+        "     Total JSON rows produced              : "
+        + str(periodCounters["JSON_ROWS"]),
         "I",
         "",
         0,
@@ -1403,7 +4134,8 @@ if __name__ == "__main__":
     )
     msgOut(
         0,
-        "     NPI-Provider JSON rows produced       : " + str(NPIProvider_row_count),
+        "     NPI-Provider JSON rows produced       : "
+        + str(periodCounters["NPI-PROVIDERS"]),
         "I",
         "",
         0,
@@ -1411,7 +4143,8 @@ if __name__ == "__main__":
     )
     msgOut(
         0,
-        "     NPI-Officials JSON rows produced      : " + str(NPIOfficials_row_count),
+        "     NPI-Officials JSON rows produced      : "
+        + str(periodCounters["NPI-OFFICIALS"]),
         "I",
         "",
         0,
@@ -1419,7 +4152,8 @@ if __name__ == "__main__":
     )
     msgOut(
         0,
-        "     NPI-Locations JSON rows produced      : " + str(NPILocations_row_count),
+        "     NPI-Locations JSON rows produced      : "
+        + str(periodCounters["NPI-LOCATIONS"]),
         "I",
         "",
         0,
@@ -1428,21 +4162,1657 @@ if __name__ == "__main__":
     msgOut(
         0,
         "     NPI-Affiliations JSON rows produced   : "
-        + str(NPIAffiliations_row_count),
+        + str(periodCounters["NPI-AFFILIATIONS"]),
         "I",
         "",
         0,
         0,
     )
 
-    # --write statistics file
-    if parms.logFileName:
-        with open(parms.logFileName, "w") as outfile:
-            json.dump(statPack, outfile, indent=4, sort_keys=True)
-        msgOut(0, f"Mapping stats written to {parms.logFileName}", "I", "", 0, 0)
 
-    elapsedMins = round((time.time() - procStartTime) / 60, 1)
-    if shutDown:
+# ---------------------------------------------------------------------
+#   Merge one statPack into another, counts are added and the first 5 distinct examples are kept
+# ---------------------------------------------------------------------
+def merge_stat_pack(intoStatPack, fromStatPack):
+
+    for cat1 in fromStatPack:
+        if cat1 not in intoStatPack:
+            intoStatPack[cat1] = {}
+        for cat2 in fromStatPack[cat1]:
+            if cat2 not in intoStatPack[cat1]:
+                intoStatPack[cat1][cat2] = {}
+                intoStatPack[cat1][cat2]["count"] = 0
+            intoStatPack[cat1][cat2]["count"] += fromStatPack[cat1][cat2]["count"]
+            for example in fromStatPack[cat1][cat2].get("examples", []):
+                if "examples" not in intoStatPack[cat1][cat2]:
+                    intoStatPack[cat1][cat2]["examples"] = []
+                if (
+                    example not in intoStatPack[cat1][cat2]["examples"]
+                    and len(intoStatPack[cat1][cat2]["examples"]) < 5
+                ):
+                    intoStatPack[cat1][cat2]["examples"].append(example)
+
+
+# ---------------------------------------------------------------------
+#   Merge the partition stats files of a file period into the stats file of a single node run
+#      returns 1 if any partition is missing or was aborted
+# ---------------------------------------------------------------------
+def merge_period_stats(filePeriod):
+
+    logFileSpec = period_file_name(parms.logFileName, filePeriod)
+    fileRoot, fileExt = os.path.splitext(logFileSpec)
+    partitionFileSpecs = sorted(glob.glob(glob.escape(fileRoot) + "_p*of*" + fileExt))
+    msgOut(
+        0,
+        "  - Merging %s partition stats files for file period %s"
+        % (len(partitionFileSpecs), filePeriod),
+        "I",
+        "",
+        0,
+        0,
+    )
+
+    mergeErrors = 0
+    mergedStats = {}
+    mergedSketches = {}
+    mergedCounters = {}
+    partitionsMerged = set()
+    partitionCounts = set()
+    for partitionFileSpec in partitionFileSpecs:
+        with open(partitionFileSpec, "r") as infile:
+            partitionStats = json.load(infile)
+        if "PARTITION" not in partitionStats:
+            msgOut(
+                0, partitionFileSpec + " is not a partition stats file", "W", "", 0, 0
+            )
+            continue
+        if partitionStats["ABORTED"]:
+            mergeErrors = 1
+            msgOut(0, partitionFileSpec + " is from an aborted run", "W", "", 0, 0)
+        partitionsMerged.add(partitionStats["PARTITION"])
+        partitionCounts.add(partitionStats["PARTITION_COUNT"])
+        merge_stat_pack(mergedStats, partitionStats["STATS"])
+        merge_stat_sketches(mergedSketches, partitionStats.get("SKETCHES", []))
+        for counterName, counterValue in partitionStats["COUNTERS"].items():
+            mergedCounters[counterName] = (
+                mergedCounters.get(counterName, 0) + counterValue
+            )
+        msgOut(0, "        Merged " + partitionFileSpec, "I", "", 0, 0)
+
+    if len(partitionCounts) != 1:
+        msgOut(
+            0,
+            " No partition stats files or more than one partition count for file period "
+            + filePeriod,
+            "E",
+            "",
+            0,
+            0,
+        )
+        return 1
+    mergedPartitionCount = partitionCounts.pop()
+    missingPartitions = sorted(
+        set(range(1, mergedPartitionCount + 1)) - partitionsMerged
+    )
+    if missingPartitions:
+        mergeErrors = 1
+        msgOut(
+            0,
+            " Partitions %s of %s are missing for file period %s"
+            % (
+                ",".join(str(x) for x in missingPartitions),
+                mergedPartitionCount,
+                filePeriod,
+            ),
+            "W",
+            "",
+            0,
+            0,
+        )
+
+    # --JSON_row_count starts at 1 in each partition
+    mergedCounters["JSON_ROWS"] -= len(partitionsMerged) - 1
+    print_period_totals(mergedCounters)
+    add_sketch_stats(mergedStats, mergedSketches)
+    with open(logFileSpec, "w") as outfile:
+        json.dump(mergedStats, outfile, indent=4, sort_keys=True)
+    msgOut(0, f"Mapping stats written to {logFileSpec}", "I", "", 0, 0)
+    return mergeErrors
+
+
+# ---------------------------------------------------------------------
+#   Open the --history-db, the append only store of the mapped records of each file period
+#      a record only gets a new version when it is new, changed or gone since the last period appended,
+#      a gone record's version has no RECORD_DATA.  RECORD_CURRENT has the hash of each record's latest version
+# ---------------------------------------------------------------------
+def open_history_db(historyDbFileSpec):
+
+    historyConn = sqlite3.connect(historyDbFileSpec)
+    sql = "create table if not exists HISTORY_PERIOD ("
+    sql += " PERIOD_SEQ integer primary key,"
+    sql += " FILE_PERIOD text unique,"
+    sql += " SOURCE_DIR text,"
+    sql += " DATA_SOURCES text,"
+    sql += " ADDED integer,"
+    sql += " CHANGED integer,"
+    sql += " DELETED integer,"
+    sql += " UNCHANGED integer,"
+    sql += " APPENDED text)"
+    historyConn.execute(sql)
+    sql = "create table if not exists RECORD_VERSION ("
+    sql += " DATA_SOURCE text,"
+    sql += " RECORD_ID text,"
+    sql += " NPI text,"
+    sql += " PERIOD_SEQ integer,"
+    sql += " RECORD_HASH text,"
+    sql += " RECORD_DATA blob)"
+    historyConn.execute(sql)
+    historyConn.execute(
+        "create index if not exists RECORD_VERSION_KEY on RECORD_VERSION (DATA_SOURCE, RECORD_ID, PERIOD_SEQ)"
+    )
+    historyConn.execute(
+        "create index if not exists RECORD_VERSION_NPI on RECORD_VERSION (NPI)"
+    )
+    sql = "create table if not exists RECORD_CURRENT ("
+    sql += " DATA_SOURCE text,"
+    sql += " RECORD_ID text,"
+    sql += " NPI text,"
+    sql += " RECORD_HASH text,"
+    sql += " primary key (DATA_SOURCE, RECORD_ID)) without rowid"
+    historyConn.execute(sql)
+    historyConn.commit()
+    return historyConn
+
+
+# ---------------------------------------------------------------------
+#   Read the records of a file period's output files for the --history-db
+#      the hash is of the record with its attributes sorted, the record itself is kept compressed as written
+# ---------------------------------------------------------------------
+def read_history_records(outputFileSpecs):
+
+    for outputFileSpec in outputFileSpecs:
+        with open(outputFileSpec, "rb") as inFile:
+            for recordLine in inFile:
+                recordData = json.loads(recordLine)
+                yield (
+                    recordData["DATA_SOURCE"],
+                    recordData["RECORD_ID"],
+                    recordData["RECORD_ID"].split("-")[0],
+                    hashlib.sha1(
+                        json.dumps(recordData, sort_keys=True).encode("utf-8")
+                    ).hexdigest(),
+                    zlib.compress(recordLine.rstrip(b"\n")),
+                )
+
+
+# ---------------------------------------------------------------------
+#   Append the records of a mapped file period to the --history-db, only those that changed are added
+#      periods must be appended in order, returns 1 if the period is already in it or is older than the last one
+# ---------------------------------------------------------------------
+def append_history_period(historyConn, periodResult):
+
+    filePeriod = periodResult["filePeriod"]
+    if historyConn.execute(
+        "select 1 from HISTORY_PERIOD where FILE_PERIOD = ?", (filePeriod,)
+    ).fetchone():
+        msgOut(
+            0,
+            " File period %s is already in the history db" % filePeriod,
+            "W",
+            "",
+            0,
+            0,
+        )
+        return 1
+    lastPeriod = historyConn.execute(
+        "select FILE_PERIOD from HISTORY_PERIOD order by PERIOD_SEQ desc limit 1"
+    ).fetchone()
+    if lastPeriod and filePeriod[-8:] < lastPeriod[0][-8:]:
+        msgOut(
+            0,
+            " File period %s is older than %s, the last period in the history db"
+            % (filePeriod, lastPeriod[0]),
+            "W",
+            "",
+            0,
+            0,
+        )
+        return 1
+
+    appendStartTime = time.time()
+    dataSources = periodResult["dataSources"]
+    sourceMarks = ", ".join("?" * len(dataSources))
+    sql = "create temp table if not exists RECORD_STAGE ("
+    sql += " DATA_SOURCE text,"
+    sql += " RECORD_ID text,"
+    sql += " NPI text,"
+    sql += " RECORD_HASH text,"
+    sql += " RECORD_DATA blob,"
+    sql += " primary key (DATA_SOURCE, RECORD_ID))"
+    historyConn.execute(sql)
+    historyConn.execute("delete from RECORD_STAGE")
+    with historyConn:
+        historyConn.executemany(
+            "insert or replace into RECORD_STAGE values (?, ?, ?, ?, ?)",
+            read_history_records(periodResult["outputFiles"]),
+        )
+        periodSeq = historyConn.execute(
+            "insert into HISTORY_PERIOD (FILE_PERIOD, SOURCE_DIR, DATA_SOURCES, APPENDED) values (?, ?, ?, ?)",
+            (
+                filePeriod,
+                os.path.abspath(periodResult["sourceDir"]),
+                ",".join(dataSources),
+                datetime.datetime.now().isoformat(),
+            ),
+        ).lastrowid
+        stagedCount = historyConn.execute(
+            "select count(*) from RECORD_STAGE"
+        ).fetchone()[0]
+
+        sql = "insert into RECORD_VERSION"
+        sql += (
+            " select s.DATA_SOURCE, s.RECORD_ID, s.NPI, ?, s.RECORD_HASH, s.RECORD_DATA"
+        )
+        sql += " from RECORD_STAGE s left join RECORD_CURRENT c"
+        sql += " on c.DATA_SOURCE = s.DATA_SOURCE and c.RECORD_ID = s.RECORD_ID"
+        addedCount = historyConn.execute(
+            sql + " where c.RECORD_ID is null", (periodSeq,)
+        ).rowcount
+        changedCount = historyConn.execute(
+            sql + " where c.RECORD_HASH != s.RECORD_HASH", (periodSeq,)
+        ).rowcount
+
+        # --records of the data sources mapped that are not in the period anymore
+        sql = "insert into RECORD_VERSION"
+        sql += " select c.DATA_SOURCE, c.RECORD_ID, c.NPI, ?, null, null"
+        sql += " from RECORD_CURRENT c where c.DATA_SOURCE in (%s)" % sourceMarks
+        sql += " and not exists (select 1 from RECORD_STAGE s"
+        sql += "  where s.DATA_SOURCE = c.DATA_SOURCE and s.RECORD_ID = c.RECORD_ID)"
+        deletedCount = historyConn.execute(sql, [periodSeq] + dataSources).rowcount
+
+        sql = "delete from RECORD_CURRENT where DATA_SOURCE in (%s)" % sourceMarks
+        sql += " and not exists (select 1 from RECORD_STAGE s"
+        sql += "  where s.DATA_SOURCE = RECORD_CURRENT.DATA_SOURCE and s.RECORD_ID = RECORD_CURRENT.RECORD_ID)"
+        historyConn.execute(sql, dataSources)
+        sql = "insert or replace into RECORD_CURRENT"
+        sql += " select s.DATA_SOURCE, s.RECORD_ID, s.NPI, s.RECORD_HASH from RECORD_STAGE s"
+        sql += " where not exists (select 1 from RECORD_CURRENT c"
+        sql += "  where c.DATA_SOURCE = s.DATA_SOURCE and c.RECORD_ID = s.RECORD_ID"
+        sql += "  and c.RECORD_HASH = s.RECORD_HASH)"
+        historyConn.execute(sql)
+
+        historyConn.execute(
+            "update HISTORY_PERIOD set ADDED = ?, CHANGED = ?, DELETED = ?, UNCHANGED = ? where PERIOD_SEQ = ?",
+            (
+                addedCount,
+                changedCount,
+                deletedCount,
+                stagedCount - addedCount - changedCount,
+                periodSeq,
+            ),
+        )
+        historyConn.execute("delete from RECORD_STAGE")
+    msgOut(
+        0,
+        "  File period %s appended to the history db in %s seconds, %s added, %s changed, %s deleted, %s unchanged"
+        % (
+            filePeriod,
+            round(time.time() - appendStartTime, 1),
+            addedCount,
+            changedCount,
+            deletedCount,
+            stagedCount - addedCount - changedCount,
+        ),
+        "I",
+        "",
+        0,
+        0,
+    )
+    return 0
+
+
+# ---------------------------------------------------------------------
+#   The file periods in the --history-db that match the -f parameter, in the order they were appended
+# ---------------------------------------------------------------------
+def get_history_periods(historyConn, inFilePeriods):
+
+    periodPatterns = [x.strip() for x in inFilePeriods.split(",") if x.strip()]
+    return [
+        x
+        for x, in historyConn.execute(
+            "select FILE_PERIOD from HISTORY_PERIOD order by PERIOD_SEQ"
+        )
+        if any(fnmatch.fnmatchcase(x, y) for y in periodPatterns)
+    ]
+
+
+# ---------------------------------------------------------------------
+#   Regenerate the output files of a file period from the --history-db with the latest version
+#   of each record as of that period.  Only the data sources the period was mapped with are written
+# ---------------------------------------------------------------------
+def regenerate_history_period(historyConn, filePeriod):
+
+    periodSeq, periodSources = historyConn.execute(
+        "select PERIOD_SEQ, DATA_SOURCES from HISTORY_PERIOD where FILE_PERIOD = ?",
+        (filePeriod,),
+    ).fetchone()
+    msgOut(0, "  - Regenerating file period " + filePeriod, "I", "", 0, 0)
+
+    sql = "select v.RECORD_DATA from RECORD_VERSION v"
+    sql += " where v.DATA_SOURCE = ? and v.RECORD_DATA is not null"
+    sql += " and v.PERIOD_SEQ = (select max(w.PERIOD_SEQ) from RECORD_VERSION w"
+    sql += "  where w.DATA_SOURCE = v.DATA_SOURCE and w.RECORD_ID = v.RECORD_ID"
+    sql += "  and w.PERIOD_SEQ <= ?)"
+    sql += " order by v.NPI, v.RECORD_ID"
+
+    outputFilePath = os.path.abspath(parms.outputFilePath)
+    one_outFile = None
+    if not os.path.isdir(outputFilePath):
+        one_outFile = ChecksumFile(period_file_name(outputFilePath, filePeriod))
+    for dataSource in dataSourceNames:
+        if (
+            dataSource not in periodSources.split(",")
+            or dataSource not in activeDataSources
+        ):
+            continue
+        outFile = one_outFile or ChecksumFile(
+            os.path.join(
+                outputFilePath,
+                dataSource.replace("-", "_") + "_" + filePeriod + ".json",
+            )
+        )
+        recordCount = 0
+        for (recordData,) in historyConn.execute(sql, (dataSource, periodSeq)):
+            outFile.write(encode_record(json.loads(zlib.decompress(recordData))) + "\n")
+            recordCount += 1
+        msgOut(
+            0,
+            "     %s %s records written to %s"
+            % (recordCount, dataSource, outFile.fileSpec),
+            "I",
+            "",
+            0,
+            0,
+        )
+        if not one_outFile:
+            outFile.close()
+    if one_outFile:
+        one_outFile.close()
+
+
+# ---------------------------------------------------------------------
+#   Write the history of NPIs from the --history-db, each version of their records as a json line
+#      with the file period it appeared in and whether the record was ADDED, CHANGED or DELETED then
+# ---------------------------------------------------------------------
+def write_npi_history(historyConn, npiList, outFile):
+
+    sql = "select h.FILE_PERIOD, v.DATA_SOURCE, v.RECORD_ID, v.RECORD_DATA"
+    sql += " from RECORD_VERSION v join HISTORY_PERIOD h on h.PERIOD_SEQ = v.PERIOD_SEQ"
+    sql += " where v.NPI = ?"
+    sql += " order by v.PERIOD_SEQ, v.DATA_SOURCE, v.RECORD_ID"
+
+    missingCount = 0
+    for inNPI in npiList:
+        recordStates = {}
+        versionCount = 0
+        for filePeriod, dataSource, recordId, recordData in historyConn.execute(
+            sql, (inNPI,)
+        ):
+            npiVersion = {}
+            npiVersion["NPI"] = inNPI
+            npiVersion["FILE_PERIOD"] = filePeriod
+            npiVersion["DATA_SOURCE"] = dataSource
+            npiVersion["RECORD_ID"] = recordId
+            if recordData is None:
+                npiVersion["CHANGE"] = "DELETED"
+            elif recordStates.get((dataSource, recordId)):
+                npiVersion["CHANGE"] = "CHANGED"
+            else:
+                npiVersion["CHANGE"] = "ADDED"
+            if recordData is not None:
+                npiVersion["RECORD"] = json.loads(zlib.decompress(recordData))
+            recordStates[(dataSource, recordId)] = recordData is not None
+            outFile.write(jsonEncoder.encode(npiVersion) + "\n")
+            versionCount += 1
+        if not versionCount:
+            missingCount += 1
+            msgOut(0, " NPI %s is not in the history db" % inNPI, "W", "", 0, 0)
+    return missingCount
+
+
+# ---------------------------------------------------------------------
+#   Index the byte offset of each row of the main NPI file by NPI for --serve
+#      returns the header and sorted arrays of NPIs and offsets, or None if the file is not in NPI order
+#      a line only starts a row when the quotes before it are balanced, a quoted field can hold a newline
+# ---------------------------------------------------------------------
+def build_npi_index(npiDataFileSpec):
+
+    npiKeys = array.array("Q")
+    npiOffsets = array.array("Q")
+    with open(npiDataFileSpec, "rb") as inFile:
+        headerLine = inFile.readline()
+        fieldNames = next(csv.reader([headerLine.decode("utf-8")]))
+        lineOffset = len(headerLine)
+        rowQuotes = 0
+        for line in inFile:
+            if rowQuotes % 2 == 0:
+                rowQuotes = 0
+                if line[:1] == b'"':
+                    lineNPI = int(line[1 : line.find(b'"', 1)])
+                else:
+                    lineNPI = int(line[: line.find(b",")])
+                if npiKeys and lineNPI <= npiKeys[-1]:
+                    return None
+                npiKeys.append(lineNPI)
+                npiOffsets.append(lineOffset)
+            rowQuotes += line.count(b'"')
+            lineOffset += len(line)
+    return fieldNames, npiKeys, npiOffsets
+
+
+# ---------------------------------------------------------------------
+#   Load the reference data and main NPI file index of a file period for --serve
+#      runs in the background on a reload, requests are served from the current store until the new one is swapped in
+# ---------------------------------------------------------------------
+def load_serve_store(sourceDir, filePeriod):
+
+    global serveStore
+    global serveLoading
+
+    newStore = {}
+    try:
+        loadStartTime = time.time()
+        msgOut(0, "  - Loading file period " + filePeriod + " to serve", "I", "", 0, 0)
+        fileSpecs = {}
+        for fileType in ("npidata", "othername", "pl", "endpoint"):
+            if fileType != "npidata" and not activeDataSources.intersection(
+                referenceTableDataSources[fileType.upper()]
+            ):
+                continue
+            fileSpecs[fileType] = os.path.abspath(
+                sourceDir + fileType + "_pfile_" + filePeriod + ".csv"
+            )
+            if not os.path.isfile(fileSpecs[fileType]):
+                msgOut(0, fileSpecs[fileType] + " does not exist", "E", "", 0, 0)
+                return
+            if parms.sortInputs:
+                fileSpecs[fileType] = get_sorted_file(
+                    fileSpecs[fileType],
+                    parms.sortDir or os.path.join(sourceDir, "sorted"),
+                    sortMemory,
+                )
+        if check_period_columns(sourceDir, filePeriod):
+            return
+
+        newStore["sourceDir"] = sourceDir
+        newStore["filePeriod"] = filePeriod
+        newStore["users"] = 0
+        newStore["retired"] = False
+        newStore["conn"] = open_reference_data(
+            sourceDir,
+            filePeriod,
+            [
+                (fileSpecs[x.lower()], x)
+                for x in ("OTHERNAME", "PL", "ENDPOINT")
+                if x.lower() in fileSpecs
+            ],
+            None,
+            1,
+        )
+        newStore["npiPresence"] = build_npi_presence(newStore["conn"])
+        npiIndex = build_npi_index(fileSpecs["npidata"])
+        if not npiIndex:
+            msgOut(
+                0,
+                fileSpecs["npidata"] + " is not in NPI order, use --sort",
+                "E",
+                "",
+                0,
+                0,
+            )
+            return
+        newStore["fieldNames"], newStore["npiKeys"], newStore["npiOffsets"] = npiIndex
+        newStore["npiFile"] = open(fileSpecs["npidata"], "rb")
+        newStore["loaded"] = datetime.datetime.now().isoformat(timespec="seconds")
+        with serveStoreLock:
+            oldStore = serveStore
+            serveStore = newStore
+            if oldStore:
+                oldStore["retired"] = True
+        if oldStore and not oldStore["users"]:
+            close_serve_store(oldStore)
+        msgOut(
+            0,
+            "  File period %s with %s NPIs loaded in %s seconds"
+            % (filePeriod, len(npiIndex[1]), round(time.time() - loadStartTime, 1)),
+            "I",
+            "",
+            0,
+            0,
+        )
+    except (OSError, ValueError, sqlite3.Error) as err:
+        msgOut(
+            0,
+            "Loading file period " + filePeriod + " failed: " + str(err),
+            "E",
+            "",
+            0,
+            0,
+        )
+    finally:
+        if newStore is not serveStore:
+            close_serve_store(newStore)
+        serveLoading = False
+
+
+# ---------------------------------------------------------------------
+#   Count a request as using the served store, and close a replaced store once its last request is done
+# ---------------------------------------------------------------------
+def acquire_serve_store():
+
+    with serveStoreLock:
+        serveStore["users"] += 1
+        return serveStore
+
+
+def release_serve_store(store):
+
+    with serveStoreLock:
+        store["users"] -= 1
+        closeStore = store["retired"] and not store["users"]
+    if closeStore:
+        close_serve_store(store)
+
+
+def close_serve_store(store):
+
+    if store.get("conn"):
+        store["conn"].close()
+    if store.get("npiFile"):
+        store["npiFile"].close()
+    msgOut(
+        0,
+        "  File period %s closed" % store.get("filePeriod"),
+        "I",
+        "",
+        0,
+        0,
+    )
+
+
+# ---------------------------------------------------------------------
+#   Map a list of NPIs from the served store, returns the json response with the records of each data source
+# ---------------------------------------------------------------------
+def map_served_npis(npiList):
+
+    store = acquire_serve_store()
+    try:
+        with serveMapLock:
+            return map_store_npis(store, npiList)
+    finally:
+        release_serve_store(store)
+
+
+def map_store_npis(store, npiList):
+
+    global conn
+    global npiPresence
+    global statPack
+    global statSketches
+    global Providers_outFile
+    global Officials_outFile
+    global Affiliations_outFile
+    global Locations_outFile
+    global JSON_row_count
+    global NPIProvider_row_count
+    global NPIOfficials_row_count
+    global NPILocations_row_count
+    global NPIAffiliations_row_count
+    global referenceLookupSeconds
+    global heldRecords
+    global heldStats
+
+    conn = store["conn"]
+    npiPresence = store["npiPresence"]
+    statPack = {}
+    statSketches = {}
+    JSON_row_count = 0
+    NPIProvider_row_count = 0
+    NPIOfficials_row_count = 0
+    NPILocations_row_count = 0
+    NPIAffiliations_row_count = 0
+    referenceLookupSeconds = 0.0
+    outputBuffers = {}
+    for dataSource in dataSourceNames:
+        outputBuffers[dataSource] = io.StringIO()
+    Providers_outFile = outputBuffers["NPI-PROVIDERS"]
+    Officials_outFile = outputBuffers["NPI-OFFICIALS"]
+    Locations_outFile = outputBuffers["NPI-LOCATIONS"]
+    Affiliations_outFile = outputBuffers["NPI-AFFILIATIONS"]
+
+    notFound = []
+    npiErrors = []
+    for inNPI in npiList:
+        npiKey = int(inNPI) if inNPI.isdigit() else -1
+        keyIndex = bisect.bisect_left(store["npiKeys"], npiKey)
+        if keyIndex == len(store["npiKeys"]) or store["npiKeys"][keyIndex] != npiKey:
+            notFound.append(inNPI)
+            continue
+
+        # --an NPI whose row cannot be read or mapped is listed with the kind of error it would be quarantined for
+        npiError = None
+        store["npiFile"].seek(store["npiOffsets"][keyIndex])
+        try:
+            rowValues = next(
+                csv.reader(x.decode("utf-8") for x in store["npiFile"]), []
+            )
+        except UnicodeDecodeError as err:
+            npiError = ("ENCODING", str(err))
+        except csv.Error as err:
+            npiError = ("CSV", str(err))
+        else:
+            if len(rowValues) != len(store["fieldNames"]):
+                npiError = (
+                    "FIELD-COUNT",
+                    "expected %s fields, saw %s"
+                    % (len(store["fieldNames"]), len(rowValues)),
+                )
+        if not npiError:
+            heldRecords = []
+            heldStats = []
+            try:
+                map_npi(dict(zip(store["fieldNames"], rowValues)))
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                heldRecords = None
+                heldStats = None
+                npiError = (
+                    "MAPPING-" + type(err).__name__,
+                    "%s: %s" % (type(err).__name__, err),
+                )
+            else:
+                release_held_records()
+        if npiError:
+            npiErrors.append({"NPI": inNPI, "KIND": npiError[0], "ERROR": npiError[1]})
+    for outFile in outputBuffers.values():
+        flush_records(outFile)
+
+    responseParts = [
+        '"FILE_PERIOD":' + json.dumps(store["filePeriod"]),
+        '"NOT_FOUND":' + jsonEncoder.encode(notFound),
+        '"ERRORS":' + jsonEncoder.encode(npiErrors),
+    ]
+    for dataSource in dataSourceNames:
+        responseParts.append(
+            json.dumps(dataSource)
+            + ":["
+            + ",".join(outputBuffers[dataSource].getvalue().splitlines())
+            + "]"
+        )
+    return "{" + ",".join(responseParts) + "}"
+
+
+# ---------------------------------------------------------------------
+#   Requests for --serve
+#      GET  /npi/<npi>[,<npi>...]  the mapped records of up to 1000 NPIs
+#      GET  /status                the file period being served
+#      POST /reload[?period=<file period>]  load a file period in the background and swap it in when ready,
+#                                           by default the last file period -i and -f now match
+# ---------------------------------------------------------------------
+class ServeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Maps the NPIs requested from the served file period"""
+
+    def send_json(self, statusCode, responseText):
+        responseBytes = responseText.encode("utf-8")
+        self.send_response(statusCode)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(responseBytes)))
+        self.end_headers()
+        self.wfile.write(responseBytes)
+
+    def do_GET(self):
+        requestUrl = urllib.parse.urlparse(self.path)
+        if requestUrl.path.startswith("/npi/"):
+            npiList = [x for x in requestUrl.path[5:].split(",") if x]
+            if not npiList or len(npiList) > 1000:
+                self.send_json(400, json.dumps({"ERROR": "give 1 to 1000 NPIs"}))
+            else:
+                try:
+                    self.send_json(200, map_served_npis(npiList))
+                except Exception as err:  # pylint: disable=broad-exception-caught
+                    self.send_json(
+                        500, json.dumps({"ERROR": "%s: %s" % (type(err).__name__, err)})
+                    )
+        elif requestUrl.path == "/status":
+            serveStatus = {}
+            serveStatus["SOURCE_DIR"] = serveStore["sourceDir"]
+            serveStatus["FILE_PERIOD"] = serveStore["filePeriod"]
+            serveStatus["NPI_COUNT"] = len(serveStore["npiKeys"])
+            serveStatus["LOADED"] = serveStore["loaded"]
+            serveStatus["RELOADING"] = serveLoading
+            self.send_json(200, json.dumps(serveStatus))
+        else:
+            self.send_json(404, json.dumps({"ERROR": "not found"}))
+
+    def do_POST(self):
+        global serveLoading
+
+        requestUrl = urllib.parse.urlparse(self.path)
+        if requestUrl.path != "/reload":
+            self.send_json(404, json.dumps({"ERROR": "not found"}))
+            return
+        if serveLoading:
+            self.send_json(409, json.dumps({"ERROR": "a reload is already running"}))
+            return
+        requestParms = urllib.parse.parse_qs(requestUrl.query)
+        periodList = get_period_list(
+            parms.sourceDir, requestParms.get("period", [parms.filePeriod])[0]
+        )
+        if not periodList:
+            self.send_json(400, json.dumps({"ERROR": "no file period found"}))
+            return
+        serveLoading = True
+        threading.Thread(
+            target=load_serve_store, args=periodList[-1], daemon=True
+        ).start()
+        self.send_json(202, json.dumps({"RELOADING": periodList[-1][1]}))
+
+    def log_message(self, format, *args):
+        msgOut(0, " " + self.address_string() + " " + format % args, "I", "", 0, 0)
+
+
+# ---------------------------------------------------------------------
+#   Count the lines in a file through a memory map, about as fast as the file can be read
+#      these are lines, not csv rows, a row with a newline in a quoted field is counted once per line
+# ---------------------------------------------------------------------
+def count_lines(inFileSpec):
+
+    lineCount = 0
+    if os.path.getsize(inFileSpec):
+        with open(inFileSpec, "rb") as inFile:
+            with mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ) as mappedFile:
+                blockSize = 16 * 1024 * 1024
+                for blockStart in range(0, len(mappedFile), blockSize):
+                    lineCount += mappedFile[blockStart : blockStart + blockSize].count(
+                        b"\n"
+                    )
+    return lineCount
+
+
+# ---------------------------------------------------------------------
+#   Copy the header and the rows for sampled NPIs of a NPPES csv file to a new file
+#      the NPI is taken from the start of each line so the other rows are never parsed
+# ---------------------------------------------------------------------
+def extract_sample_rows(inFileSpec, outFileSpec, estThreshold):
+
+    sampleNPIs = {}
+    with open(inFileSpec, "rb") as inFile, open(outFileSpec, "wb") as outFile:
+        outFile.write(inFile.readline())
+        for line in inFile:
+            if line[:1] == b'"':
+                lineNPI = line[1 : line.find(b'"', 1)]
+            else:
+                lineNPI = line[: line.find(b",")]
+            if zlib.crc32(lineNPI) % 1000000 < estThreshold:
+                outFile.write(line)
+                lineNPI = lineNPI.decode("latin-1")
+                sampleNPIs[lineNPI] = sampleNPIs.get(lineNPI, 0) + 1
+    return sampleNPIs
+
+
+# ---------------------------------------------------------------------
+#   Profile the input files of a file period and estimate the cost of mapping them
+#      the rows of a hash sample of NPIs are loaded and mapped to calibrate the estimate
+# ---------------------------------------------------------------------
+def estimate_period(sourceDir, filePeriod):
+
+    global statPack
+    global statSketches
+    global conn
+    global npiPresence
+    global Providers_outFile
+    global Officials_outFile
+    global Affiliations_outFile
+    global Locations_outFile
+    global NPIProvider_row_count
+    global NPIOfficials_row_count
+    global NPILocations_row_count
+    global NPIAffiliations_row_count
+    global JSON_row_count
+    global referenceLookupSeconds
+    global npiErrFile
+    global npiErrFileSpec
+    global npiQuarantineCount
+    global npiQuarantinedLines
+    global npiLinesRead
+    global npiBytesRead
+    global npiRowLines
+
+    msgOut(0, "  - Estimating file period " + filePeriod, "I", "", 0, 0)
+    fileTypes = {
+        "npidata": "NPIDATA",
+        "othername": "OTHERNAME",
+        "pl": "PL",
+        "endpoint": "ENDPOINT",
+    }
+    fileSpecs = {}
+    for fileType, tabName in fileTypes.items():
+        fileSpecs[tabName] = os.path.abspath(
+            sourceDir + fileType + "_pfile_" + filePeriod + ".csv"
+        )
+        if not os.path.isfile(fileSpecs[tabName]):
+            msgOut(0, fileSpecs[tabName] + " does not exist", "E", "", 2, 0)
+            return None
+
+    periodEstimate = {"files": {}}
+    scanStartTime = time.time()
+    for tabName, fileSpec in fileSpecs.items():
+        periodEstimate["files"][tabName] = {
+            "bytes": os.path.getsize(fileSpec),
+            "rows": max(0, count_lines(fileSpec) - 1),
+        }
+    scanSeconds = time.time() - scanStartTime
+    npiRows = periodEstimate["files"]["NPIDATA"]["rows"]
+
+    # --the estimate sample is nested inside any --sample-rate sample as they use the same hash
+    estThreshold = int(1000000 * parms.estimateNPIs / npiRows) if npiRows else 1000000
+    estThreshold = max(1, min(sampleThreshold, estThreshold))
+    runFraction = sampleThreshold / 1000000
+
+    statPack = {}
+    statSketches = {}
+    conn = sqlite3.connect(":memory:")
+    with tempfile.TemporaryDirectory() as sampleDir:
+        sampleFileSpecs = {}
+        sampleNPIs = {}
+        for tabName, fileSpec in fileSpecs.items():
+            sampleFileSpecs[tabName] = os.path.join(sampleDir, tabName + ".csv")
+            sampleNPIs[tabName] = extract_sample_rows(
+                fileSpec, sampleFileSpecs[tabName], estThreshold
+            )
+
+        # --load the sampled reference rows, the slowest one sets the load time as they load in parallel
+        loadBytesPerSecond = None
+        for tabName in ("OTHERNAME", "PL", "ENDPOINT"):
+            loadStartTime = time.time()
+            loadDB(sampleFileSpecs[tabName], tabName, conn, None, 1000000, 250000)
+            loadSeconds = time.time() - loadStartTime
+            sampleBytes = os.path.getsize(sampleFileSpecs[tabName])
+            if sampleBytes and loadSeconds:
+                loadBytesPerSecond = min(
+                    loadBytesPerSecond or sampleBytes / loadSeconds,
+                    sampleBytes / loadSeconds,
+                )
+        npiPresence = build_npi_presence(conn)
+
+        # --parse and map the sampled main rows
+        outputBuffers = {}
+        for dataSource in dataSourceNames:
+            outputBuffers[dataSource] = io.StringIO()
+        Providers_outFile = outputBuffers["NPI-PROVIDERS"]
+        Officials_outFile = outputBuffers["NPI-OFFICIALS"]
+        Locations_outFile = outputBuffers["NPI-LOCATIONS"]
+        Affiliations_outFile = outputBuffers["NPI-AFFILIATIONS"]
+        NPIProvider_row_count = 0
+        NPIOfficials_row_count = 0
+        NPILocations_row_count = 0
+        NPIAffiliations_row_count = 0
+        JSON_row_count = 0
+        referenceLookupSeconds = 0.0
+
+        # --bad sampled rows are quarantined to a file of their own that is discarded with the sample
+        npiErrFile = None
+        npiErrFileSpec = sampleFileSpecs["NPIDATA"] + ".err"
+        npiQuarantineCount = 0
+        npiQuarantinedLines = set()
+        npiLinesRead = 0
+        npiBytesRead = 0
+        npiRowLines = []
+        parseStartTime = time.perf_counter()
+        with open(sampleFileSpecs["NPIDATA"], "rb") as inFile:
+            sampleRows = [x for x in read_npi_rows(inFile) if x is not None]
+        parseSeconds = time.perf_counter() - parseStartTime
+        if npiErrFile:
+            npiErrFile.close()
+            npiErrFile = None
+
+        mappedNPIs = []
+        mapStartTime = time.perf_counter()
+        for input_row in sampleRows:
+            if npiFilterActive and not check_npi_filter(input_row):
+                continue
+            mappedNPIs.append(input_row["NPI"])
+            map_npi(input_row)
+        for outFile in outputBuffers.values():
+            flush_records(outFile)
+        mapSeconds = time.perf_counter() - mapStartTime
+    conn.close()
+
+    sampleRowCount = len(sampleRows)
+    if not sampleRowCount:
+        msgOut(0, " No NPIs were sampled, the file may be empty", "W", "", 0, 0)
+        return periodEstimate
+    scaleFactor = npiRows * runFraction / sampleRowCount
+
+    # --distribution of reference rows per mapped NPI
+    for tabName in ("OTHERNAME", "PL", "ENDPOINT"):
+        rowsPerNPI = {"0": 0, "1": 0, "2": 0, "3-5": 0, "6-10": 0, "11+": 0}
+        for mappedNPI in mappedNPIs:
+            npiRowCount = sampleNPIs[tabName].get(mappedNPI, 0)
+            if npiRowCount <= 2:
+                rowsPerNPI[str(npiRowCount)] += 1
+            elif npiRowCount <= 5:
+                rowsPerNPI["3-5"] += 1
+            elif npiRowCount <= 10:
+                rowsPerNPI["6-10"] += 1
+            else:
+                rowsPerNPI["11+"] += 1
+        periodEstimate["files"][tabName]["rows_per_npi_pct"] = {
+            x: round(100 * y / len(mappedNPIs), 1) if mappedNPIs else 0
+            for x, y in rowsPerNPI.items()
+        }
+
+    periodEstimate["sampled_npis"] = sampleRowCount
+    periodEstimate["quarantined_sample_rows"] = npiQuarantineCount
+    periodEstimate["mapped_npis"] = int(len(mappedNPIs) * scaleFactor)
+    periodEstimate["output_records"] = {
+        "NPI-PROVIDERS": int(len(mappedNPIs) * scaleFactor),
+        "NPI-OFFICIALS": int(NPIOfficials_row_count * scaleFactor),
+        "NPI-LOCATIONS": int(NPILocations_row_count * scaleFactor),
+        "NPI-AFFILIATIONS": int(NPIAffiliations_row_count * scaleFactor),
+    }
+    periodEstimate["output_bytes"] = {
+        x: int(len(y.getvalue().encode("utf-8")) * scaleFactor)
+        for x, y in outputBuffers.items()
+    }
+
+    # --memory: the reference DB and the chunks being loaded, the main mapping loop itself is small
+    refFileSpecs = [fileSpecs[x] for x in ("OTHERNAME", "PL", "ENDPOINT")]
+    refFraction = runFraction * (len(mappedNPIs) / sampleRowCount)
+    refBytes = sum(os.path.getsize(x) for x in refFileSpecs) * refFraction
+    avgRowBytes = max(get_avg_row_bytes(x) for x in refFileSpecs)
+    # --a loading chunk is never bigger than the (sampled) file it is read from
+    chunkBytes = min(
+        250000 * avgRowBytes * 10,
+        max(os.path.getsize(x) for x in refFileSpecs) * refFraction * 10,
+    )
+    periodEstimate["reference_db_bytes"] = int(refBytes * 1.5)
+    periodEstimate["peak_memory_bytes"] = int(get_peak_rss() + chunkBytes)
+    if memoryBudget:
+        referenceBackend, loadChunkSize, cacheKiB = choose_reference_backend(
+            memoryBudget, refFileSpecs, refFraction
+        )
+        periodEstimate["reference_backend"] = referenceBackend
+        chunkBytes = loadChunkSize * avgRowBytes * 10 * len(refFileSpecs)
+        periodEstimate["peak_memory_bytes"] = int(
+            get_peak_rss()
+            + chunkBytes
+            + (refBytes * 1.5 if referenceBackend == "memory" else cacheKiB * 1024)
+        )
+
+    # --runtime: every main row is parsed, only the ones that pass the filters are mapped
+    estimatedSeconds = scanSeconds
+    if loadBytesPerSecond:
+        estimatedSeconds += (
+            max(os.path.getsize(x) for x in refFileSpecs)
+            * refFraction
+            / loadBytesPerSecond
+        )
+    estimatedSeconds += npiRows * parseSeconds / sampleRowCount
+    estimatedSeconds += mapSeconds * scaleFactor
+    periodEstimate["runtime_minutes"] = round(estimatedSeconds / 60, 1)
+
+    for tabName, fileEstimate in periodEstimate["files"].items():
+        msgOut(
+            0,
+            "     %-10s about %12s rows %12s"
+            % (
+                tabName,
+                fileEstimate["rows"],
+                format_bytes(fileEstimate["bytes"]),
+            ),
+            "I",
+            "",
+            0,
+            0,
+        )
+        if "rows_per_npi_pct" in fileEstimate:
+            msgOut(
+                0,
+                "                rows per NPI %: "
+                + ", ".join(
+                    "%s=%s" % (x, y)
+                    for x, y in fileEstimate["rows_per_npi_pct"].items()
+                ),
+                "I",
+                "",
+                0,
+                0,
+            )
+    for dataSource, recordCount in periodEstimate["output_records"].items():
+        msgOut(
+            0,
+            "     %-18s %12s records %12s"
+            % (
+                dataSource,
+                recordCount,
+                format_bytes(periodEstimate["output_bytes"][dataSource]),
+            ),
+            "I",
+            "",
+            0,
+            0,
+        )
+    msgOut(
+        0,
+        "     Estimated peak memory  : "
+        + format_bytes(periodEstimate["peak_memory_bytes"]),
+        "I",
+        "",
+        0,
+        0,
+    )
+    msgOut(
+        0,
+        "     Estimated runtime      : %s minutes, from %s sampled NPIs"
+        % (periodEstimate["runtime_minutes"], sampleRowCount),
+        "I",
+        "",
+        0,
+        0,
+    )
+    if npiQuarantineCount:
+        msgOut(
+            0,
+            "     %s sampled main NPI rows could not be read and were left out"
+            % npiQuarantineCount,
+            "W",
+            "",
+            0,
+            0,
+        )
+    return periodEstimate
+
+
+# ---------------------------------------------------------------------
+#   M A I N     P R O G R A M
+# ---------------------------------------------------------------------
+if __name__ == "__main__":
+
+    procStartTime = time.time()
+
+    msgOut(0, "  - Starting processing", "I", "", 0, 0)
+    # --   Checking Arguments passed in
+    msgOut(0, "      - Checking parameters passed in", "I", "", 0, 0)
+
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument(
+        "-i",
+        "--sourceDir",
+        dest="sourceDir",
+        default="",
+        help="directory in which the source files are located, can be a comma separated list, required unless --regenerate or --npi-history",
+    )
+    argParser.add_argument(
+        "-f",
+        "--filePeriod",
+        dest="filePeriod",
+        default="",
+        help='the period portion of the NPPES file naming convention such as "20050523-20201108", can be a comma separated list or a wildcard such as "*-2020*"',
+    )
+    argParser.add_argument(
+        "-o",
+        "--outFileDir",
+        dest="outputFilePath",
+        default="",
+        help="the file or directory to write the JSON files to, required unless --check-sort, --estimate, --merge-stats, --serve or --npi-history",
+    )
+    argParser.add_argument(
+        "-l",
+        "--logFileName",
+        dest="logFileName",
+        default="",
+        help="optional statistics output file name",
+    )
+    argParser.add_argument(
+        "--state",
+        dest="stateFilter",
+        default="",
+        help='only map NPIs with a practice location in these states, comma separated such as "NY,NJ"',
+    )
+    argParser.add_argument(
+        "--entity-type",
+        dest="entityTypeFilter",
+        default="",
+        choices=["1", "2"],
+        help="only map NPIs of this entity type code, 1=individual 2=organization",
+    )
+    argParser.add_argument(
+        "--taxonomy",
+        dest="taxonomyFilter",
+        default="",
+        help="only map NPIs with one of these taxonomy codes or taxonomy group codes, comma separated",
+    )
+    argParser.add_argument(
+        "--status",
+        dest="statusFilter",
+        default="",
+        choices=["active", "deactivated"],
+        help="only map active or only map deactivated NPIs",
+    )
+    argParser.add_argument(
+        "--enumerated-from",
+        dest="enumeratedFrom",
+        default="",
+        help="only map NPIs enumerated on or after this date (YYYY-MM-DD)",
+    )
+    argParser.add_argument(
+        "--enumerated-to",
+        dest="enumeratedTo",
+        default="",
+        help="only map NPIs enumerated on or before this date (YYYY-MM-DD)",
+    )
+    argParser.add_argument(
+        "--sample-rate",
+        dest="sampleRate",
+        type=float,
+        default=1.0,
+        help="only map this fraction of the NPIs such as 0.01 for 1%%, picked by a stable hash of the NPI so the same NPIs are kept in all files",
+    )
+    argParser.add_argument(
+        "--memory-budget",
+        dest="memoryBudget",
+        default="",
+        help="optional memory limit such as 4G, used to choose how the reference data is held and loaded",
+    )
+    argParser.add_argument(
+        "--profile",
+        dest="profileFileName",
+        default="",
+        help="optional file to profile the mapping to, with a summary of where the time went in <name>_summary.txt",
+    )
+    argParser.add_argument(
+        "--profile-mode",
+        dest="profileMode",
+        choices=("trace", "sample"),
+        default="trace",
+        help="trace writes a cProfile pstats file, sample writes collapsed stacks for flamegraph tools, defaults to trace",
+    )
+    argParser.add_argument(
+        "--profile-rows",
+        dest="profileRows",
+        type=int,
+        default=0,
+        help="only profile the first this many main NPI rows, defaults to the whole file period",
+    )
+    argParser.add_argument(
+        "--export-db",
+        dest="exportDbFileName",
+        default="",
+        help="optional sqlite file the mapped records are also written to, a table per data source with child tables for lists",
+    )
+    argParser.add_argument(
+        "--history-db",
+        dest="historyDbFileName",
+        default="",
+        help="optional sqlite file each mapped file period is appended to, keeping only the records that changed",
+    )
+    argParser.add_argument(
+        "--regenerate",
+        dest="regenerate",
+        action="store_true",
+        default=False,
+        help="only write the output of the -f file periods from the --history-db, no input files are read",
+    )
+    argParser.add_argument(
+        "--npi-history",
+        dest="npiHistory",
+        default="",
+        help="only write the history of these comma separated NPIs from the --history-db to -o, or the console",
+    )
+    argParser.add_argument(
+        "--metrics-file",
+        dest="metricsFileName",
+        default="",
+        help="optional live metrics file, rewritten during the run. Use a .prom extension for a prometheus textfile collector, otherwise json",
+    )
+    argParser.add_argument(
+        "--metrics-interval",
+        dest="metricsInterval",
+        type=int,
+        default=15,
+        help="seconds between metrics file updates, defaults to 15",
+    )
+    argParser.add_argument(
+        "--period-workers",
+        dest="periodWorkers",
+        type=int,
+        default=1,
+        help="number of file periods to map at the same time when more than one is given, defaults to 1",
+    )
+    argParser.add_argument(
+        "--check-sort",
+        dest="checkSort",
+        action="store_true",
+        default=False,
+        help="only check that the input files are in NPI order, no mapping is done",
+    )
+    argParser.add_argument(
+        "--check-columns",
+        dest="checkColumns",
+        action="store_true",
+        default=False,
+        help="only check that the input files have the columns the mapping reads, no mapping is done",
+    )
+    argParser.add_argument(
+        "--sort",
+        dest="sortInputs",
+        action="store_true",
+        default=False,
+        help="sort any input file that is not in NPI order before mapping it",
+    )
+    argParser.add_argument(
+        "--sort-dir",
+        dest="sortDir",
+        default="",
+        help="directory for the sorted copies of the input files, defaults to a sorted directory under the output directory",
+    )
+    argParser.add_argument(
+        "--sort-memory",
+        dest="sortMemory",
+        default="1G",
+        help="memory to use for each sorted run such as 512M or 2G, defaults to 1G",
+    )
+    argParser.add_argument(
+        "--estimate",
+        dest="estimate",
+        action="store_true",
+        default=False,
+        help="only profile the input files and estimate the output, memory and runtime of mapping them on this host",
+    )
+    argParser.add_argument(
+        "--estimate-npis",
+        dest="estimateNPIs",
+        type=int,
+        default=2000,
+        help="number of NPIs to sample and map for --estimate, defaults to 2000",
+    )
+    argParser.add_argument(
+        "--only",
+        dest="onlySources",
+        default="",
+        help="only map these data sources, comma separated such as NPI-PROVIDERS,NPI-OFFICIALS",
+    )
+    argParser.add_argument(
+        "--skip",
+        dest="skipSources",
+        default="",
+        help="do not map these data sources, comma separated such as NPI-LOCATIONS,NPI-AFFILIATIONS",
+    )
+    argParser.add_argument(
+        "--spread-window",
+        dest="spreadWindow",
+        type=int,
+        default=0,
+        help="hold back this many records per output file to spread the ones that share an address, phone or affiliate apart, such as 10000",
+    )
+    argParser.add_argument(
+        "--stable-ids",
+        dest="stableIds",
+        action="store_true",
+        default=False,
+        help="give locations and affiliations RECORD_IDs from a hash of their values instead of a counter",
+    )
+    argParser.add_argument(
+        "--max-error-rate",
+        dest="maxErrorRate",
+        type=float,
+        default=0.001,
+        help="fraction of the main NPI rows that can be quarantined before the run is aborted, defaults to 0.001",
+    )
+    argParser.add_argument(
+        "--anchor-first",
+        dest="anchorFirst",
+        action="store_true",
+        default=False,
+        help="write each NPI-PROVIDERS record before the records that point to it",
+    )
+    argParser.add_argument(
+        "--output-profile",
+        dest="outputProfile",
+        default="full",
+        help='full (the default) or resolution to leave out the payload attributes, for one data source as "NPI-PROVIDERS=resolution", can be a comma separated list',
+    )
+    argParser.add_argument(
+        "--serve",
+        dest="servePort",
+        type=int,
+        default=0,
+        help="serve the mapped records of single NPIs over http on this port, from the last file period -i and -f match",
+    )
+    argParser.add_argument(
+        "--serve-host",
+        dest="serveHost",
+        default="127.0.0.1",
+        help="address for --serve to listen on, defaults to 127.0.0.1",
+    )
+    argParser.add_argument(
+        "--partition",
+        dest="partition",
+        default="",
+        help="only map the NPIs in hash partition K of N such as 2/8, for spreading a run over several hosts",
+    )
+    argParser.add_argument(
+        "--merge-stats",
+        dest="mergeStats",
+        action="store_true",
+        default=False,
+        help="only merge the statistics files (-l) written by each --partition into the statistics file of a single run",
+    )
+    parms = argParser.parse_args()
+
+    periodList = get_period_list(parms.sourceDir, parms.filePeriod)
+    abortRun = init_run_settings(parms, len(periodList) > 1)
+    historyCommand = parms.regenerate or parms.npiHistory
+    if historyCommand:
+        if not parms.historyDbFileName or not os.path.isfile(parms.historyDbFileName):
+            abortRun = 1
+            msgOut(
+                0,
+                " --regenerate and --npi-history need an existing --history-db",
+                "E",
+                "",
+                2,
+                0,
+            )
+        if parms.regenerate and not parms.filePeriod:
+            abortRun = 1
+            msgOut(0, " --regenerate needs the file periods (-f)", "E", "", 2, 0)
+    elif not parms.sourceDir or not parms.filePeriod:
+        abortRun = 1
+        msgOut(
+            0,
+            " The source directory (-i) and file period (-f) are required",
+            "E",
+            "",
+            2,
+            0,
+        )
+    elif not periodList:
+        abortRun = 1
+        msgOut(
+            0,
+            " No file periods found for : " + parms.filePeriod,
+            "E",
+            "",
+            2,
+            0,
+        )
+    # --the output names only carry the file period, the same period from two source directories would overwrite
+    periodDirs = {}
+    for sourceDir, filePeriod in periodList:
+        periodDirs.setdefault(filePeriod, []).append(sourceDir)
+    for filePeriod, sourceDirs in periodDirs.items():
+        if len(sourceDirs) > 1:
+            abortRun = 1
+            msgOut(
+                0,
+                " File period %s is in more than one source directory : %s   <-  map them in separate runs"
+                % (filePeriod, ", ".join(sourceDirs)),
+                "E",
+                "",
+                2,
+                0,
+            )
+    if parms.periodWorkers < 1:
+        abortRun = 1
+        msgOut(0, " Period workers must be 1 or more", "E", "", 2, 0)
+    if parms.mergeStats and (not parms.logFileName or parms.partition):
+        abortRun = 1
+        msgOut(
+            0,
+            " --merge-stats needs the statistics file (-l) and no --partition",
+            "E",
+            "",
+            2,
+            0,
+        )
+    if parms.servePort and (parms.partition or parms.sampleRate < 1 or npiFilterActive):
+        abortRun = 1
+        msgOut(
+            0,
+            " --serve maps every NPI and cannot be used with --partition, --sample-rate or filters",
+            "E",
+            "",
+            2,
+            0,
+        )
+    if parms.historyDbFileName and (
+        parms.partition or parms.sampleRate < 1 or npiFilterActive
+    ):
+        abortRun = 1
+        msgOut(
+            0,
+            " --history-db keeps whole file periods and cannot be used with --partition, --sample-rate or filters",
+            "E",
+            "",
+            2,
+            0,
+        )
+    if not parms.outputFilePath and not (
+        parms.checkSort
+        or parms.checkColumns
+        or parms.estimate
+        or parms.mergeStats
+        or parms.servePort
+        or parms.npiHistory
+    ):
+        abortRun = 1
+        msgOut(0, " An output file or directory (-o) is required", "E", "", 2, 0)
+    if abortRun == 1:
+        msgOut(1, " Aborting Run after Command Line Validation", "E", "", 42, 0)
+
+    # --history modes only read the history db, the NPI history is written to -o or the console
+    if parms.npiHistory:
+        historyConn = open_history_db(parms.historyDbFileName)
+        npiList = parse_list_parm(parms.npiHistory)
+        if parms.outputFilePath:
+            with open(parms.outputFilePath, "w") as outfile:
+                missingCount = write_npi_history(historyConn, npiList, outfile)
+            msgOut(0, f"NPI history written to {parms.outputFilePath}", "I", "", 0, 0)
+        else:
+            missingCount = write_npi_history(historyConn, npiList, sys.stdout)
+        historyConn.close()
+        sys.exit(1 if missingCount else 0)
+    if parms.regenerate:
+        historyConn = open_history_db(parms.historyDbFileName)
+        historyPeriods = get_history_periods(historyConn, parms.filePeriod)
+        if not historyPeriods:
+            msgOut(
+                1,
+                " No file periods in the history db match : " + parms.filePeriod,
+                "E",
+                "",
+                2,
+                0,
+            )
+        multiPeriod = len(historyPeriods) > 1
+        for filePeriod in historyPeriods:
+            regenerate_history_period(historyConn, filePeriod)
+        historyConn.close()
+        sys.exit(0)
+
+    # --check mode only reports whether the input files are in NPI order
+    if parms.checkSort:
+        unorderedFiles = 0
+        for sourceDir, filePeriod in periodList:
+            for fileType in ("npidata", "othername", "pl", "endpoint"):
+                fileSpec = os.path.abspath(
+                    sourceDir + fileType + "_pfile_" + filePeriod + ".csv"
+                )
+                if not os.path.isfile(fileSpec):
+                    msgOut(0, fileSpec + " does not exist", "W", "", 0, 0)
+                    continue
+                rowCount, unorderedCount = check_npi_order(fileSpec)
+                if unorderedCount:
+                    unorderedFiles += 1
+                    msgOut(
+                        0,
+                        " %s is NOT in NPI order, %s of %s rows are out of order"
+                        % (fileSpec, unorderedCount, rowCount),
+                        "W",
+                        "",
+                        0,
+                        0,
+                    )
+                else:
+                    msgOut(
+                        0,
+                        "  %s is in NPI order, %s rows" % (fileSpec, rowCount),
+                        "I",
+                        "",
+                        0,
+                        0,
+                    )
+        sys.exit(1 if unorderedFiles else 0)
+
+    # --the input headers of every file period are checked up front, a renamed column would
+    #   otherwise only fail the run after its reference data is loaded
+    if not parms.mergeStats:
+        missingCount = 0
+        for sourceDir, filePeriod in periodList:
+            missingCount += check_period_columns(sourceDir, filePeriod)
+        if parms.checkColumns:
+            if not missingCount:
+                msgOut(0, "  Input files have all the mapped columns", "I", "", 0, 0)
+            sys.exit(1 if missingCount else 0)
+        if missingCount:
+            msgOut(
+                1,
+                " Aborting Run, %s mapped columns are missing" % missingCount,
+                "E",
+                "",
+                42,
+                0,
+            )
+
+    # --estimate mode only profiles the input files and estimates the cost of mapping them
+    if parms.estimate:
+        periodEstimates = {}
+        for sourceDir, filePeriod in periodList:
+            periodEstimates[sourceDir + filePeriod] = estimate_period(
+                sourceDir, filePeriod
+            )
+        if parms.logFileName:
+            with open(parms.logFileName, "w") as outfile:
+                json.dump(periodEstimates, outfile, indent=4)
+            msgOut(0, f"Estimates written to {parms.logFileName}", "I", "", 0, 0)
+        sys.exit(0)
+
+    # --merge mode only combines the partition statistics files into one per file period
+    if parms.mergeStats:
+        mergeErrors = 0
+        for filePeriod in sorted({x[1] for x in periodList}):
+            mergeErrors = max(mergeErrors, merge_period_stats(filePeriod))
+        sys.exit(mergeErrors)
+
+    # --server mode keeps the reference data and main NPI file index of a file period loaded and maps NPIs on request
+    if parms.servePort:
+        refRowsLoaded = {}
+        serveStore = None
+        serveLoading = True
+        load_serve_store(*periodList[-1])
+        if not serveStore:
+            msgOut(1, " Aborting Run, file period could not be loaded", "E", "", 43, 0)
+        # --single threaded, requests map one at a time anyway as serveMapLock guards the mapping globals
+        serveServer = http.server.HTTPServer(
+            (parms.serveHost, parms.servePort), ServeRequestHandler
+        )
+        msgOut(
+            0,
+            "  Serving NPIs on http://%s:%s/npi/<npi>"
+            % (parms.serveHost, parms.servePort),
+            "I",
+            "",
+            0,
+            0,
+        )
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            serveServer.serve_forever()
+        except KeyboardInterrupt:
+            serveServer.server_close()
+        sys.exit(0)
+
+    periodWorkers = min(parms.periodWorkers, len(periodList))
+
+    periodResults = []
+    if periodWorkers > 1:
+        msgOut(
+            0,
+            "  Mapping %s file periods, %s at a time"
+            % (len(periodList), periodWorkers),
+            "I",
+            "",
+            0,
+            0,
+        )
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=periodWorkers,
+            initializer=init_run_settings,
+            initargs=(parms, True, periodWorkers),
+        ) as periodPool:
+            for periodResult in periodPool.map(
+                process_period,
+                [x[0] for x in periodList],
+                [x[1] for x in periodList],
+            ):
+                periodResults.append(periodResult)
+    else:
+        for sourceDir, filePeriod in periodList:
+            periodResults.append(process_period(sourceDir, filePeriod))
+            if shutDown:
+                break
+
+    if len(periodList) > 1:
+        msgOut(0, "  File period summary", "I", "", 0, 0)
+        for periodResult in periodResults:
+            msgOut(
+                0,
+                "     %s%s : %s NPI rows, %s JSON rows in %s minutes%s"
+                % (
+                    periodResult["sourceDir"],
+                    periodResult["filePeriod"],
+                    periodResult["npiRows"],
+                    periodResult["jsonRows"],
+                    periodResult["elapsedMins"],
+                    " (aborted)" if periodResult["aborted"] else "",
+                ),
+                "I",
+                "",
+                0,
+                0,
+            )
+
+    # --the completed file periods are appended to the history db in period order
+    if parms.historyDbFileName:
+        historyConn = open_history_db(parms.historyDbFileName)
+        for periodResult in sorted(periodResults, key=lambda x: x["filePeriod"][-8:]):
+            if periodResult["aborted"]:
+                msgOut(
+                    0,
+                    " File period %s was aborted and is not appended to the history db"
+                    % periodResult["filePeriod"],
+                    "W",
+                    "",
+                    0,
+                    0,
+                )
+                continue
+            append_history_period(historyConn, periodResult)
+        historyConn.close()
+
+    elapsedMins = round((time.time() - procStartTime) / 60, 1)
+    if shutDown or any(x["aborted"] for x in periodResults):
         msgOut(
             0, " Process aborted after " + str(elapsedMins) + " minutes!", "I", "", 0, 0
         )